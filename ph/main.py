@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import copy
 import datetime
 import json
 import os
@@ -13,15 +14,43 @@ import sys
 
 from ph import gh
 from ph import formatters
+from ph import parsepool
 from ph import shell
+from ph import stats
+from ph.cachebundle import write_bundle
 from ph.commitlog import CommitLog
 from ph.coveragedetails import CoverageDetails
 from ph.coveragesummary import CoverageSummary
+from ph.diskcache import NAMESPACES
 from ph.pullrequest import PullRequest
 from ph.release import Release
+from ph.sqlitecache import SqliteCache
 from ph.workflowrun import WorkflowRun
 
 
+def _parse_days(value):
+  return sorted(set(int(days) for days in value.split(",")))
+
+
+_SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def _parse_bytes(value):
+  value = value.strip().upper().rstrip("B")
+  if value and value[-1] in _SIZE_SUFFIXES:
+    return int(float(value[:-1]) * _SIZE_SUFFIXES[value[-1]])
+  return int(value)
+
+
+def _parse_quota(value):
+  namespace, _, size = value.partition("=")
+  if namespace not in NAMESPACES or not size:
+    raise argparse.ArgumentTypeError(
+        "Expected NAMESPACE=SIZE, where NAMESPACE is one of: " +
+        ", ".join(NAMESPACES))
+  return namespace, _parse_bytes(size)
+
+
 def parse_args():
   home = os.environ.get("HOME", "/")
 
@@ -29,55 +58,166 @@ def parse_args():
       description="Take project health (PH) measurements",
       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument(
-      "--days", "-d", type=int, help="Time period in days", default=90)
+      "command", nargs="?",
+      choices=["collect", "migrate-cache", "pack-cache"],
+      help="\"collect\" takes measurements.  \"migrate-cache\" moves a"
+           " cache folder of JSON files into the SQLite cache in that folder."
+           "  \"pack-cache\" packs the live cache entries, including those"
+           " from --cache-bundle, into the --cache-bundle file.",
+      default="collect")
+  parser.add_argument(
+      "--days", "-d", type=_parse_days,
+      help="Time period in days, or a comma-separated list of periods.  Data"
+           " is collected once for the longest period and filtered for the"
+           " others.",
+      default="90")
   parser.add_argument(
       "--repo", "-r", help="GitHub repo name",
       default="shaka-project/shaka-player")
   parser.add_argument(
-      "--rate-limit",
+      "--rate-limit", type=int,
       help="Self-imposed sustained rate limit (calls/hour) after the burst"
            " budget is consumed. GitHub's actual limit is 5,000 calls/hour"
            " for personal tokens, shared across all apps using that token."
-           " This lower value preserves quota for other tools.",
+           " This lower value preserves quota for other tools.  The burst"
+           " budget follows the quota GitHub reports on each response.",
       default=4000)
+  parser.add_argument(
+      "--api-backend", choices=["auto", "http", "gh"],
+      help="How to call the GitHub API.  \"http\" uses pooled in-process"
+           " connections, \"gh\" runs a \"gh api\" subprocess per call, and"
+           " \"auto\" uses \"http\" when a token can be found.",
+      default="auto")
+  parser.add_argument(
+      "--concurrency", type=int,
+      help="Maximum number of GitHub API calls to make at once",
+      default=1)
+  parser.add_argument(
+      "--workers", type=int,
+      help="Number of processes for parsing coverage artifacts.  0 parses"
+           " them in the main process.",
+      default=0)
+  parser.add_argument(
+      "--page-size", type=int,
+      help="Items per page when listing workflow runs, PRs, and other"
+           " objects, up to 100.  Each page is cached separately.",
+      default=100)
   parser.add_argument(
       "--cache-folder", help="Where to cache GitHub API responses",
       default=os.path.join(home, ".cache", "shaka-player-ph"))
+  parser.add_argument(
+      "--cache-backend", choices=["files", "sqlite"],
+      help="How to store the cache: one JSON file per entry, or a single"
+           " SQLite database in the cache folder",
+      default="files")
+  parser.add_argument(
+      "--cache-compression", choices=["gzip", "zstd"],
+      help="Compress cached JSON and text data (files backend only).  zstd"
+           " requires the zstandard module.",
+      default=None)
+  parser.add_argument(
+      "--cache-max-bytes", type=_parse_bytes,
+      help="Evict the least recently used cache entries to keep the cache"
+           " under this size, such as 500M or 2G.  Pinned coverage results"
+           " are never evicted.",
+      default=None)
+  parser.add_argument(
+      "--cache-quota", type=_parse_quota, action="append",
+      help="Size limit for one kind of cache entry, as NAMESPACE=SIZE, such"
+           " as artifacts=1G.  Namespaces are " + ", ".join(NAMESPACES) +
+           ".  May be repeated.",
+      default=[])
+  parser.add_argument(
+      "--cache-bundle",
+      help="A single-file cache bundle written by \"pack-cache\".  Entries"
+           " are read from it without extracting it, and new entries are"
+           " written to the cache folder.",
+      default=None)
+  parser.add_argument(
+      "--stale-while-revalidate", action="store_true",
+      help="Use recently expired API responses right away, and refresh them"
+           " after the output is written.  Results may be a few hours old.",
+      default=False)
+  parser.add_argument(
+      "--cache-artifacts", action="store_true",
+      help="Cache downloaded artifact and log zips, not just the results"
+           " computed from them",
+      default=False)
+  parser.add_argument(
+      "--ranged-artifacts", action="store_true",
+      help="Download only the needed file from each artifact zip, using HTTP"
+           " Range requests.  Ignored with --cache-artifacts, which needs"
+           " whole zips.",
+      default=False)
+  parser.add_argument(
+      "--coverage-index", action="store_true",
+      help="Cache a compact index of each run's coverage details, so coverage"
+           " can be recomputed later without downloading artifacts again",
+      default=False)
   parser.add_argument(
       "--green-workflow", "-gw",
-      help="GitHub Actions workflow (filename or filename:event)"
-           " for greenness and flake measurements",
+      help="GitHub Actions workflow (filename, filename:event, or"
+           " filename:event:branch) for greenness and flake measurements",
       default="selenium-lab-tests.yaml:schedule")
   parser.add_argument(
       "--latency-workflow", "-lw",
-      help="GitHub Actions workflow (filename or filename:event)"
-           " for latency measurements",
+      help="GitHub Actions workflow (filename, filename:event, or"
+           " filename:event:branch) for latency measurements",
       default="build-and-test.yaml:pull_request")
   parser.add_argument(
       "--coverage-workflow", "-cw",
-      help="GitHub Actions workflow (filename or filename:event)"
-           " for coverage measurements",
+      help="GitHub Actions workflow (filename, filename:event, or"
+           " filename:event:branch) for coverage measurements",
       default="selenium-lab-tests.yaml:schedule")
   parser.add_argument(
       "--incremental-coverage-workflow", "-iw",
-      help="GitHub Actions workflow (filename or filename:event)"
-           " for incremental coverage measurements",
+      help="GitHub Actions workflow (filename, filename:event, or"
+           " filename:event:branch) for incremental coverage measurements",
       default="build-and-test.yaml:pull_request")
+  parser.add_argument(
+      "--graphql", action="store_true",
+      help="Find merged PRs with a GraphQL search by merge date, instead of"
+           " paging through every closed PR in the repo",
+      default=False)
   parser.add_argument(
       "--json", "-j", action="store_true", help="Output in JSON", default=False)
+  parser.add_argument(
+      "--output", "-o",
+      help="Write output to this file instead of stdout.  \"{days}\" is"
+           " replaced with the time period.  Required for multiple periods.")
+  parser.add_argument(
+      "--stats",
+      help="Write a JSON report of API calls, cache use, rate limit waits, and"
+           " time per phase to this file at exit, or to stderr if \"-\"")
   parser.add_argument(
       "--debug", action="store_true", help="Output debug logs to stderr",
       default=False)
 
-  return parser.parse_args()
+  args = parser.parse_args()
+  if args.command == "pack-cache" and not args.cache_bundle:
+    parser.error("pack-cache requires --cache-bundle.")
+  if len(args.days) > 1 and (not args.output or "{days}" not in args.output):
+    parser.error("Multiple periods require --output with \"{days}\" in it.")
+  return args
 
 
 # Headroom reserved for other tools sharing the same token.
 _QUOTA_SAFETY_MARGIN = 1000
 
 
+def _range_start(days):
+  now = datetime.datetime.now(datetime.timezone.utc)
+  time_range = datetime.timedelta(days=days)
+  range_start = now - time_range
+  # Force the timestamp to midnight to make the range queries cacheable.
+  return range_start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
 class CollectData(object):
   def __init__(self, args):
+    gh.configure_transport(args.api_backend, args.concurrency)
+    parsepool.configure(args.workers)
+
     remaining, reset_epoch = gh.get_rate_limit_remaining()
     burst = max(0, remaining - _QUOTA_SAFETY_MARGIN)
     if burst == 0:
@@ -87,39 +227,90 @@ class CollectData(object):
         "Running in sustained-rate-only mode.".format(remaining, reset_time),
         file=sys.stderr)
 
-    gh.configure(burst, args.rate_limit, args.cache_folder, args.debug)
-
-    now = datetime.datetime.now(datetime.timezone.utc)
-    time_range = datetime.timedelta(days=args.days)
-    range_start = now - time_range
-    # Force the timestamp to midnight to make the range queries cacheable.
-    range_start = range_start.replace(hour=0, minute=0, second=0, microsecond=0)
-
-    self.releases = Release.get_all(args.repo, range_start)
-
-    self.green_runs = WorkflowRun.get_all(
-        args.repo, args.green_workflow, range_start)
-    self.latency_runs = WorkflowRun.get_all(
-        args.repo, args.latency_workflow, range_start)
-    self.coverage_runs = WorkflowRun.get_all(
-        args.repo, args.coverage_workflow, range_start)
-    self.incremental_coverage_runs = WorkflowRun.get_all(
-        args.repo, args.incremental_coverage_workflow, range_start)
-
-    self.coverage_summaries = CoverageSummary.get_all(self.coverage_runs)
-    self.merged_prs = PullRequest.get_all_merged(args.repo, range_start)
+    gh.configure(burst, args.rate_limit, args.cache_folder, args.debug,
+                 args.concurrency, _QUOTA_SAFETY_MARGIN, args.cache_backend,
+                 args.cache_compression, args.cache_artifacts,
+                 args.cache_max_bytes, dict(args.cache_quota),
+                 args.cache_bundle, args.stale_while_revalidate,
+                 args.coverage_index, args.ranged_artifacts, args.page_size)
+
+    self.days = max(args.days)
+    range_start = _range_start(self.days)
+
+    with stats.phase("releases"):
+      self.releases = Release.get_all(args.repo, range_start)
+
+    with stats.phase("green_runs"):
+      self.green_runs = WorkflowRun.get_all(
+          args.repo, args.green_workflow, range_start)
+      # Only these runs are measured for flakiness.
+      WorkflowRun.load_previous_attempts(self.green_runs)
+    with stats.phase("latency_runs"):
+      self.latency_runs = WorkflowRun.get_all(
+          args.repo, args.latency_workflow, range_start)
+    with stats.phase("coverage_runs"):
+      self.coverage_runs = WorkflowRun.get_all(
+          args.repo, args.coverage_workflow, range_start)
+    with stats.phase("incremental_coverage_runs"):
+      self.incremental_coverage_runs = WorkflowRun.get_all(
+          args.repo, args.incremental_coverage_workflow, range_start)
+
+    with stats.phase("merged_prs"):
+      self.merged_prs = PullRequest.get_all_merged(
+          args.repo, range_start, args.graphql)
+
+    self._compute_coverage()
+
+  def _compute_coverage(self):
+    with stats.phase("coverage_summaries"):
+      self.coverage_summaries = CoverageSummary.get_all(self.coverage_runs)
 
     self.latest_line_coverage = None
     if len(self.coverage_summaries):
       self.latest_line_coverage = self.coverage_summaries[-1].line_coverage
 
-    self.average_incremental_coverage = PullRequest.average_incremental_coverage(
-        self.merged_prs, self.incremental_coverage_runs)
-
-
-def print_json(args, data):
+    with stats.phase("incremental_coverage"):
+      self.average_incremental_coverage = (
+          PullRequest.average_incremental_coverage(
+              self.merged_prs, self.incremental_coverage_runs))
+
+  def window(self, days):
+    """Returns the data for a shorter time period, filtered in memory.
+
+    The results match what a separate collection for that period would find.
+    """
+    if days == self.days:
+      return self
+
+    range_start = _range_start(days)
+    data = copy.copy(self)
+    data.days = days
+
+    data.releases = [
+        r for r in self.releases if r.start_time >= range_start]
+    data.green_runs = [
+        r for r in self.green_runs if r.trigger_time >= range_start]
+    data.latency_runs = [
+        r for r in self.latency_runs if r.trigger_time >= range_start]
+    data.coverage_runs = [
+        r for r in self.coverage_runs if r.trigger_time >= range_start]
+    data.incremental_coverage_runs = [
+        r for r in self.incremental_coverage_runs
+        if r.trigger_time >= range_start]
+
+    # Which run a PR matches depends on which runs are in range, so the
+    # coverage results are recomputed.  The inputs come from the cache.
+    data.merged_prs = [
+        pr.copy_without_coverage() for pr in self.merged_prs
+        if pr.timestamp >= range_start]
+
+    data._compute_coverage()
+    return data
+
+
+def print_json(data, out):
   print(json.dumps({
-    "range": args.days,
+    "range": data.days,
     "release_duration": Release.average_duration(data.releases),
     "release_granularity": Release.average_granularity(data.releases),
     "test_greenness": WorkflowRun.average_greenness(data.green_runs),
@@ -129,93 +320,172 @@ def print_json(args, data):
     "incremental_coverage": data.average_incremental_coverage,
     "releases": list(map(lambda r: r.serializable(), data.releases)),
     "green_runs": list(map(lambda r: r.serializable(), data.green_runs)),
-    "latency_runs": list(map(lambda r: r.serializable(), data.latency_runs)),
+    "latency_runs": list(map(lambda r: r.serializable(include_flaky=False),
+                             data.latency_runs)),
     "coverage_summaries": list(map(lambda s: s.serializable(), data.coverage_summaries)),
     "merged_prs": list(map(lambda pr: pr.serializable(), data.merged_prs)),
-  }))
+  }), file=out)
 
 
-def print_text_tables(args, data):
-  print("Release".ljust(10), "Duration".ljust(15), "Granularity")
-  print("=======".ljust(10), "========".ljust(15), "===========")
+def print_text_tables(data, out):
+  print("Release".ljust(10), "Duration".ljust(15), "Granularity", file=out)
+  print("=======".ljust(10), "========".ljust(15), "===========", file=out)
   for release in data.releases:
     duration = release.duration()
     if duration is not None:
       duration = duration.total_seconds()
     granularity = release.num_commits
     print(release.name.ljust(10), formatters.duration(duration).ljust(15),
-          granularity)
+          granularity, file=out)
 
-  print()
+  print(file=out)
 
-  print("Start".ljust(30), "Event".ljust(15), "Passed".ljust(10), "Flaky")
-  print("=====".ljust(30), "=====".ljust(15), "======".ljust(10), "=====")
+  print("Start".ljust(30), "Event".ljust(15), "Passed".ljust(10), "Flaky",
+        file=out)
+  print("=====".ljust(30), "=====".ljust(15), "======".ljust(10), "=====",
+        file=out)
   for run in data.green_runs:
     start = run.start_time.isoformat()
     print(start.ljust(30), run.event.ljust(15), str(run.passed).ljust(10),
-          run.flaky)
+          run.flaky, file=out)
 
-  print()
+  print(file=out)
 
-  print("Start".ljust(30), "Event".ljust(15), "Duration")
-  print("=====".ljust(30), "=====".ljust(15), "========")
+  print("Start".ljust(30), "Event".ljust(15), "Duration", file=out)
+  print("=====".ljust(30), "=====".ljust(15), "========", file=out)
   for run in data.latency_runs:
     start = run.start_time.isoformat()
     duration = run.duration.total_seconds()
     print(start.ljust(30), run.event.ljust(15),
-          formatters.duration(duration))
+          formatters.duration(duration), file=out)
 
-  print()
+  print(file=out)
 
-  print("Start".ljust(30), "Event".ljust(15), "Coverage")
-  print("=====".ljust(30), "=====".ljust(15), "========")
+  print("Start".ljust(30), "Event".ljust(15), "Coverage", file=out)
+  print("=====".ljust(30), "=====".ljust(15), "========", file=out)
   for summary in data.coverage_summaries:
     start = summary.start_time.isoformat()
     print(start.ljust(30), summary.event.ljust(15),
-          formatters.percentage(summary.line_coverage))
+          formatters.percentage(summary.line_coverage), file=out)
 
-  print()
+  print(file=out)
 
-  print("PR #".ljust(10), "Incremental Coverage")
-  print("====".ljust(10), "====================")
+  print("PR #".ljust(10), "Incremental Coverage", file=out)
+  print("====".ljust(10), "====================", file=out)
   for pr in data.merged_prs:
     print(str(pr.number).ljust(10),
-          formatters.percentage(pr.incremental_coverage))
-
-  print()
-
-  print("Average release duration over", args.days, "days:",
-        formatters.duration(Release.average_duration(data.releases)))
-  print("Average release granularity over", args.days, "days:",
-        formatters.rounded(Release.average_granularity(data.releases), "commits"))
-  print("Average test greenness over", args.days, "days:",
-        formatters.percentage(WorkflowRun.average_greenness(data.green_runs)))
-  print("Average test flakiness over", args.days, "days:",
-        formatters.percentage(WorkflowRun.average_flakiness(data.green_runs)))
-  print("Average test latency over", args.days, "days:",
-        formatters.duration(WorkflowRun.average_duration(data.latency_runs)))
+          formatters.percentage(pr.incremental_coverage), file=out)
+
+  print(file=out)
+
+  print("Average release duration over", data.days, "days:",
+        formatters.duration(Release.average_duration(data.releases)),
+        file=out)
+  print("Average release granularity over", data.days, "days:",
+        formatters.rounded(Release.average_granularity(data.releases), "commits"),
+        file=out)
+  print("Average test greenness over", data.days, "days:",
+        formatters.percentage(WorkflowRun.average_greenness(data.green_runs)),
+        file=out)
+  print("Average test flakiness over", data.days, "days:",
+        formatters.percentage(WorkflowRun.average_flakiness(data.green_runs)),
+        file=out)
+  print("Average test latency over", data.days, "days:",
+        formatters.duration(WorkflowRun.average_duration(data.latency_runs)),
+        file=out)
   print("Latest test coverage:",
-        formatters.percentage(data.latest_line_coverage))
-  print("Average incremental test coverage over", args.days, "days:",
-        formatters.percentage(data.average_incremental_coverage))
+        formatters.percentage(data.latest_line_coverage), file=out)
+  print("Average incremental test coverage over", data.days, "days:",
+        formatters.percentage(data.average_incremental_coverage),
+        file=out)
+
+
+def migrate_cache(args):
+  cache = SqliteCache(os.path.join(args.cache_folder, SqliteCache.FILENAME))
+  count = cache.import_folder(args.cache_folder)
+  print("Migrated {} cache entries into {}.".format(count, cache.path),
+        file=sys.stderr)
+
+
+def pack_cache(args):
+  cache = gh.open_cache(args.cache_folder, args.cache_backend,
+                        args.cache_compression, bundle_path=args.cache_bundle,
+                        stale_minutes=gh.MAX_STALE_MINUTES)
+  # Entries that could still be served stale are kept.  In CI, the cache
+  # folder starts out empty, so this is the only place the size limits apply.
+  count = write_bundle(args.cache_bundle, cache.entries(),
+                       args.cache_max_bytes, dict(args.cache_quota),
+                       gh.MAX_STALE_MINUTES, cache.access_time)
+  cache.clear_access_times()
+  print("Packed {} cache entries into {}.".format(count, args.cache_bundle),
+        file=sys.stderr)
 
 
 def main():
+  args = parse_args()
   try:
-    args = parse_args()
-    data = CollectData(args)
-
-    if args.json:
-      print_json(args, data)
-    else:
-      print_text_tables(args, data)
+    if args.command == "migrate-cache":
+      migrate_cache(args)
+      return
+    if args.command == "pack-cache":
+      pack_cache(args)
+      return
+
+    collected = CollectData(args)
+
+    for days in args.days:
+      with stats.phase("window"):
+        data = collected.window(days)
+
+      if args.output:
+        out = open(args.output.replace("{days}", str(days)), "w")
+      else:
+        out = sys.stdout
+
+      try:
+        if args.json:
+          print_json(data, out)
+        else:
+          print_text_tables(data, out)
+      finally:
+        if out is not sys.stdout:
+          out.close()
+
+    # Anything served stale is refreshed for next time, now that the output is
+    # published.
+    with stats.phase("refresh_stale"):
+      refreshed = gh.refresh_stale()
+    if refreshed:
+      print("Refreshed {} stale cache entries.".format(refreshed),
+            file=sys.stderr)
   finally:
+    parsepool.shutdown()
+
+    if gh.disk_cache is not None and args.cache_bundle:
+      # For "pack-cache", so it knows which bundle entries are still used.
+      gh.disk_cache.save_access_times()
+
     if gh.rate_limiter is not None:
       num_calls = gh.rate_limiter.num_calls
       minutes = (time.time() - gh.rate_limiter.start_time) / 60
       print("Made {} GH API calls over {:.1f} minutes.".format(
             num_calls, minutes), file=sys.stderr)
 
+    if gh.disk_cache is not None:
+      print("Memory cache: {} hits, {} misses.".format(
+            gh.disk_cache.hits, gh.disk_cache.misses), file=sys.stderr)
+
+    if args.stats:
+      extra = {}
+      if gh.rate_limiter is not None:
+        extra["api_calls"] = gh.rate_limiter.num_calls
+      if gh.disk_cache is not None:
+        extra["memory_cache"] = {
+          "hits": gh.disk_cache.hits,
+          "misses": gh.disk_cache.misses,
+        }
+      stats.write_report(args.stats, extra)
+
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,327 @@
+# Shaka Player Project Health Metrics
+# Copyright 2023 Google LLC
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from . import stats
+from .diskcache import (CacheEntry, EvictionCandidate, decode_data,
+                        encode_data, is_live, is_pinned, namespace_for_key,
+                        select_evictions)
+
+
+# A bundle is MAGIC, then the offset and length of the index, then the bodies
+# of all entries back to back, then the index.  The index is a JSON object
+# mapping keys to [offset, length, kind, expires_at, validators, accessed_at].
+# Bundles written before accessed_at was added have no accessed_at.
+MAGIC = b"PHCACHE1"
+_HEADER = struct.Struct("<QQ")
+_HEADER_SIZE = len(MAGIC) + _HEADER.size
+
+
+def _start_bundle(f):
+  # The header is written again at the end, once the index offset is known.
+  f.write(MAGIC + _HEADER.pack(0, 0))
+  return _HEADER_SIZE
+
+
+def _finish_bundle(f, index_offset, index):
+  index_body = json.dumps(index).encode("utf8")
+  f.write(index_body)
+  f.seek(len(MAGIC))
+  f.write(_HEADER.pack(index_offset, len(index_body)))
+
+
+def write_bundle(path, entries, max_bytes=None, quotas=None, stale_minutes=0,
+                 access_time=None):
+  """Packs (key, CacheEntry) pairs into a bundle file at path.
+
+  Entries that pruning would remove are skipped, except that they are kept
+  for stale_minutes past their expiry.  Then, if max_bytes or quotas (a map
+  of namespace to bytes) are given, the least recently used entries are
+  dropped to fit.  access_time(key) returns when an entry was last used, or
+  None if unknown, which counts as now.
+
+  The file is replaced atomically, so readers of an old bundle at the same
+  path are unaffected.  Returns the number of entries packed.
+  """
+  now = time.time()
+  index = {}
+  temp_path = path + ".tmp"
+
+  with open(temp_path, "wb") as f:
+    offset = _start_bundle(f)
+
+    for key, entry in entries:
+      if key in index or not is_live(entry, now, stale_minutes):
+        continue
+
+      kind, body = encode_data(entry.data)
+      f.write(body)
+      accessed_at = access_time(key) if access_time is not None else None
+      index[key] = [offset, len(body), kind, entry.expires_at,
+                    entry.validators or None, accessed_at or now]
+      offset += len(body)
+
+    _finish_bundle(f, offset, index)
+
+  evicted = set()
+  if max_bytes is not None or quotas:
+    candidates = [
+      EvictionCandidate(key, item[1], item[5], namespace_for_key(key),
+                        is_pinned(key))
+      for key, item in index.items()
+    ]
+    evicted = select_evictions(candidates, max_bytes, quotas)
+
+  if evicted:
+    # Copy what is kept into a smaller bundle, one body at a time.
+    compact_path = path + ".compact.tmp"
+    kept = {}
+    with open(temp_path, "rb") as source, open(compact_path, "wb") as f:
+      offset = _start_bundle(f)
+      for key, item in index.items():
+        if key in evicted:
+          continue
+        source.seek(item[0])
+        f.write(source.read(item[1]))
+        kept[key] = [offset] + item[1:]
+        offset += item[1]
+      _finish_bundle(f, offset, kept)
+
+    os.replace(compact_path, temp_path)
+    index = kept
+
+  os.replace(temp_path, path)
+  return len(index)
+
+
+class CacheBundle(object):
+  """Read-only access to a bundle file written by write_bundle.
+
+  Entries are read straight out of the memory-mapped file through the index.
+  A missing file is treated as an empty bundle.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._map = None
+    self._index = {}
+
+    try:
+      f = open(path, "rb")
+    except FileNotFoundError:
+      return
+
+    with f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if self._map[:len(MAGIC)] != MAGIC:
+      raise RuntimeError("Not a cache bundle:", path)
+
+    index_offset, index_length = _HEADER.unpack(
+        self._map[len(MAGIC):_HEADER_SIZE])
+    self._index = json.loads(
+        self._map[index_offset:index_offset + index_length])
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def __len__(self):
+    return len(self._index)
+
+  def keys(self):
+    return self._index.keys()
+
+  def get_entry(self, key):
+    """Returns a CacheEntry if it exists, even if expired, or None."""
+    return self.get_sized_entry(key)[0]
+
+  def get_sized_entry(self, key):
+    """Returns (CacheEntry, bytes stored) if it exists, or (None, 0)."""
+    item = self._index.get(key)
+    if item is None:
+      return None, 0
+
+    offset, length, kind, expires_at, validators = item[:5]
+    stats.record_cache_bytes(read=length)
+    data = decode_data(kind, self._map[offset:offset + length])
+    return CacheEntry(data, expires_at, validators or {}), length
+
+  def access_time(self, key):
+    """Returns when an entry was last used as of packing, or None."""
+    item = self._index.get(key)
+    if item is None or len(item) < 6:
+      return None
+    return item[5]
+
+  def close(self):
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+
+
+class BundledCache(object):
+  """A cache that falls back to reading from a CacheBundle.
+
+  Has the same interface as DiskCache.  Reads check the writable cache first,
+  then the bundle.  Writes only go to the writable cache, which can be packed
+  together with the bundle into a new bundle later.
+
+  Since the bundle is read-only, the times its entries are used are kept in
+  memory.  save_access_times() writes them to access_log_path, so that
+  packing in another process can evict the least recently used entries.
+  """
+
+  ACCESS_LOG_FILENAME = ".bundle-access"
+
+  def __init__(self, cache, bundle, access_log_path=None):
+    self.cache = cache
+    self.bundle = bundle
+    self.access_log_path = access_log_path
+    self._lock = threading.Lock()
+    # Keys deleted since the bundle was opened.  The bundle itself is
+    # read-only.
+    self._deleted = set()
+    # Maps keys to when they were last read from the bundle.
+    self._accessed = {}
+    self._logged_access = self._load_access_log()
+
+  def _load_access_log(self):
+    if self.access_log_path is None:
+      return {}
+    try:
+      with open(self.access_log_path, "r") as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def __getattr__(self, name):
+    # Anything else, such as cache_folder, belongs to the writable cache.
+    if name == "cache":
+      raise AttributeError(name)
+    return getattr(self.cache, name)
+
+  def _bundle_entry(self, key, record_access=True):
+    return self._sized_bundle_entry(key, record_access)[0]
+
+  def _sized_bundle_entry(self, key, record_access=True):
+    with self._lock:
+      if key in self._deleted:
+        return None, 0
+    entry, size = self.bundle.get_sized_entry(key)
+    if entry is not None and record_access:
+      with self._lock:
+        self._accessed[key] = time.time()
+    return entry, size
+
+  def access_time(self, key):
+    """Returns when an entry was last used, or None if unknown."""
+    access_time = self.cache.access_time(key)
+    if access_time is not None:
+      return access_time
+
+    with self._lock:
+      times = [self._accessed.get(key), self._logged_access.get(key),
+               self.bundle.access_time(key)]
+    times = [t for t in times if t is not None]
+    return max(times) if times else None
+
+  def save_access_times(self):
+    """Adds the times bundle entries were used to the access log."""
+    with self._lock:
+      if self.access_log_path is None or not self._accessed:
+        return
+      self._logged_access.update(self._accessed)
+      self._accessed.clear()
+      logged = dict(self._logged_access)
+
+    temp_path = self.access_log_path + ".tmp"
+    with open(temp_path, "w") as f:
+      json.dump(logged, f)
+    os.replace(temp_path, self.access_log_path)
+
+  def clear_access_times(self):
+    """Forgets logged access times, once they are packed into a bundle."""
+    with self._lock:
+      self._accessed.clear()
+      self._logged_access.clear()
+    if self.access_log_path is not None:
+      try:
+        os.unlink(self.access_log_path)
+      except FileNotFoundError:
+        pass
+
+  def get(self, key):
+    """Returns data if it exists and is valid, or None."""
+    entry = self.get_entry(key)
+    if entry is None or time.time() >= entry.expires_at:
+      return None
+    return entry.data
+
+  def get_entry(self, key):
+    """Returns a CacheEntry if it exists, even if expired, or None."""
+    return self.get_sized_entry(key)[0]
+
+  def get_sized_entry(self, key):
+    """Returns (CacheEntry, bytes stored) if it exists, or (None, 0)."""
+    entry, size = self.cache.get_sized_entry(key)
+    if entry is None:
+      entry, size = self._sized_bundle_entry(key)
+    return entry, size
+
+  def open(self, key):
+    """Returns a binary file for valid bytes data, or None."""
+    f = self.cache.open(key)
+    if f is not None:
+      return f
+
+    data = self.get(key)
+    if type(data) is not bytes:
+      return None
+    return io.BytesIO(data)
+
+  def entries(self):
+    """Yields (key, CacheEntry) for everything stored, even if expired.
+
+    Where both have the same key, the writable cache wins.
+    """
+    seen = set()
+    for key, entry in self.cache.entries():
+      seen.add(key)
+      yield key, entry
+
+    for key in list(self.bundle.keys()):
+      if key in seen:
+        continue
+      # Listing entries, such as for packing, doesn't count as using them.
+      entry = self._bundle_entry(key, record_access=False)
+      if entry is not None:
+        yield key, entry
+
+  def store(self, key, data, ttl_minutes, validators=None):
+    """Stores data in the writable cache.  See DiskCache.store."""
+    return self.cache.store(key, data, ttl_minutes, validators)
+
+  def refresh(self, key, ttl_minutes):
+    """Extends the life of an existing entry, which may have expired."""
+    if self.cache.get_entry(key) is None:
+      # Copy it out of the bundle, so the new expiry can be stored.
+      entry = self._bundle_entry(key)
+      if entry is not None:
+        self.cache.store(key, entry.data, ttl_minutes, entry.validators)
+      return
+
+    self.cache.refresh(key, ttl_minutes)
+
+  def delete(self, key):
+    """Removes an entry, if it exists."""
+    self.cache.delete(key)
+    with self._lock:
+      self._deleted.add(key)
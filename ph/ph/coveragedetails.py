@@ -2,9 +2,14 @@
 # Copyright 2023 Google LLC
 # SPDX-License-Identifier: Apache-2.0
 
+import base64
+import bisect
 import json
 import re
 
+from . import gh
+from . import parsepool
+
 
 # TODO: Figure out how to get karma to output relative paths only.
 def _strip_git_dir(path):
@@ -16,19 +21,243 @@ def _strip_git_dir(path):
   return re.sub(r'.*?/(lib|ui)/', r'\1/', path)
 
 
-def _coverage_lines(coverage_range):
+def _coverage_interval(coverage_range):
+  """Returns the lines of a range as a list of (start, end) intervals."""
   start_line = coverage_range["start"]["line"]
   end_line = coverage_range["end"]["line"]
+  if end_line < start_line:
+    return []
+  return [(start_line, end_line)]
+
+
+# Sets of lines are represented as sorted lists of (start, end) intervals,
+# inclusive.  The intervals never overlap or touch, so two lists are equal if
+# and only if they hold the same lines.
+
+
+def _subtract(intervals, removed):
+  """Returns the lines of intervals that are not in removed."""
+  result = []
+  i = 0
+  for start, end in intervals:
+    # Skip what was removed entirely before this interval.
+    while i < len(removed) and removed[i][1] < start:
+      i += 1
+
+    j = i
+    while j < len(removed) and removed[j][0] <= end and start <= end:
+      removed_start, removed_end = removed[j]
+      if removed_start > start:
+        result.append((start, removed_start - 1))
+      start = max(start, removed_end + 1)
+      j += 1
+
+    if start <= end:
+      result.append((start, end))
+  return result
+
+
+def _is_subset(intervals, other):
+  """True if all the lines of intervals are in other."""
+  j = 0
+  for start, end in intervals:
+    while j < len(other) and other[j][1] < start:
+      j += 1
+    # Since other is canonical, each interval must fit in one of its own.
+    if j == len(other) or other[j][0] > start or other[j][1] < end:
+      return False
+  return True
+
+
+class LineSet(object):
+  """A set of line numbers, stored as the bits of a Python int.
+
+  Union, intersection, and counting are single operations on the whole set,
+  and a file's worth of lines takes a few hundred bytes instead of a few
+  hundred kilobytes.
+  """
+
+  def __init__(self, bits=0):
+    self.bits = bits
+
+  @staticmethod
+  def from_lines(lines):
+    bits = 0
+    for line in lines:
+      bits |= 1 << line
+    return LineSet(bits)
+
+  @staticmethod
+  def from_intervals(intervals):
+    """Make a set from (start, end) intervals, inclusive."""
+    bits = 0
+    for start, end in intervals:
+      bits |= ((1 << (end - start + 1)) - 1) << start
+    return LineSet(bits)
+
+  def __or__(self, other):
+    return LineSet(self.bits | other.bits)
+
+  def __and__(self, other):
+    return LineSet(self.bits & other.bits)
+
+  def __len__(self):
+    return self.bits.bit_count()
+
+  def __contains__(self, line):
+    return line >= 0 and (self.bits >> line) & 1 == 1
+
+  def __iter__(self):
+    bits = self.bits
+    while bits:
+      lowest = bits & -bits
+      yield lowest.bit_length() - 1
+      bits ^= lowest
+
+  def __eq__(self, other):
+    if isinstance(other, LineSet):
+      return self.bits == other.bits
+    if isinstance(other, (set, frozenset)):
+      return set(self) == other
+    return NotImplemented
+
+  def __repr__(self):
+    return "LineSet({})".format(sorted(self))
+
+  def encode(self):
+    """Returns the set as a compact string, for storage."""
+    num_bytes = (self.bits.bit_length() + 7) // 8
+    return base64.b64encode(self.bits.to_bytes(num_bytes, "little")).decode()
+
+  @staticmethod
+  def decode(encoded):
+    return LineSet(int.from_bytes(base64.b64decode(encoded), "little"))
+
+
+class _IntervalTree(object):
+  """A static centered interval tree.
+
+  Finds the intervals that contain a given line in O(log n + m) time, where m
+  is the number found.
+  """
+
+  def __init__(self, intervals):
+    """intervals is a list of (start, end, value) tuples."""
+    self._root = self._build(sorted(intervals))
+
+  def _build(self, intervals):
+    if not intervals:
+      return None
+
+    # The median start.  Intervals entirely to either side of it go into
+    # subtrees, so each subtree has at most half of the intervals.
+    center = intervals[len(intervals) // 2][0]
+    left = [item for item in intervals if item[1] < center]
+    right = [item for item in intervals if item[0] > center]
+    here = [item for item in intervals if item[0] <= center <= item[1]]
+    by_end = sorted(here, key=lambda item: item[1], reverse=True)
+    return (center, here, by_end, self._build(left), self._build(right))
 
-  lines = set()
-  for line in range(start_line, end_line + 1):
-    lines.add(line)
-  return lines
+  def containing(self, line):
+    """Yields each (start, end, value) with start <= line <= end."""
+    node = self._root
+    while node is not None:
+      center, by_start, by_end, left, right = node
+      if line < center:
+        for item in by_start:
+          if item[0] > line:
+            break
+          yield item
+        node = left
+      else:
+        for item in by_end:
+          if item[1] < line:
+            break
+          yield item
+        node = right
+
+
+# Matches a JSON string.
+_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+# Matches anything in an object or array other than strings and nested
+# objects or arrays.
+_OTHER = r'[^"{}\[\]]*'
+
+
+def _container_pattern(depth):
+  # Matches an object or array nested up to depth levels deep, without
+  # backtracking.  Mismatched brackets are accepted, since this only skips
+  # over JSON that is already known to be valid.
+  inner = _STRING
+  if depth > 1:
+    inner = _STRING + "|" + _container_pattern(depth - 1)
+  return (r'[\[{]' + _OTHER + r'(?:(?:' + inner + r')' + _OTHER + r')*[\]}]')
+
+
+# Deep enough for Istanbul's branch maps.  Anything deeper falls back to a full
+# parse.
+_SKIP_CONTAINER = re.compile(_container_pattern(8))
+_WHITESPACE = re.compile(r'\s*')
+
+
+def _items(file_data, wanted_paths):
+  """Yields (path, data) for the files in coverage JSON.
+
+  If wanted_paths is given, only the files in it are parsed, and the rest are
+  skipped over without building them.
+  """
+  if wanted_paths is None:
+    yield from json.loads(file_data).items()
+    return
+
+  if type(file_data) is bytes:
+    file_data = file_data.decode("utf8")
+
+  decoder = json.JSONDecoder()
+
+  def skip_whitespace(pos):
+    return _WHITESPACE.match(file_data, pos).end()
+
+  def expect(pos, token):
+    pos = skip_whitespace(pos)
+    if not file_data.startswith(token, pos):
+      raise ValueError("Expected {} at {} in coverage JSON".format(token, pos))
+    return pos + 1
+
+  pos = expect(0, "{")
+  if file_data.startswith("}", skip_whitespace(pos)):
+    return
+
+  while True:
+    pos = expect(pos, '"')
+    path, pos = json.decoder.scanstring(file_data, pos)
+    pos = skip_whitespace(expect(pos, ":"))
+
+    if _strip_git_dir(path) in wanted_paths:
+      data, pos = decoder.raw_decode(file_data, pos)
+      yield path, data
+    else:
+      match = _SKIP_CONTAINER.match(file_data, pos)
+      if match:
+        pos = match.end()
+      else:
+        _, pos = decoder.raw_decode(file_data, pos)
+
+    pos = skip_whitespace(pos)
+    if file_data.startswith("}", pos):
+      return
+    pos = expect(pos, ",")
 
 
 class CoverageDetails(object):
-  def __init__(self, file_data):
-    json_data = json.loads(file_data)
+  def __init__(self, file_data, wanted_paths=None):
+    """Parse coverage JSON.
+
+    If wanted_paths is given, only those source paths (relative to the repo
+    root, like "lib/player.js") are processed.
+    """
+    if wanted_paths is not None:
+      wanted_paths = set(wanted_paths)
 
     self.files = {}
 
@@ -40,12 +269,9 @@ class CoverageDetails(object):
     #     "s": { ... }
     #   }
     # }
-    for path, path_data in json_data.items():
+    for path, path_data in _items(file_data, wanted_paths):
       path = _strip_git_dir(path)
 
-      statement_to_lines = {}
-      instrumented_lines = set()
-
       # The function map is a structure to map where each function is in a
       # source file:
       # {
@@ -65,11 +291,14 @@ class CoverageDetails(object):
       # }
       # We extract function locations and remove them from statement spans
       # below, so that we don't count (for example) class declaration statements
-      # as containing all the lines of every method in the class.
-      function_locations = []
-      for key, value in path_data["fnMap"].items():
-        lines = _coverage_lines(value["loc"])
-        function_locations.append(lines)
+      # as containing all the lines of every method in the class.  They are
+      # sorted by start, so the functions that start within a statement can be
+      # found by bisection, and keep their original order for subtraction.
+      function_intervals = sorted(
+          (interval, index)
+          for index, value in enumerate(path_data["fnMap"].values())
+          for interval in _coverage_interval(value["loc"]))
+      function_starts = [interval[0] for interval, index in function_intervals]
 
       # The statement map is a structure to map where each statement is in a
       # source file:
@@ -86,43 +315,119 @@ class CoverageDetails(object):
       #   },
       #   ...
       # }
-      for key, value in path_data["statementMap"].items():
+      statement_map = path_data["statementMap"]
+      order = {key: index for index, key in enumerate(statement_map)}
+      statement_tree = _IntervalTree([
+        (start, end, key)
+        for key, value in statement_map.items()
+        for start, end in _coverage_interval(value)
+      ])
+
+      statement_to_lines = {}
+      for key, value in statement_map.items():
         # All the lines of the statement, which may include other functions or
         # statements.
-        lines = _coverage_lines(value)
+        lines = _coverage_interval(value)
+        if not lines:
+          statement_to_lines[key] = lines
+          continue
+        start, end = lines[0]
 
         # Subtract from that the lines of any function that is a subset of
         # these lines.  By excluding entire methods before adding back their
         # child statements, we exclude empty lines in class methods.
-        for function_lines in function_locations:
-          if function_lines < lines:  # strict subset
-            lines -= function_lines  # set subtraction
+        first = bisect.bisect_left(function_starts, start)
+        last = bisect.bisect_right(function_starts, end)
+        functions = sorted(
+          (index, interval)
+          for interval, index in function_intervals[first:last]
+          if interval[1] <= end)
+        for index, function_lines in functions:
+          function_lines = [function_lines]
+          # Check for a proper subset of what is left.  Functions that
+          # share a line with one already subtracted are not subsets anymore.
+          if function_lines != lines and _is_subset(function_lines, lines):
+            lines = _subtract(lines, function_lines)
 
         # If this statement is inside the range of another statement, remove
         # this inner range from that outer one.  This is important because loops
-        # and conditional statements contain their inner branches.
-        for older_key, older_lines in statement_to_lines.items():
-          # Check for a proper subset (lines contains all elements of
-          # child_lines, but child_lines is not an equal set).
-          if lines < older_lines:  # strict subset
-            statement_to_lines[older_key] -= lines  # set subtraction
+        # and conditional statements contain their inner branches.  Only
+        # earlier statements whose original span covers all of these lines can
+        # contain them.
+        if lines:
+          first_line = lines[0][0]
+          last_line = lines[-1][1]
+          for _, older_end, older_key in statement_tree.containing(first_line):
+            if older_end < last_line or order[older_key] >= order[key]:
+              continue
+            older_lines = statement_to_lines[older_key]
+            # Check for a proper subset.
+            if lines != older_lines and _is_subset(lines, older_lines):
+              statement_to_lines[older_key] = _subtract(older_lines, lines)
 
         statement_to_lines[key] = lines
 
       # Whatever is left in any statement, we count as instrumented.
+      instrumented_lines = LineSet()
       for key, lines in statement_to_lines.items():
-        for line in lines:
-          instrumented_lines.add(line)
+        instrumented_lines |= LineSet.from_intervals(lines)
 
       # The "s" field is a map from statement numbers to number of times
       # executed.
-      executed_lines = set()
+      executed_lines = LineSet()
       for key, executed in path_data["s"].items():
         if executed:
-          for line in statement_to_lines[key]:
-            executed_lines.add(line)
+          executed_lines |= LineSet.from_intervals(statement_to_lines[key])
 
       self.files[path] = {
         "instrumented": instrumented_lines,
         "executed": executed_lines,
       }
+
+  @classmethod
+  def from_index(cls, index):
+    """Restore CoverageDetails from the output of to_index()."""
+    obj = cls.__new__(cls)
+    obj.files = {
+      path: {
+        "instrumented": LineSet.decode(data["instrumented"]),
+        "executed": LineSet.decode(data["executed"]),
+      } for path, data in index.items()
+    }
+    return obj
+
+  def to_index(self):
+    """Returns the line sets of every file in a compact, JSON-ready form."""
+    return {
+      path: {
+        "instrumented": data["instrumented"].encode(),
+        "executed": data["executed"].encode(),
+      } for path, data in self.files.items()
+    }
+
+  @staticmethod
+  def load(run, wanted_paths=None):
+    """Load the coverage details of a workflow run, or return None.
+
+    If the run's coverage index is cached, it is used instead of the artifact.
+    Otherwise, the artifact is parsed, and if gh.store_coverage_index is set,
+    the index of every file is cached for next time.  Else, only wanted_paths
+    are parsed.
+    """
+    key = "coverage-index:{}".format(run.run_id)
+    index = gh.disk_cache.get(key)
+    if index is not None:
+      return CoverageDetails.from_index(index)
+
+    file_data = run.fetch_artifact("coverage", "coverage-details.json")
+    if file_data is None:
+      return None
+
+    if not gh.store_coverage_index:
+      return parsepool.run(CoverageDetails, file_data, wanted_paths)
+
+    details = parsepool.run(CoverageDetails, file_data)
+    # This will be stored as a JSON object.
+    gh.disk_cache.store(key, details.to_index(),
+                        ttl_minutes=gh.LONG_TTL_MINUTES)
+    return details
@@ -5,6 +5,7 @@
 import json
 
 from . import gh
+from . import parsepool
 
 
 class CoverageSummary(object):
@@ -38,26 +39,28 @@ class CoverageSummary(object):
       "line_coverage": self.line_coverage,
     }
 
+  @staticmethod
+  def _load(run):
+    key = "coverage-summary:{}".format(run.run_id)
+    cached_line_coverage = gh.disk_cache.get(key)
+    if cached_line_coverage is not None:
+      return CoverageSummary.from_cache(
+          run.start_time, run.event, cached_line_coverage)
+
+    file_data = run.fetch_artifact("coverage", "coverage.json")
+    if file_data is None:
+      return None
+    summary = parsepool.run(
+        CoverageSummary, run.start_time, run.event, file_data)
+    # This will be stored as a JSON number.
+    gh.disk_cache.store(key, summary.line_coverage,
+                        ttl_minutes=gh.LONG_TTL_MINUTES)
+    return summary
+
   @staticmethod
   def get_all(coverage_runs):
-    results = []
-
-    for run in coverage_runs:
-      key = "coverage-summary:{}".format(run.run_id)
-      cached_line_coverage = gh.disk_cache.get(key)
-      if cached_line_coverage is not None:
-        summary = CoverageSummary.from_cache(
-            run.start_time, run.event, cached_line_coverage)
-        results.append(summary)
-        continue
-
-      file_data = run.fetch_artifact("coverage", "coverage.json")
-      if file_data is None:
-        continue
-      summary = CoverageSummary(run.start_time, run.event, file_data)
-      # This will be stored as a JSON number.
-      gh.disk_cache.store(key, summary.line_coverage,
-                          ttl_minutes=gh.LONG_TTL_MINUTES)
-      results.append(summary)
+    # Artifacts for each run are independent, so fetch them concurrently.
+    results = gh.map_concurrent(CoverageSummary._load, coverage_runs)
+    results = [summary for summary in results if summary is not None]
 
     return sorted(results, key=lambda r: r.start_time)
@@ -3,40 +3,295 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import base64
+import collections
+import contextlib
+import gzip
 import hashlib
+import io
 import json
 import os
+import re
+import tempfile
+import threading
 import time
 import sys
 
+from . import stats
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import fcntl
+except ImportError:
+  # No locking between processes on Windows.
+  fcntl = None
+
+
+# Expired entries that can be revalidated with a conditional request are kept
+# this long past their expiry, so that a daily job can still revalidate them.
+REVALIDATION_GRACE_MINUTES = 10_080  # 7 days
+
+# Temporary files older than this were left behind by a process that died
+# mid-write, and are removed when pruning.
+STALE_TEMP_FILE_SECONDS = 3600
+
+
+# An entry as stored, whether or not it has expired.  validators holds the
+# "etag" and/or "last-modified" response headers, if any.
+CacheEntry = collections.namedtuple(
+    "CacheEntry", ["data", "expires_at", "validators"])
+
+
+def is_live(entry, now, stale_minutes=0):
+  """True if pruning would keep entry: unexpired, or still revalidatable.
+
+  Entries are also kept for stale_minutes past their expiry, so that they can
+  be served stale.
+  """
+  grace_minutes = stale_minutes
+  if entry.validators:
+    grace_minutes = max(grace_minutes, REVALIDATION_GRACE_MINUTES)
+  return entry.expires_at + grace_minutes * 60 >= now
+
+
+def encode_data(data):
+  """Returns (kind, body) to store data as "text", "bytes", or "json"."""
+  if type(data) is str:
+    return "text", data.encode("utf8")
+  elif type(data) is bytes:
+    return "bytes", data
+  else:
+    return "json", json.dumps(data).encode("utf8")
+
+
+def decode_data(kind, body):
+  """The inverse of encode_data."""
+  if kind == "text":
+    return bytes(body).decode("utf8")
+  elif kind == "bytes":
+    return bytes(body)
+  else:
+    return json.loads(body)
+
+
+# Derived results that can't be recomputed once the artifacts they came from
+# expire on GitHub.  These are never evicted to make room for other entries.
+PINNED_PREFIXES = [
+  "incremental-coverage:", "coverage-summary:", "coverage-index:",
+]
+
+# Kinds of entries that can be given their own size quota.
+NAMESPACES = ["api", "artifacts", "derived"]
+
+
+def namespace_for_key(key):
+  """Classifies a cache key as "api", "artifacts", or "derived"."""
+  if re.search(r'/artifacts/\d+/zip$|/logs$', key):
+    return "artifacts"
+  if (key.startswith("/") or key.startswith("https://") or
+      key.startswith("graphql:") or key.startswith("incremental:")):
+    return "api"
+  return "derived"
+
+
+def is_pinned(key):
+  return any(key.startswith(prefix) for prefix in PINNED_PREFIXES)
+
+
+# What eviction needs to know about an entry.  id is whatever the cache
+# needs to delete it.
+EvictionCandidate = collections.namedtuple(
+    "EvictionCandidate", ["id", "size", "last_access", "namespace", "pinned"])
+
+
+def select_evictions(candidates, max_bytes=None, quotas=None):
+  """Chooses the least recently used entries to evict to fit size budgets.
+
+  quotas maps namespaces to byte budgets, and max_bytes is a budget for
+  everything.  Pinned entries count against budgets, but are never evicted.
+  Returns a set of ids to evict.
+  """
+  evicted = set()
+
+  def fit(entries, budget):
+    # Keep the most recently used entries, up to the budget.
+    total = sum(c.size for c in entries if c.pinned)
+    by_recency = sorted(entries, key=lambda c: c.last_access, reverse=True)
+    for candidate in by_recency:
+      if candidate.pinned:
+        continue
+      total += candidate.size
+      if total > budget:
+        evicted.add(candidate.id)
+
+  for namespace, budget in (quotas or {}).items():
+    fit([c for c in candidates if c.namespace == namespace], budget)
+
+  if max_bytes is not None:
+    fit([c for c in candidates if c.id not in evicted], max_bytes)
+
+  return evicted
+
+
+# Supported values for the compression of JSON and text entries.
+COMPRESSIONS = [None, "gzip", "zstd"]
+
+
+def _compress(compression, body):
+  if compression == "gzip":
+    return gzip.compress(body, compresslevel=6)
+  elif compression == "zstd":
+    return zstandard.ZstdCompressor().compress(body)
+  return body
+
+
+def _decompress(compression, body):
+  if compression == "gzip":
+    return gzip.decompress(body)
+  elif compression == "zstd":
+    return zstandard.ZstdDecompressor().decompress(body)
+  return body
+
+
 class DiskCache(object):
-  """Cache some arbitrary data on disk."""
+  """Cache some arbitrary data on disk.
+
+  Each entry is a JSON file named for the SHA-256 of its key.  Binary data is
+  kept raw in a ".body" file next to it, as are JSON and text data if
+  compression is enabled.
+
+  Safe to use from multiple threads and processes.  Files are written to a
+  temporary name and renamed into place, so a reader never sees a partial
+  write.  A lock file shared by all processes keeps an entry's metadata and
+  body consistent, and keeps pruning from deleting files out from under
+  active readers.
+  """
+
+  LOCK_FILENAME = ".lock"
+
+  def __init__(self, cache_folder, compression=None, max_bytes=None,
+               quotas=None, stale_minutes=0):
+    """Open the cache, and prune expired entries.
+
+    Expired entries are kept for stale_minutes, so they can be served stale.
+    If max_bytes or quotas (a map of namespace to bytes) are given, the least
+    recently used entries are then evicted to fit.
+    """
+    if compression not in COMPRESSIONS:
+      raise ValueError("Unknown cache compression: {}".format(compression))
+    if compression == "zstd" and zstandard is None:
+      raise ValueError("zstd cache compression requires the zstandard module")
 
-  def __init__(self, cache_folder):
     self.cache_folder = cache_folder
+    self.compression = compression
+    self.max_bytes = max_bytes
+    self.quotas = quotas
+    self.stale_minutes = stale_minutes
+    self._lock = threading.RLock()
+    self._lock_depth = 0
     os.makedirs(self.cache_folder, mode=0o755, exist_ok=True)
+    self._lock_file = open(
+        os.path.join(self.cache_folder, self.LOCK_FILENAME), "a")
     self._prune_cache()
 
+  @contextlib.contextmanager
+  def _locked(self, exclusive=False, blocking=True):
+    """Holds the thread lock, and the lock file shared with other processes.
+
+    Readers share the lock file, and writers hold it exclusively.  If not
+    blocking and another process holds it, yields False.
+    """
+    with self._lock:
+      self._lock_depth += 1
+      try:
+        acquired = True
+        # Nested calls in the same thread already hold the lock file.
+        if self._lock_depth == 1 and fcntl is not None:
+          mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+          if not blocking:
+            mode |= fcntl.LOCK_NB
+          try:
+            fcntl.flock(self._lock_file, mode)
+          except BlockingIOError:
+            acquired = False
+
+        try:
+          yield acquired
+        finally:
+          if self._lock_depth == 1 and fcntl is not None and acquired:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+      finally:
+        self._lock_depth -= 1
+
   def _prune_cache(self):
     now = time.time()
-    for name in os.listdir(self.cache_folder):
-      if not name.endswith(".json"):
-        continue
-      path = os.path.join(self.cache_folder, name)
-      self._prune_file_if_expired(path, now)
+    # If another process is using the cache, leave the pruning to it, rather
+    # than waiting for it to finish.
+    with self._locked(exclusive=True, blocking=False) as acquired:
+      if not acquired:
+        return
+
+      names = os.listdir(self.cache_folder)
+      candidates = []
+      for name in names:
+        if not name.endswith(".json"):
+          continue
+        path = os.path.join(self.cache_folder, name)
+        candidate = self._prune_file_if_expired(path, now)
+        if candidate is not None:
+          candidates.append(candidate)
+
+      # Remove any body left behind by an entry that is gone.
+      for name in names:
+        if not name.endswith(".body"):
+          continue
+        path = os.path.join(self.cache_folder, name)
+        if not os.path.exists(self._metadata_path(path)):
+          self._delete_corrupt_file(path)
+
+      for name in names:
+        if not name.endswith(".tmp"):
+          continue
+        path = os.path.join(self.cache_folder, name)
+        try:
+          if os.path.getmtime(path) < now - STALE_TEMP_FILE_SECONDS:
+            self._delete_corrupt_file(path)
+        except OSError:
+          pass
+
+      if self.max_bytes is not None or self.quotas:
+        for path in select_evictions(candidates, self.max_bytes, self.quotas):
+          self._delete_files(path)
 
   def _prune_file_if_expired(self, path, now):
+    """Deletes an expired entry, or returns an EvictionCandidate for it."""
     try:
       with open(path, "r") as f:
         data = json.load(f)
+        stat = os.fstat(f.fileno())
+
+      entry = CacheEntry(None, data.get("expires_at", 0),
+                         data.get("validators"))
+      if not is_live(entry, now, self.stale_minutes):
+        self._delete_files(path)
+        return None
 
-      expires_at = data.get("expires_at", 0)
-      if expires_at < now:
-        os.unlink(path)
+      size = stat.st_size
+      if "body" in data:
+        size += os.path.getsize(self._body_path(path))
+
+      # Reads touch the file, so its mtime is the last time it was used.
+      key = data.get("key", "")
+      return EvictionCandidate(path, size, stat.st_mtime,
+                               namespace_for_key(key), is_pinned(key))
     except Exception as e:
       print("Exception pruning cache file {}: {}".format(path, e),
             file=sys.stderr)
-      self._delete_corrupt_file(path)
+      self._delete_files(path)
+      return None
 
   def _delete_corrupt_file(self, path):
     try:
@@ -44,56 +299,366 @@ class DiskCache(object):
     except:
       pass
 
+  def _delete_files(self, path):
+    self._delete_corrupt_file(path)
+    self._delete_corrupt_file(self._body_path(path))
+
   def _path_for_key(self, key):
     sha = hashlib.sha256(key.encode("utf8")).hexdigest()
     return os.path.join(self.cache_folder, sha + ".json")
 
+  def _body_path(self, path):
+    return path[:-len(".json")] + ".body"
+
+  def _metadata_path(self, body_path):
+    return body_path[:-len(".body")] + ".json"
+
   def get(self, key):
     """Returns data if it exists and is valid, or None."""
+    entry = self.get_entry(key)
+    if entry is None or time.time() >= entry.expires_at:
+      return None
+    return entry.data
+
+  def get_entry(self, key):
+    """Returns a CacheEntry if it exists, even if expired, or None."""
+    return self.get_sized_entry(key)[0]
+
+  def get_sized_entry(self, key):
+    """Returns (CacheEntry, bytes stored) if it exists, or (None, 0)."""
+    path = self._path_for_key(key)
+    with self._locked():
+      stored, size = self._load_sized(key)
+      if stored is None:
+        return None, 0
+
+      entry, body_size = self._sized_entry_from_stored(stored, path)
+      self._touch(path)
+      return entry, size + body_size
+
+  def open(self, key):
+    """Returns a binary file for valid bytes data, or None.
+
+    Large binary data, such as a zip file, can be read from the file as
+    needed, instead of being loaded into memory all at once.
+    """
+    path = self._path_for_key(key)
+    with self._locked():
+      stored = self._load(key)
+      if stored is None or time.time() >= stored.get("expires_at", 0):
+        return None
+
+      body = stored.get("body")
+      if body is None or body["kind"] != "bytes" or body.get("compression"):
+        entry = self._entry_from_stored(stored, path)
+        if type(entry.data) is not bytes:
+          return None
+        return io.BytesIO(entry.data)
+
+      try:
+        f = open(self._body_path(path), "rb")
+      except FileNotFoundError:
+        return None
+
+      self._touch(path)
+      return f
+
+  def _touch(self, path):
+    # Record the access time for LRU eviction.  Metadata files are small, so
+    # their mtime is used instead of relying on atime, which is often off.
+    try:
+      os.utime(path)
+    except OSError:
+      pass
+
+  def access_time(self, key):
+    """Returns when an entry was last used, or None if it doesn't exist."""
+    try:
+      return os.path.getmtime(self._path_for_key(key))
+    except OSError:
+      return None
+
+  def entries(self):
+    """Yields (key, CacheEntry) for everything stored, even if expired."""
+    for name in os.listdir(self.cache_folder):
+      if not name.endswith(".json"):
+        continue
+
+      path = os.path.join(self.cache_folder, name)
+      try:
+        with self._locked():
+          with open(path, "r") as f:
+            stored = json.load(f)
+          entry = self._entry_from_stored(stored, path)
+      except Exception:
+        # Deleted or being replaced.  Skip it.
+        continue
+
+      if "key" in stored:
+        yield stored["key"], entry
+
+  def _entry_from_stored(self, stored, path):
+    return self._sized_entry_from_stored(stored, path)[0]
+
+  def _sized_entry_from_stored(self, stored, path):
+    """Returns the CacheEntry and the size of its body file, if any."""
+    body_size = 0
+    if "json" in stored:
+      data = stored["json"]
+    elif "text" in stored:
+      data = stored["text"]
+    elif "bytes" in stored:
+      data = base64.b64decode(stored["bytes"])
+    else:
+      body = stored["body"]
+      with open(self._body_path(path), "rb") as f:
+        data = f.read()
+      body_size = len(data)
+      stats.record_cache_bytes(read=body_size)
+      data = _decompress(body.get("compression"), data)
+      if body["kind"] == "json":
+        data = json.loads(data)
+      elif body["kind"] == "text":
+        data = data.decode("utf8")
+
+    entry = CacheEntry(data, stored.get("expires_at", 0),
+                       stored.get("validators", {}))
+    return entry, body_size
+
+  def _load(self, key):
+    return self._load_sized(key)[0]
+
+  def _load_sized(self, key):
+    """Returns the stored metadata and its size, or (None, 0)."""
     path = self._path_for_key(key)
     try:
       with open(path, "r") as f:
         stored = json.load(f)
+        size = f.tell()
+        stats.record_cache_bytes(read=size)
 
       if stored.get("key") != key:
-        return None
+        return None, 0
 
-      expires_at = stored.get("expires_at", 0)
-      if time.time() >= expires_at:
-        return None
-
-      if "json" in stored:
-        return stored["json"]
-      elif "text" in stored:
-        return stored["text"]
-      else:
-        return base64.b64decode(stored["bytes"])
+      return stored, size
     except FileNotFoundError:
-      return None
+      return None, 0
     except Exception as e:
       print("Exception loading cache file {}: {}".format(path, e),
             file=sys.stderr)
-      self._delete_corrupt_file(path)
-      return None
+      self._delete_files(path)
+      return None, 0
+
+  def store(self, key, data, ttl_minutes, validators=None):
+    """Stores data in the cache, and returns the number of bytes stored.
+
+    If given, validators holds the "etag" and/or "last-modified" response
+    headers, used to revalidate the entry once it expires.
+    """
+    stored = {
+      "time": time.time(),
+      "expires_at": time.time() + ttl_minutes * 60,
+      "key": key,
+    }
+    if validators:
+      stored["validators"] = validators
+
+    body = None
+    if type(data) is bytes:
+      # Binary data is usually a zip file, which is already compressed.
+      stored["body"] = {"kind": "bytes"}
+      body = data
+    elif self.compression is None:
+      if type(data) is str:
+        stored["text"] = data
+      else:
+        stored["json"] = data
+    else:
+      if type(data) is str:
+        stored["body"] = {"kind": "text"}
+        body = data.encode("utf8")
+      else:
+        stored["body"] = {"kind": "json"}
+        body = json.dumps(data).encode("utf8")
+      stored["body"]["compression"] = self.compression
+      body = _compress(self.compression, body)
+
+    with self._locked(exclusive=True):
+      return self._write(key, stored, body)
+
+  def refresh(self, key, ttl_minutes):
+    """Extends the life of an existing entry, which may have expired."""
+    with self._locked(exclusive=True):
+      stored = self._load(key)
+      if stored is None:
+        return
+
+      stored["time"] = time.time()
+      stored["expires_at"] = time.time() + ttl_minutes * 60
+      self._write_metadata(self._path_for_key(key), stored)
 
-  def store(self, key, data, ttl_minutes):
-    """Stores data in the cache."""
+  def delete(self, key):
+    """Removes an entry, if it exists."""
+    with self._locked(exclusive=True):
+      self._delete_files(self._path_for_key(key))
+
+  def _write(self, key, stored, body):
+    """Writes an entry, and returns the number of bytes written."""
     path = self._path_for_key(key)
+    body_path = self._body_path(path)
     try:
-      with open(path, "w") as f:
-        stored = {
-          "time": time.time(),
-          "expires_at": time.time() + ttl_minutes * 60,
-          "key": key,
-        }
-        if type(data) is str:
-          stored["text"] = data
-        elif type(data) is bytes:
-          stored["bytes"] = base64.b64encode(data).decode("utf8")
-        else:
-          stored["json"] = data
-        json.dump(stored, f)
+      if body is None:
+        self._delete_corrupt_file(body_path)
+      else:
+        self._write_atomically(body_path, body)
+    except Exception as e:
+      print("Exception storing cache file {}: {}".format(body_path, e),
+            file=sys.stderr)
+      self._delete_files(path)
+      return 0
+
+    return len(body or b"") + self._write_metadata(path, stored)
+
+  def _write_metadata(self, path, stored):
+    content = json.dumps(stored).encode("utf8")
+    try:
+      self._write_atomically(path, content)
     except Exception as e:
       print("Exception storing cache file {}: {}".format(path, e),
             file=sys.stderr)
-      self._delete_corrupt_file(path)
+      self._delete_files(path)
+      return 0
+    return len(content)
+
+  def _write_atomically(self, path, content):
+    # A temporary file in the same folder can be renamed over the original
+    # atomically.  The ".tmp" suffix keeps pruning from mistaking it for an
+    # entry.
+    fd, temp_path = tempfile.mkstemp(dir=self.cache_folder, suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.write(content)
+      stats.record_cache_bytes(written=len(content))
+      # mkstemp makes files only readable by the owner.
+      os.chmod(temp_path, 0o644)
+      os.replace(temp_path, path)
+    except:
+      self._delete_corrupt_file(temp_path)
+      raise
+
+
+class MemoryCache(object):
+  """An in-memory LRU tier in front of a DiskCache or SqliteCache.
+
+  Writes go through to the backing cache.  Repeated reads of the same key are
+  served from memory, without touching the filesystem.  Cached data is
+  shared, so callers must not modify it.
+
+  Bounded by entry count and by bytes, as measured by the size of the data as
+  stored in the backing cache.  Binary data, such as artifact zips, is never
+  kept in memory.
+  """
+
+  MAX_ENTRIES = 4096
+  MAX_BYTES = 256 << 20  # 256 MB
+
+  def __init__(self, backing, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+    self.backing = backing
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    # Maps keys to (CacheEntry, size), least recently used first.
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+
+  def __getattr__(self, name):
+    # Anything else, such as cache_folder, belongs to the backing cache.
+    if name == "backing":
+      raise AttributeError(name)
+    return getattr(self.backing, name)
+
+  def _lookup(self, key):
+    with self._lock:
+      item = self._entries.get(key)
+      if item is None:
+        self.misses += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return item[0]
+
+  def _remember(self, key, entry, size):
+    if type(entry.data) is bytes:
+      return
+
+    with self._lock:
+      self._forget(key)
+      if size > self.max_bytes:
+        return
+
+      self._entries[key] = (entry, size)
+      self._bytes += size
+      while (len(self._entries) > self.max_entries or
+             self._bytes > self.max_bytes):
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self._bytes -= evicted_size
+
+  def _forget(self, key):
+    # Must be called with the lock held.
+    item = self._entries.pop(key, None)
+    if item is not None:
+      self._bytes -= item[1]
+
+  def get(self, key):
+    """Returns data if it exists and is valid, or None."""
+    entry = self.get_entry(key)
+    if entry is None or time.time() >= entry.expires_at:
+      stats.record_cache(namespace_for_key(key), "miss")
+      return None
+    stats.record_cache(namespace_for_key(key), "hit")
+    return entry.data
+
+  def get_entry(self, key):
+    """Returns a CacheEntry if it exists, even if expired, or None."""
+    entry = self._lookup(key)
+    if entry is not None:
+      return entry
+
+    entry, size = self.backing.get_sized_entry(key)
+    if entry is not None:
+      self._remember(key, entry, size)
+    return entry
+
+  def open(self, key):
+    """Returns a binary file for valid bytes data, or None."""
+    # Binary data is never in memory.  It is streamed from the backing cache.
+    return self.backing.open(key)
+
+  def entries(self):
+    """Yields (key, CacheEntry) for everything stored, even if expired."""
+    return self.backing.entries()
+
+  def store(self, key, data, ttl_minutes, validators=None):
+    """Stores data in the cache.  See DiskCache.store."""
+    size = self.backing.store(key, data, ttl_minutes, validators)
+    entry = CacheEntry(data, time.time() + ttl_minutes * 60, validators or {})
+    self._remember(key, entry, size)
+
+  def refresh(self, key, ttl_minutes):
+    """Extends the life of an existing entry, which may have expired."""
+    self.backing.refresh(key, ttl_minutes)
+    with self._lock:
+      item = self._entries.get(key)
+      if item is not None:
+        entry, size = item
+        expires_at = time.time() + ttl_minutes * 60
+        self._entries[key] = (entry._replace(expires_at=expires_at), size)
+
+  def delete(self, key):
+    """Removes an entry, if it exists."""
+    self.backing.delete(key)
+    with self._lock:
+      self._forget(key)
@@ -2,41 +2,162 @@
 # Copyright 2023 Google LLC
 # SPDX-License-Identifier: Apache-2.0
 
+import collections
+import io
 import json
+import os
 import re
 import sys
+import threading
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests as requests_lib
 
-from . import shell
-from .diskcache import DiskCache
+from . import rangefile
+from . import stats
+from . import transport
+from .cachebundle import BundledCache, CacheBundle
+from .diskcache import CacheEntry, DiskCache, MemoryCache, namespace_for_key
 from .ratelimit import RateLimit
+from .sqlitecache import SqliteCache
 
 
 SHORT_TTL_MINUTES = 120  # 2 hours
 LONG_TTL_MINUTES = 144_000  # 100 days
 
+# How many times to retry a call that was refused by a rate limit.
+MAX_RATE_LIMIT_RETRIES = 3
+
+# In stale-while-revalidate mode, how long past its expiry an entry can still
+# be served while a refresh is queued.
+MAX_STALE_MINUTES = 360  # 6 hours
+
 rate_limiter = None
 disk_cache = None
 debug_api = False
+api_transport = None
+concurrency = 1
+# Whether to cache artifact and log zips, which can be large.
+cache_artifacts = False
+# Whether to cache a compact index of each run's coverage details, so that
+# coverage can be recomputed without the artifact.
+store_coverage_index = False
+# Whether to read single files out of artifact zips with HTTP Range requests,
+# instead of downloading whole zips.
+ranged_artifacts = False
+# Items per page for listings.  GitHub allows up to 100.
+page_size = 100
+# Bounds the number of API calls in flight at once, across all threads.
+_in_flight = threading.BoundedSemaphore(1)
+# Whether to serve recently expired entries, and refresh them later.
+stale_while_revalidate = False
+# Maps keys served stale to functions that refetch them.
+_stale_refreshes = collections.OrderedDict()
+_stale_lock = threading.Lock()
+
+
+def _get_transport():
+  global api_transport
+
+  if api_transport is None:
+    api_transport = transport.create_transport("gh")
+  return api_transport
+
+
+def configure_transport(backend, max_concurrency=1):
+  """Choose how API calls are made: "http", "gh", or "auto"."""
+  global api_transport
+
+  pool_size = max(transport.POOL_SIZE, max_concurrency)
+  api_transport = transport.create_transport(backend, pool_size)
 
 
 def get_rate_limit_remaining():
   """Query actual remaining GitHub API quota. Does not consume quota."""
-  raw = shell.run_command(["gh", "api", "/rate_limit"], text=True)
+  raw = _get_transport().get("/rate_limit", text=True).content
   data = json.loads(raw)
   core = data["resources"]["core"]
   return core["remaining"], core["reset"]
 
 
-def configure(burst_limit, rate_limit_per_hour, cache_folder, debug):
+def open_cache(cache_folder, cache_backend="files", compression=None,
+               max_bytes=None, quotas=None, bundle_path=None,
+               stale_minutes=0):
+  """Open the cache in cache_folder, as one file per entry or as SQLite.
+
+  max_bytes and quotas (a map of namespace to bytes) bound the size of the
+  cache.  The least recently used entries are evicted when it is opened.
+  Expired entries are kept for stale_minutes, so they can be served stale.
+  If bundle_path is given, entries are also read from that bundle file, as
+  written by "main.py pack-cache".  Either way, the cache is fronted by an
+  in-memory tier.
+  """
+  if cache_backend == "sqlite":
+    cache = SqliteCache(os.path.join(cache_folder, SqliteCache.FILENAME),
+                        max_bytes, quotas, stale_minutes)
+  else:
+    cache = DiskCache(cache_folder, compression, max_bytes, quotas,
+                      stale_minutes)
+
+  if bundle_path is not None:
+    cache = BundledCache(
+        cache, CacheBundle(bundle_path),
+        os.path.join(cache_folder, BundledCache.ACCESS_LOG_FILENAME))
+
+  # Many of the same entries are read several times per run, for example when
+  # two measurements use the same workflow.
+  return MemoryCache(cache)
+
+
+def configure(burst_limit, rate_limit_per_hour, cache_folder, debug,
+              max_concurrency=1, quota_reserve=0, cache_backend="files",
+              cache_compression=None, artifact_caching=False,
+              cache_max_bytes=None, cache_quotas=None, cache_bundle=None,
+              serve_stale=False, coverage_index=False, ranged_downloads=False,
+              listing_page_size=100):
   global rate_limiter
   global disk_cache
   global debug_api
-
-  rate_limiter = RateLimit(burst_limit, rate_limit_per_hour)
-  disk_cache = DiskCache(cache_folder)
+  global concurrency
+  global _in_flight
+  global cache_artifacts
+  global stale_while_revalidate
+  global store_coverage_index
+  global ranged_artifacts
+  global page_size
+
+  rate_limiter = RateLimit(burst_limit, rate_limit_per_hour, quota_reserve)
+  disk_cache = open_cache(cache_folder, cache_backend, cache_compression,
+                          cache_max_bytes, cache_quotas, cache_bundle,
+                          MAX_STALE_MINUTES if serve_stale else 0)
   debug_api = debug
+  cache_artifacts = artifact_caching
+  stale_while_revalidate = serve_stale
+  store_coverage_index = coverage_index
+  ranged_artifacts = ranged_downloads
+  page_size = listing_page_size
+  _stale_refreshes.clear()
+  concurrency = max(1, max_concurrency)
+  _in_flight = threading.BoundedSemaphore(concurrency)
+
+
+def map_concurrent(callback, items):
+  """Like map(), but runs callback on up to `concurrency` items at once.
+
+  Returns a list of results in the same order as items.  Exceptions raised by
+  callback are raised here.
+  """
+  items = list(items)
+  if concurrency <= 1 or len(items) <= 1:
+    return [callback(item) for item in items]
+
+  # A fresh pool per call, so that nested calls (pages within objects) can't
+  # deadlock waiting on each other.  _in_flight bounds the actual API calls.
+  with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as pool:
+    return list(pool.map(callback, items))
 
 
 def http_head(url):
@@ -56,48 +177,304 @@ def _is_url_immutable(url):
   return re.search(r'/commits/[0-9a-f]{40}', url)
 
 
+def _ttl_minutes(url_or_full_path, data, is_immutable_cb):
+  is_immutable = _is_url_immutable(url_or_full_path)
+  if is_immutable_cb is not None:
+    is_immutable = is_immutable_cb(data)
+
+  return LONG_TTL_MINUTES if is_immutable else SHORT_TTL_MINUTES
+
+
+def _conditional_headers(entry):
+  """Request headers to revalidate an expired cache entry, if possible."""
+  headers = {}
+  if entry is None:
+    return headers
+
+  if "etag" in entry.validators:
+    headers["If-None-Match"] = entry.validators["etag"]
+  if "last-modified" in entry.validators:
+    headers["If-Modified-Since"] = entry.validators["last-modified"]
+  return headers
+
+
+def _call(request, endpoint):
+  """Make a rate-limited API call, and feed the response to the limiter.
+
+  The call is counted in the stats for endpoint.
+
+  Retries calls that are refused by a rate limit, once the limiter says so.
+  """
+  retries = 0
+  while True:
+    with _in_flight:
+      rate_limiter.wait()
+      start = time.time()
+      try:
+        response = request()
+      except transport.RateLimitedError as e:
+        stats.record_call(endpoint, time.time() - start)
+        rate_limiter.update(e.headers, limited=True)
+        if retries == MAX_RATE_LIMIT_RETRIES:
+          raise
+        retries += 1
+        continue
+
+    num_bytes = len(response.content) if response.content else 0
+    stats.record_call(endpoint, time.time() - start, num_bytes)
+    rate_limiter.update(response.headers)
+    return response
+
+
+def _can_serve_stale(entry, now):
+  return (stale_while_revalidate and
+          now < entry.expires_at + MAX_STALE_MINUTES * 60)
+
+
+def _queue_refresh(key, fetch):
+  # Only the first request for each key is kept.
+  with _stale_lock:
+    _stale_refreshes.setdefault(key, fetch)
+
+
+def refresh_stale():
+  """Refetch the entries that were served stale.  Returns the number refreshed.
+
+  Failures are reported, but don't stop the other refreshes.
+  """
+  with _stale_lock:
+    refreshes = list(_stale_refreshes.items())
+    _stale_refreshes.clear()
+
+  def refresh(item):
+    key, fetch = item
+    try:
+      fetch()
+      return True
+    except Exception as e:
+      print("Failed to refresh stale cache entry {}: {}".format(key, e),
+            file=sys.stderr)
+      return False
+
+  return sum(map_concurrent(refresh, refreshes))
+
+
 def _api_base(url_or_full_path, is_json, is_immutable_cb, cache):
-  global rate_limiter
   global disk_cache
   global debug_api
 
+  entry = None
   if cache:
-    data = disk_cache.get(url_or_full_path)
+    entry = disk_cache.get_entry(url_or_full_path)
+    now = time.time()
 
-    if debug_api:
-      if data is None:
-        print("CACHE MISS: {}".format(url_or_full_path), file=sys.stderr)
-      else:
+    namespace = namespace_for_key(url_or_full_path)
+
+    if entry is not None and now < entry.expires_at:
+      stats.record_cache(namespace, "hit")
+      if debug_api:
         print("CACHE HIT: {}".format(url_or_full_path), file=sys.stderr)
+      return entry.data
+
+    if entry is not None and _can_serve_stale(entry, now):
+      stats.record_cache(namespace, "stale")
+      if debug_api:
+        print("CACHE STALE: {}".format(url_or_full_path), file=sys.stderr)
+      _queue_refresh(url_or_full_path, lambda: _fetch(
+          url_or_full_path, is_json, is_immutable_cb, True, entry))
+      return entry.data
 
-    if data is not None:
-      return data
+    stats.record_cache(namespace, "miss")
+    if debug_api:
+      if entry is not None and entry.validators:
+        print("CACHE REVALIDATE: {}".format(url_or_full_path),
+              file=sys.stderr)
+      else:
+        print("CACHE MISS: {}".format(url_or_full_path), file=sys.stderr)
   elif debug_api:
     print("CACHE SKIP: {}".format(url_or_full_path), file=sys.stderr)
 
-  rate_limiter.wait()
-  args = ["gh", "api", url_or_full_path]
-  data = shell.run_command(args, text=is_json)
+  return _fetch(url_or_full_path, is_json, is_immutable_cb, cache, entry)
+
+
+def _fetch(url_or_full_path, is_json, is_immutable_cb, cache, entry):
+  """Call the API, and cache the result if asked.
+
+  entry is the expired cache entry, if any, to revalidate.
+  """
+  # If an expired entry has an ETag or Last-Modified date, ask the server
+  # whether it has changed.  A 304 costs no quota and transfers no body.
+  headers = _conditional_headers(entry)
+
+  response = _call(lambda: _get_transport().get(
+      url_or_full_path, text=is_json, headers=headers),
+      stats.endpoint_for_url(url_or_full_path))
 
+  if response.status == 304:
+    ttl_minutes = _ttl_minutes(url_or_full_path, entry.data, is_immutable_cb)
+    disk_cache.refresh(url_or_full_path, ttl_minutes=ttl_minutes)
+    return entry.data
+
+  data = response.content
   if is_json:
     data = json.loads(data)
 
   if cache:
-    is_immutable = _is_url_immutable(url_or_full_path)
-    if is_immutable_cb is not None:
-      is_immutable = is_immutable_cb(data)
-
-    ttl_minutes = LONG_TTL_MINUTES if is_immutable else SHORT_TTL_MINUTES
+    ttl_minutes = _ttl_minutes(url_or_full_path, data, is_immutable_cb)
+    validators = {
+      name: response.headers[name]
+      for name in ["etag", "last-modified"] if name in response.headers
+    }
 
     # This will be stored as bytes or JSON depending on the type.
-    disk_cache.store(url_or_full_path, data, ttl_minutes=ttl_minutes)
+    disk_cache.store(url_or_full_path, data, ttl_minutes=ttl_minutes,
+                     validators=validators)
 
   return data
 
 
-def api_raw(url_or_path):
+def api_graphql(query, variables):
+  """Run a GraphQL query and return its "data".  Caches with short TTL."""
+  key = "graphql:" + json.dumps(
+      {"query": query, "variables": variables}, sort_keys=True)
+
+  entry = disk_cache.get_entry(key)
+  now = time.time()
+  if entry is not None and now < entry.expires_at:
+    status = "HIT"
+  elif entry is not None and _can_serve_stale(entry, now):
+    status = "STALE"
+    _queue_refresh(key, lambda: _fetch_graphql(key, query, variables))
+  else:
+    status = "MISS"
+
+  stats.record_cache("api", status.lower())
+  if debug_api:
+    print("CACHE {}: graphql {}".format(status, variables), file=sys.stderr)
+  if status != "MISS":
+    return entry.data
+
+  return _fetch_graphql(key, query, variables)
+
+
+def _fetch_graphql(key, query, variables):
+  response = _call(lambda: _get_transport().graphql(query, variables),
+                   "graphql")
+
+  parsed = json.loads(response.content)
+  if parsed.get("errors"):
+    raise RuntimeError("GraphQL query failed:", variables, parsed["errors"])
+
+  data = parsed["data"]
+  # This will be stored as a JSON object.
+  disk_cache.store(key, data, ttl_minutes=SHORT_TTL_MINUTES)
+  return data
+
+
+def api_graphql_nodes(query, variables, connection):
+  """Page through a GraphQL connection and return all of its nodes.
+
+  The query must take a $cursor variable, pass it as "after" to the top-level
+  field named by connection, and select pageInfo { hasNextPage endCursor }.
+  """
+  variables = dict(variables, cursor=None)
+  results = []
+  while True:
+    page = api_graphql(query, variables)[connection]
+    results.extend(page["nodes"])
+
+    if not page["pageInfo"]["hasNextPage"]:
+      return results
+    variables["cursor"] = page["pageInfo"]["endCursor"]
+
+
+def api_raw(url_or_path, cache=False):
+  # Raw downloads are artifact and log zips, which never change once they
+  # exist, so they are cached with long TTL.
   return _api_base(url_or_path,
-      is_json=False, is_immutable_cb=None, cache=False)
+      is_json=False, is_immutable_cb=lambda data: True, cache=cache)
+
+
+def api_raw_file(url_or_path, cache=False):
+  """Like api_raw, but returns a binary file object.
+
+  Cached data is read from disk as needed, not loaded into memory.
+  """
+  if cache:
+    f = disk_cache.open(url_or_path)
+    if f is not None:
+      stats.record_cache(namespace_for_key(url_or_path), "hit")
+      if debug_api:
+        print("CACHE HIT: {}".format(url_or_path), file=sys.stderr)
+      return f
+
+  return io.BytesIO(api_raw(url_or_path, cache))
+
+
+def _resolve_blob(url_or_path):
+  """Returns the blob storage URL for a download, and a function to open it.
+
+  The function takes the URL and request headers, and returns a streaming
+  response.
+  """
+  response = _call(lambda: _get_transport().get_redirect(url_or_path),
+                   stats.endpoint_for_url(url_or_path))
+  url = response.headers.get("location")
+  if url is None:
+    raise RuntimeError("Expected a redirect:", url_or_path, response.status)
+
+  def open_stream(url, headers):
+    # Blob storage is not the GitHub API, so this is not rate-limited.
+    start = time.time()
+    response = _get_transport().open_stream(url, headers)
+    num_bytes = int(response.headers.get("content-length") or 0)
+    stats.record_call("blob", time.time() - start, num_bytes)
+    return response
+
+  return url, open_stream
+
+
+def _open_ranged(url_or_path):
+  """Returns a binary file for a zip, read from blob storage as needed."""
+  if debug_api:
+    print("RANGED: {}".format(url_or_path), file=sys.stderr)
+  url, open_stream = _resolve_blob(url_or_path)
+  return rangefile.open_url(open_stream, url)
+
+
+def api_raw_spooled(url_or_path, cache=False):
+  """Like api_raw_file, but the download is spooled to a temporary file.
+
+  Memory use stays bounded, however large the file is.  Data that must be
+  cached, and any download through the gh CLI transport, is still read into
+  memory, as api_raw_file does.
+  """
+  if cache or not hasattr(_get_transport(), "open_stream"):
+    return api_raw_file(url_or_path, cache)
+
+  if debug_api:
+    print("SPOOLED: {}".format(url_or_path), file=sys.stderr)
+  url, open_stream = _resolve_blob(url_or_path)
+  return rangefile.download(open_stream, url)
+
+
+def api_zip_member(url_or_path, filename, cache=False):
+  """Returns the contents of filename in the zip at url_or_path, or None.
+
+  With ranged_artifacts and the HTTP transport, only the zip's central
+  directory and that one file are downloaded, unless the zip must be cached.
+  """
+  if (ranged_artifacts and not cache and
+      hasattr(_get_transport(), "open_stream")):
+    zip_file = _open_ranged(url_or_path)
+  else:
+    zip_file = api_raw_file(url_or_path, cache)
+
+  with zip_file, zipfile.ZipFile(zip_file, 'r') as f:
+    try:
+      return f.read(filename)
+    except KeyError:
+      return None
 
 
 def api_single(url_or_path, is_immutable_cb=None):
@@ -106,14 +483,13 @@ def api_single(url_or_path, is_immutable_cb=None):
 
 
 def api_multiple(url_or_path, subkey=None, stop_predicate=None):
+  # The page size is part of each page's URL, and so of its cache key.
   if "?" in url_or_path:
-    url_or_path += "&page_size=100"
+    url_or_path += "&per_page={}".format(page_size)
   else:
-    url_or_path += "?page_size=100"
+    url_or_path += "?per_page={}".format(page_size)
 
-  page_number = 1
-  results = []
-  while True:
+  def fetch_page(page_number):
     next_page_url = url_or_path + "&page={}".format(page_number)
     next_page = _api_base(next_page_url,
         is_json=True, is_immutable_cb=None, cache=True)
@@ -122,12 +498,172 @@ def api_multiple(url_or_path, subkey=None, stop_predicate=None):
       next_page = next_page[subkey]
 
     assert type(next_page) is list
-    if len(next_page) == 0:
-      break
+    return next_page
 
-    results.extend(next_page)
-    if stop_predicate is not None and stop_predicate(results):
-      break
-    page_number += 1
-
-  return results
+  # The first page is fetched alone, since many listings fit in one page.
+  # After that, pages are fetched in batches of up to `concurrency`.  This can
+  # overshoot the end of the listing by a few empty pages, which are cached
+  # like any other page.
+  page_number = 1
+  batch_size = 1
+  results = []
+  while True:
+    page_numbers = range(page_number, page_number + batch_size)
+    for next_page in map_concurrent(fetch_page, page_numbers):
+      if len(next_page) == 0:
+        return results
+
+      results.extend(next_page)
+      if stop_predicate is not None and stop_predicate(results):
+        return results
+
+    page_number += batch_size
+    batch_size = concurrency
+
+
+def _pick_fields(item, fields):
+  """Returns a copy of item with only fields, which may be dotted paths."""
+  picked = {}
+  for field in fields:
+    source = item
+    target = picked
+    *parents, name = field.split(".")
+    for parent in parents:
+      source = source.get(parent) or {}
+      target = target.setdefault(parent, {})
+    if name in source:
+      target[name] = source[name]
+  return picked
+
+
+def api_incremental(url_or_path, subkey=None, time_field="updated_at",
+                    id_field="id", fields=None):
+  """Like api_multiple, but only fetches what changed since the last call.
+
+  The listing must be sorted by time_field, newest first, such as
+  "/pulls?state=closed&sort=updated&direction=desc".  The merged set of items
+  is cached by id.  Pages are fetched from the newest until one contains an
+  item that is already known and unchanged, since everything after that is
+  unchanged, too.  So the cost of a call tracks new activity, not the length
+  of the listing.
+
+  If fields is given, only those fields of each item are kept, as well as
+  id_field and time_field.  Nested fields are named like "head.sha".
+
+  NOTE: Items that leave the listing entirely (such as a closed PR that is
+  reopened) are not removed.
+  """
+  # The items are only rewritten when something changed.  When the listing
+  # was last checked, and its validators, are stored separately.
+  key = "incremental:" + url_or_path
+  checked_key = "incremental:checked:" + url_or_path
+  if "?" in url_or_path:
+    url_or_path += "&per_page={}".format(page_size)
+  else:
+    url_or_path += "?per_page={}".format(page_size)
+  if fields is not None:
+    fields = [id_field, time_field] + list(fields)
+
+  # Read the entries directly, so that this lookup is counted only once in
+  # the stats, below.
+  now = time.time()
+  items_entry = disk_cache.get_entry(key)
+  checked_entry = disk_cache.get_entry(checked_key)
+  # With nothing cached, or items cached in an older format, start over.
+  items = None
+  checked = {"checked_at": 0, "validators": {}}
+  if (items_entry is not None and now < items_entry.expires_at and
+      type(items_entry.data) is list and
+      checked_entry is not None and now < checked_entry.expires_at):
+    items = items_entry.data
+    checked = checked_entry.data
+
+  if (items is not None and
+      now < checked["checked_at"] + SHORT_TTL_MINUTES * 60):
+    stats.record_cache("api", "hit")
+    if debug_api:
+      print("CACHE HIT: {}".format(key), file=sys.stderr)
+    return items
+
+  stats.record_cache("api", "miss")
+  known = {}
+  validators = {}
+  if items is not None:
+    known = {item[id_field]: item for item in items}
+    validators = checked["validators"]
+
+  def fetch_page(page_number):
+    url = url_or_path + "&page={}".format(page_number)
+    # Page 1 is revalidated, so an unchanged listing costs no quota.
+    headers = {}
+    if page_number == 1:
+      headers = _conditional_headers(CacheEntry(None, 0, validators))
+
+    response = _call(lambda: _get_transport().get(
+        url, text=True, headers=headers), stats.endpoint_for_url(url))
+    if response.status == 304:
+      return None, validators
+
+    page = json.loads(response.content)
+    if subkey is not None:
+      page = page[subkey]
+
+    assert type(page) is list
+    page_validators = {
+      name: response.headers[name]
+      for name in ["etag", "last-modified"] if name in response.headers
+    }
+    return page, page_validators
+
+  def is_unchanged(item):
+    old = known.get(item[id_field])
+    return old is not None and old[time_field] == item[time_field]
+
+  # With nothing known, the whole listing is needed, so pages are fetched in
+  # batches like api_multiple.  Otherwise, usually only the first page is.
+  batch_size = 1
+  page_number = 1
+  fetched = []
+  done = False
+  while not done:
+    page_numbers = range(page_number, page_number + batch_size)
+    for page, page_validators in map_concurrent(fetch_page, page_numbers):
+      if page_number == 1:
+        validators = page_validators
+      page_number += 1
+
+      if not page:
+        # The end of the listing, or page 1 is unchanged.
+        done = True
+        break
+
+      fetched.extend(page)
+      if any(is_unchanged(item) for item in page):
+        done = True
+        break
+
+    if not known:
+      batch_size = concurrency
+
+  if debug_api:
+    print("LISTING: {} new or updated items from {} pages of {}".format(
+          len(fetched), page_number - 1, url_or_path), file=sys.stderr)
+
+  changed = [item for item in fetched if not is_unchanged(item)]
+  if changed or items is None:
+    # An item can show up twice if it moved while paging.  The newest wins.
+    for item in reversed(changed):
+      if fields is not None:
+        item = _pick_fields(item, fields)
+      known[item[id_field]] = item
+    items = sorted(known.values(), key=lambda item: item[time_field],
+                   reverse=True)
+    # The merged items never expire.  Only how recently they were checked
+    # matters.
+    disk_cache.store(key, items, ttl_minutes=LONG_TTL_MINUTES)
+
+  disk_cache.store(checked_key, {
+    "checked_at": now,
+    "validators": validators,
+  }, ttl_minutes=LONG_TTL_MINUTES)
+  return items
@@ -0,0 +1,60 @@
+# Shaka Player Project Health Metrics
+# Copyright 2023 Google LLC
+# SPDX-License-Identifier: Apache-2.0
+
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+# The number of worker processes for parsing.  With 0, parsing runs in the
+# calling thread.
+workers = 0
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(num_workers):
+  """Parse in up to num_workers processes.  0 parses in-process."""
+  global workers
+
+  shutdown()
+  workers = max(0, num_workers)
+
+
+def _get_pool():
+  global _pool
+
+  with _pool_lock:
+    if _pool is None:
+      # Forking a process with other threads running can deadlock, so the
+      # workers start from a clean interpreter instead.
+      context = multiprocessing.get_context("spawn")
+      _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    return _pool
+
+
+def run(callback, *args):
+  """Returns callback(*args), computed in a worker process if configured.
+
+  callback, args, and the result must all be picklable, so callback must be a
+  module-level function or a class.  This blocks the calling thread, so
+  callers fetching artifacts concurrently with gh.map_concurrent parse them
+  in parallel, too.
+  """
+  if workers == 0:
+    return callback(*args)
+
+  return _get_pool().submit(callback, *args).result()
+
+
+def shutdown():
+  """Stop the worker processes, if any were started."""
+  global _pool
+
+  with _pool_lock:
+    if _pool is not None:
+      _pool.shutdown()
+      _pool = None
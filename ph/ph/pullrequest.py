@@ -2,12 +2,49 @@
 # Copyright 2023 Google LLC
 # SPDX-License-Identifier: Apache-2.0
 
+import copy
 import dateutil.parser
 import json
+import sys
 
 from . import base
 from . import gh
-from .coveragedetails import CoverageDetails
+from .coveragedetails import CoverageDetails, LineSet
+
+
+# Finds merged PRs with the fields PullRequest needs, 100 at a time.
+_MERGED_PRS_QUERY = """
+query($search: String!, $cursor: String) {
+  search(query: $search, type: ISSUE, first: 100, after: $cursor) {
+    issueCount
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
+    nodes {
+      ... on PullRequest {
+        number
+        mergedAt
+        updatedAt
+        mergeCommit {
+          oid
+        }
+        headRefOid
+      }
+    }
+  }
+}
+"""
+
+# GitHub search never returns more than this many results for one query.
+_MAX_SEARCH_RESULTS = 1000
+
+
+# The fields of listed PRs that are read by the constructor.  Only these are
+# cached.
+_LISTING_FIELDS = [
+  "number", "merged_at", "updated_at", "merge_commit_sha", "head.sha",
+]
 
 
 class PullRequest(object):
@@ -40,6 +77,14 @@ class PullRequest(object):
       "num_instrumented_lines": self.num_instrumented_lines,
     }
 
+  def copy_without_coverage(self):
+    """Returns a copy that shares the loaded changes, but not coverage."""
+    pr = copy.copy(self)
+    pr.num_covered_lines = None
+    pr.num_instrumented_lines = None
+    pr.incremental_coverage = None
+    return pr
+
   def _matching_workflow_run(self, runs):
     # Start with the most recent runs.
     for run in sorted(runs, key=lambda r: r.start_time, reverse=True):
@@ -48,7 +93,11 @@ class PullRequest(object):
     return None
 
   def _load_changes(self):
-    self.changes = {}
+    if self.changes is not None:
+      # Already loaded.
+      return
+
+    changes = {}
 
     api_path = "/repos/%s/commits/%s" % (self.repo, self.merge_sha)
     files = gh.api_multiple(api_path, "files")
@@ -76,7 +125,9 @@ class PullRequest(object):
           touched_lines.append(line_number)
           line_number += 1
 
-      self.changes[filename] = touched_lines
+      changes[filename] = touched_lines
+
+    self.changes = changes
 
   def _load_incremental_coverage(self, runs):
     if self.num_covered_lines is not None:
@@ -96,28 +147,26 @@ class PullRequest(object):
       self.incremental_coverage = cached["incremental"]
       return
 
-    file_data = run.fetch_artifact("coverage", "coverage-details.json")
-    if file_data is None:
+    # Only the files this PR changed are needed.
+    coverage_details = CoverageDetails.load(run, wanted_paths=self.changes)
+    if coverage_details is None:
       # No coverage details available.
       return
 
-    coverage_details = CoverageDetails(file_data)
-
     self.num_covered_lines = 0
     self.num_instrumented_lines = 0
 
     for path in self.changes:
       if path in coverage_details.files:
-        changed_lines = self.changes[path]
+        changed_lines = LineSet.from_lines(self.changes[path])
         instrumented_lines = coverage_details.files[path]["instrumented"]
         executed_lines = coverage_details.files[path]["executed"]
 
-        for line in changed_lines:
-          # Only count the instrumented lines, not whitespace or comments.
-          if line in instrumented_lines:
-            self.num_instrumented_lines += 1
-            if line in executed_lines:
-              self.num_covered_lines += 1
+        # Only count the instrumented lines, not whitespace or comments.
+        changed_instrumented_lines = changed_lines & instrumented_lines
+        self.num_instrumented_lines += len(changed_instrumented_lines)
+        self.num_covered_lines += len(
+            changed_instrumented_lines & executed_lines)
 
     if self.num_instrumented_lines == 0:
       self.incremental_coverage = None
@@ -139,14 +188,43 @@ class PullRequest(object):
     return PullRequest(repo, data)
 
   @staticmethod
-  def get_all_merged(repo, range_start):
-    # NOTE: We can't use a predicate here to stop paging early.  We have to
-    # pull in all PRs.  This is because GH won't sort our PRs by when they are
-    # merged, and stopping early only works if the items are in order of the
-    # thing you care about.  (Current options as of September 2024 are:
-    # created, updated, popularity, long-running.)
-    # See: https://docs.github.com/en/rest/pulls/pulls#list-pull-requests
-    results = gh.api_multiple("/repos/%s/pulls?state=closed" % repo)
+  def _search_merged(repo, range_start):
+    # Unlike the REST listing, search can filter by merge date, so the number
+    # of calls depends on the size of the range, not the age of the repo.
+    search = "repo:%s is:pr is:merged merged:>=%s" % (
+        repo, range_start.strftime("%Y-%m-%d"))
+    nodes = gh.api_graphql_nodes(
+        _MERGED_PRS_QUERY, {"search": search}, "search")
+
+    if len(nodes) >= _MAX_SEARCH_RESULTS:
+      print("Warning: PR search hit the limit of {} results.  Some merged PRs "
+            "may be missing.".format(_MAX_SEARCH_RESULTS), file=sys.stderr)
+
+    # Convert to the same shape as the REST API.
+    return [{
+      "number": node["number"],
+      "merged_at": node["mergedAt"],
+      "updated_at": node["updatedAt"],
+      "merge_commit_sha": (node["mergeCommit"] or {}).get("oid"),
+      "head": {"sha": node["headRefOid"]},
+    } for node in nodes]
+
+  @staticmethod
+  def get_all_merged(repo, range_start, use_graphql=False):
+    if use_graphql:
+      results = PullRequest._search_merged(repo, range_start)
+    else:
+      # NOTE: We can't use a predicate here to stop paging early.  We have to
+      # pull in all PRs.  This is because GH won't sort our PRs by when they
+      # are merged, and stopping early only works if the items are in order of
+      # the thing you care about.  (Current options as of September 2024 are:
+      # created, updated, popularity, long-running.)
+      # See: https://docs.github.com/en/rest/pulls/pulls#list-pull-requests
+      # Sorting by update time lets the full set be cached, and only PRs
+      # updated since the last run be fetched.
+      results = gh.api_incremental(
+          "/repos/%s/pulls?state=closed&sort=updated&direction=desc" % repo,
+          fields=_LISTING_FIELDS)
 
     return base.load_and_filter_by_time(
         results,
@@ -157,10 +235,14 @@ class PullRequest(object):
 
   @staticmethod
   def average_incremental_coverage(merged_prs, workflow_runs):
-    for pr in merged_prs:
+    # Each PR's changes and coverage artifact are independent of the others,
+    # so load them concurrently.
+    def load(pr):
       pr._load_changes()
       pr._load_incremental_coverage(workflow_runs)
 
+    gh.map_concurrent(load, merged_prs)
+
     return base.average(
         merged_prs,
         should_count=lambda pr: pr.num_instrumented_lines is not None,
@@ -0,0 +1,161 @@
+# Shaka Player Project Health Metrics
+# Copyright 2023 Google LLC
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import re
+import tempfile
+
+
+# The first request fetches this much of the end of the file.  For a zip, that
+# is usually enough to hold the whole central directory.
+TAIL_BYTES = 64 << 10
+
+# Small reads are rounded up to this, so that a zip member's local header and
+# the start of its data come back in one request.
+READ_AHEAD_BYTES = 64 << 10
+
+# Streamed downloads stay in memory up to this size, then go to disk.
+SPOOL_MAX_MEMORY_BYTES = 16 << 20
+
+_CHUNK_BYTES = 1 << 20
+
+
+def _check_status(url, response):
+  if response.status_code >= 400:
+    raise RuntimeError("Request failed:", url, response.status_code)
+
+
+class RangeFile(io.RawIOBase):
+  """A read-only, seekable file backed by HTTP Range requests.
+
+  open_stream(url, headers) must return a streaming requests.Response.  Use
+  open_url() to create one, since it handles servers without range support.
+  """
+
+  def __init__(self, open_stream, url, size, buffer_start, buffer):
+    super().__init__()
+    self._open_stream = open_stream
+    self.url = url
+    self.size = size
+    self.num_requests = 1
+    self._position = 0
+    self._buffer_start = buffer_start
+    self._buffer = buffer
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self._position
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      offset += self._position
+    elif whence == io.SEEK_END:
+      offset += self.size
+
+    if offset < 0:
+      raise ValueError("Negative seek position", offset)
+    self._position = offset
+    return offset
+
+  def _fetch(self, start, end):
+    """Returns bytes [start, end) of the file."""
+    headers = {"Range": "bytes={}-{}".format(start, end - 1)}
+    response = self._open_stream(self.url, headers)
+    self.num_requests += 1
+    with response:
+      _check_status(self.url, response)
+      if response.status_code != 206:
+        raise RuntimeError("Range request ignored:", self.url)
+      return response.content
+
+  def _read(self, n):
+    start = self._position
+    end = min(self.size, start + n)
+    if start >= end:
+      return b""
+
+    buffer_end = self._buffer_start + len(self._buffer)
+    if self._buffer_start <= start and end <= buffer_end:
+      offset = start - self._buffer_start
+      data = self._buffer[offset:offset + end - start]
+    elif self._buffer_start <= start < buffer_end:
+      # Use what is buffered, and fetch the rest.
+      offset = start - self._buffer_start
+      data = self._buffer[offset:] + self._fetch(buffer_end, end)
+    else:
+      fetch_end = min(self.size, max(end, start + READ_AHEAD_BYTES))
+      self._buffer_start = start
+      self._buffer = self._fetch(start, fetch_end)
+      data = self._buffer[:end - start]
+
+    self._position += len(data)
+    return data
+
+  def readinto(self, b):
+    data = self._read(len(b))
+    b[:len(data)] = data
+    return len(data)
+
+  def read(self, n=-1):
+    if n is None or n < 0:
+      return self.readall()
+    return self._read(n)
+
+  def readall(self):
+    return self._read(max(0, self.size - self._position))
+
+
+def _spool(response):
+  f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_BYTES)
+  for chunk in response.iter_content(_CHUNK_BYTES):
+    f.write(chunk)
+  f.seek(0)
+  return f
+
+
+def download(open_stream, url):
+  """Returns a binary file with the whole contents of url.
+
+  The file is streamed into a temporary file, which is in memory only while
+  it is small.
+  """
+  response = open_stream(url, {})
+  with response:
+    _check_status(url, response)
+    return _spool(response)
+
+
+def open_url(open_stream, url):
+  """Returns a seekable, read-only binary file with the contents of url.
+
+  Reads are made with HTTP Range requests, so only the parts of the file that
+  are read get downloaded.  If the server doesn't support ranges, the whole
+  file is streamed into a temporary file, which is in memory only while it is
+  small.
+  """
+  response = open_stream(url, {"Range": "bytes=-{}".format(TAIL_BYTES)})
+  with response:
+    if response.status_code == 206:
+      # Content-Range looks like "bytes 1000-1999/2000".
+      match = re.match(r'bytes (\d+)-\d+/(\d+)',
+                       response.headers.get("content-range", ""))
+      if match:
+        return RangeFile(open_stream, url, int(match.group(2)),
+                         int(match.group(1)), response.content)
+
+    if response.status_code == 200:
+      # The range was ignored, and this is the whole file.
+      return _spool(response)
+
+    if response.status_code != 416:
+      _check_status(url, response)
+
+  # A range the server can't satisfy, or one it answered strangely.  Stream
+  # the whole file instead.
+  return download(open_stream, url)
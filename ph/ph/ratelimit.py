@@ -2,42 +2,138 @@
 # Copyright 2023 Google LLC
 # SPDX-License-Identifier: Apache-2.0
 
+import threading
 import time
 
+from . import stats
+
+
+# GitHub's secondary rate limits allow about 900 REST calls per minute.  Stay
+# under that no matter how much primary quota is left.
+MIN_SECONDS_BETWEEN_CALLS = 60 / 800
+
+# How long to back off after hitting a secondary rate limit that didn't say
+# how long to wait.  GitHub's docs recommend at least a minute.
+SECONDARY_LIMIT_BACKOFF_SECONDS = 60
+
+
 class RateLimit(object):
   """Rate limit calls to an arbitrary thing."""
 
-  def __init__(self, burst_limit, max_calls_per_hour):
-    """Allow up to burst_limit calls beyond the limit (max_calls_per_hour)."""
+  def __init__(self, burst_limit, max_calls_per_hour, reserve=0,
+               min_seconds_between_calls=MIN_SECONDS_BETWEEN_CALLS):
+    """Allow up to burst_limit calls beyond the limit (max_calls_per_hour).
+
+    If the server reports its actual quota through update(), the burst budget
+    follows that instead, minus reserve calls kept back for other tools.
+    """
     self.burst_limit = burst_limit
     self.seconds_per_call = 3600 / max_calls_per_hour
+    self.reserve = reserve
+    self.min_seconds_between_calls = min_seconds_between_calls
     self.start_time = time.time()
     self.num_calls = 0
+    self._lock = threading.Lock()
+
+    # The time and call count that the burst accounting is measured from.
+    # These move forward each time the server reports the real quota.
+    self._base_time = self.start_time
+    self._base_calls = 0
+
+    # The last quota reported by the server.
+    self._remaining = None
+    self._reset_time = None
+
+    # No calls may start before this time.
+    self._resume_time = 0
+    # The earliest time the next call may start, to avoid secondary limits.
+    self._next_slot = 0
+
+  def update(self, headers, limited=False):
+    """Adjust the budget from a response's (lower-cased) headers.
+
+    Uses X-RateLimit-Remaining and X-RateLimit-Reset to track the actual
+    quota, which may be shared with other tools, and Retry-After to pause all
+    callers.  Set limited if the response was a rate limit error.
+    """
+    resource = headers.get("x-ratelimit-resource", "core")
+    remaining = headers.get("x-ratelimit-remaining")
+    reset_time = headers.get("x-ratelimit-reset")
+    retry_after = headers.get("retry-after")
+
+    with self._lock:
+      now = time.time()
+
+      if retry_after is not None:
+        self._resume_time = max(self._resume_time, now + float(retry_after))
+      elif limited and (remaining != "0" or resource != "core"):
+        # A secondary limit with no hint about how long to wait.
+        self._resume_time = max(
+            self._resume_time, now + SECONDARY_LIMIT_BACKOFF_SECONDS)
+
+      if resource != "core":
+        # GraphQL and search have separate budgets, which aren't tracked.
+        # Their rate limit errors still pause all callers, above.
+        return
+
+      if remaining is None or reset_time is None:
+        return
+
+      remaining = int(remaining)
+      reset_time = float(reset_time)
+
+      # With concurrent callers, responses can arrive out of order.  Within
+      # one quota window, the lowest count is the most recent.
+      if reset_time == self._reset_time and remaining > self._remaining:
+        return
+      self._remaining = remaining
+      self._reset_time = reset_time
+
+      budget = remaining - self.reserve
+      if budget <= 0:
+        # Out of quota.  Nothing can be done until it resets.
+        self._resume_time = max(self._resume_time, reset_time)
+        budget = 0
+
+      # Start the burst accounting over from here, with the real budget.
+      self.burst_limit = budget
+      self._base_time = now
+      self._base_calls = self.num_calls
 
   def wait(self):
-    """Returns when another call would not break the rate limit."""
-    self.num_calls += 1
+    """Returns when another call would not break the rate limit.
+
+    Safe to call from multiple threads.  Each caller reserves its own slot
+    before sleeping, so concurrent callers are spaced out, not bunched up.
+    """
+    with self._lock:
+      self.num_calls += 1
+      num_calls = self.num_calls - self._base_calls
+      base_time = self._base_time
+      burst_limit = self.burst_limit
+
+      now = time.time()
+      slot = max(now, self._next_slot, self._resume_time)
+      self._next_slot = slot + self.min_seconds_between_calls
+
+    wait_seconds = slot - now
 
     # Are we over our burst budget?  Compute how long we "should" wait to make
     # this many calls without considering the burst behavior.
-    now = time.time()
-    end_time = self.start_time + (self.num_calls * self.seconds_per_call)
+    end_time = base_time + (num_calls * self.seconds_per_call)
 
     # See how far in the future that is, computed in number of calls.  This is
     # how far over-budget we are without the burst behavior.
     over_budget_calls = (end_time - now) / self.seconds_per_call
 
-    # Now compare that to the burst limit.  If we're over by less than the
-    # burst limit, we can proceed.
-    if over_budget_calls <= self.burst_limit:
-      # Within the burst limit.  OK to proceed.
-      return
-
-    # Now we are over the burst limit, so we decide how long to wait to get
-    # back under that limit.
-    over_budget_calls -= self.burst_limit
-    wait_seconds = over_budget_calls * self.seconds_per_call
+    # Now compare that to the burst limit.  If we're over by more than the
+    # burst limit, we decide how long to wait to get back under that limit.
+    if over_budget_calls > burst_limit:
+      over_budget_calls -= burst_limit
+      wait_seconds = max(wait_seconds,
+                         over_budget_calls * self.seconds_per_call)
 
     # It should be positive, but sleep() throws if it's not.
     if wait_seconds > 0:
+      stats.record_sleep(wait_seconds)
       time.sleep(wait_seconds)
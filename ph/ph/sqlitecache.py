@@ -0,0 +1,239 @@
+# Shaka Player Project Health Metrics
+# Copyright 2023 Google LLC
+# SPDX-License-Identifier: Apache-2.0
+
+import atexit
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import stats
+from .diskcache import (CacheEntry, DiskCache, EvictionCandidate,
+                        REVALIDATION_GRACE_MINUTES, decode_data, encode_data,
+                        is_pinned, namespace_for_key, select_evictions)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+  key TEXT PRIMARY KEY,
+  -- "json", "text", or "bytes"
+  kind TEXT NOT NULL,
+  body BLOB NOT NULL,
+  time REAL NOT NULL,
+  expires_at REAL NOT NULL,
+  -- JSON object with "etag" and/or "last-modified", or NULL
+  validators TEXT,
+  -- The last time the entry was read or written, for LRU eviction
+  accessed_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at);
+"""
+
+
+class SqliteCache(object):
+  """Cache some arbitrary data in a single SQLite database file.
+
+  Has the same interface as DiskCache.  Expiry is an indexed column, so
+  pruning is a single query instead of reading every entry, and binary data
+  is stored as-is.
+  """
+
+  FILENAME = "cache.sqlite3"
+
+  # Access times from reads are kept in memory, and written in one batch once
+  # this many are pending, before pruning, and at exit.
+  ACCESS_FLUSH_BATCH = 256
+
+  def __init__(self, path, max_bytes=None, quotas=None, stale_minutes=0):
+    """Open the cache, and prune expired entries.
+
+    Expired entries are kept for stale_minutes, so they can be served stale.
+    If max_bytes or quotas (a map of namespace to bytes) are given, the least
+    recently used entries are then evicted to fit.
+    """
+    self.path = path
+    self.max_bytes = max_bytes
+    self.quotas = quotas
+    self.stale_minutes = stale_minutes
+    folder = os.path.dirname(path)
+    if folder:
+      os.makedirs(folder, mode=0o755, exist_ok=True)
+
+    self._lock = threading.RLock()
+    # Maps keys to access times not yet written to the database.
+    self._pending_access = {}
+    # The connection is shared by all threads, under the lock.  The timeout
+    # covers waiting on other processes.
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self._lock:
+      self._db.execute("PRAGMA journal_mode=WAL")
+      self._db.execute("PRAGMA synchronous=NORMAL")
+      self._db.executescript(_SCHEMA)
+      columns = [row[1] for row in
+                 self._db.execute("PRAGMA table_info(cache)").fetchall()]
+      if "accessed_at" not in columns:
+        # Databases created before eviction was added.
+        self._db.execute("ALTER TABLE cache ADD COLUMN "
+                         "accessed_at REAL NOT NULL DEFAULT 0")
+    self._prune_cache()
+    atexit.register(self.flush_access_times)
+
+  def flush_access_times(self):
+    """Writes the access times of recent reads to the database."""
+    with self._lock:
+      if not self._pending_access:
+        return
+      updates = [(accessed_at, key)
+                 for key, accessed_at in self._pending_access.items()]
+      self._pending_access.clear()
+      with self._db:
+        self._db.executemany(
+            "UPDATE cache SET accessed_at = ? WHERE key = ?", updates)
+
+  def _prune_cache(self):
+    self.flush_access_times()
+    now = time.time()
+    # Expired entries are kept while they can be served stale, and those with
+    # validators a while longer, so they can be revalidated.
+    stale_cutoff = now - self.stale_minutes * 60
+    grace_cutoff = min(stale_cutoff, now - REVALIDATION_GRACE_MINUTES * 60)
+    with self._lock, self._db:
+      self._db.execute(
+          "DELETE FROM cache WHERE expires_at < ? AND "
+          "(validators IS NULL OR expires_at < ?)",
+          (stale_cutoff, grace_cutoff))
+
+      if self.max_bytes is None and not self.quotas:
+        return
+
+      rows = self._db.execute(
+          "SELECT key, length(body), accessed_at FROM cache").fetchall()
+      candidates = [
+        EvictionCandidate(key, size, accessed_at, namespace_for_key(key),
+                          is_pinned(key))
+        for key, size, accessed_at in rows
+      ]
+      evicted = select_evictions(candidates, self.max_bytes, self.quotas)
+      self._db.executemany("DELETE FROM cache WHERE key = ?",
+                           [(key,) for key in evicted])
+
+  def get(self, key):
+    """Returns data if it exists and is valid, or None."""
+    entry = self.get_entry(key)
+    if entry is None or time.time() >= entry.expires_at:
+      return None
+    return entry.data
+
+  def get_entry(self, key):
+    """Returns a CacheEntry if it exists, even if expired, or None."""
+    return self.get_sized_entry(key)[0]
+
+  def get_sized_entry(self, key):
+    """Returns (CacheEntry, bytes stored) if it exists, or (None, 0)."""
+    with self._lock:
+      row = self._db.execute(
+          "SELECT kind, body, expires_at, validators FROM cache WHERE key = ?",
+          (key,)).fetchone()
+      if row is not None:
+        # Writing this now would make every read a write transaction.
+        self._pending_access[key] = time.time()
+        if len(self._pending_access) >= self.ACCESS_FLUSH_BATCH:
+          self.flush_access_times()
+
+    if row is None:
+      return None, 0
+
+    stats.record_cache_bytes(read=len(row[1]))
+    return self._entry_from_row(*row), len(row[1])
+
+  def open(self, key):
+    """Returns a binary file for valid bytes data, or None."""
+    data = self.get(key)
+    if type(data) is not bytes:
+      return None
+    return io.BytesIO(data)
+
+  def access_time(self, key):
+    """Returns when an entry was last used, or None if it doesn't exist."""
+    with self._lock:
+      row = self._db.execute(
+          "SELECT accessed_at FROM cache WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        return None
+      return self._pending_access.get(key, row[0])
+
+  def entries(self):
+    """Yields (key, CacheEntry) for everything stored, even if expired."""
+    with self._lock:
+      rows = self._db.execute(
+          "SELECT key, kind, body, expires_at, validators FROM cache"
+          ).fetchall()
+
+    for key, *row in rows:
+      yield key, self._entry_from_row(*row)
+
+  def _entry_from_row(self, kind, body, expires_at, validators):
+    validators = json.loads(validators) if validators else {}
+    return CacheEntry(decode_data(kind, body), expires_at, validators)
+
+  def store(self, key, data, ttl_minutes, validators=None):
+    """Stores data in the cache, and returns the number of bytes stored.
+
+    If given, validators holds the "etag" and/or "last-modified" response
+    headers, used to revalidate the entry once it expires.
+    """
+    now = time.time()
+    return self._put(key, data, now, now + ttl_minutes * 60, validators)
+
+  def _put(self, key, data, stored_time, expires_at, validators):
+    with self._lock, self._db:
+      return self._insert(key, data, stored_time, expires_at, validators)
+
+  def _insert(self, key, data, stored_time, expires_at, validators):
+    kind, body = encode_data(data)
+    stats.record_cache_bytes(written=len(body))
+    validators = json.dumps(validators) if validators else None
+    self._db.execute(
+        "INSERT OR REPLACE INTO cache "
+        "(key, kind, body, time, expires_at, validators, accessed_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (key, kind, body, stored_time, expires_at, validators, time.time()))
+    return len(body)
+
+  def refresh(self, key, ttl_minutes):
+    """Extends the life of an existing entry, which may have expired."""
+    now = time.time()
+    with self._lock, self._db:
+      self._db.execute(
+          "UPDATE cache SET time = ?, expires_at = ? WHERE key = ?",
+          (now, now + ttl_minutes * 60, key))
+
+  def delete(self, key):
+    """Removes an entry, if it exists."""
+    with self._lock, self._db:
+      self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+  def import_folder(self, cache_folder):
+    """Moves the entries of a DiskCache folder into this database.
+
+    Expired entries are pruned rather than imported.  Returns the number of
+    entries imported.
+    """
+    source = DiskCache(cache_folder)
+    now = time.time()
+    keys = []
+
+    # One transaction for the whole import is much faster than one per entry.
+    with self._lock, self._db:
+      for key, entry in source.entries():
+        self._insert(key, entry.data, now, entry.expires_at, entry.validators)
+        keys.append(key)
+
+    # Only remove the files once the import has been committed.
+    for key in keys:
+      source.delete(key)
+
+    return len(keys)
@@ -0,0 +1,144 @@
+# Shaka Player Project Health Metrics
+# Copyright 2023 Google LLC
+# SPDX-License-Identifier: Apache-2.0
+
+import collections
+import contextlib
+import json
+import re
+import sys
+import threading
+import time
+
+
+# Upper bounds of the API latency histogram buckets, in seconds.  Slower
+# calls go in a final overflow bucket.
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Cache lookup results that are counted.
+CACHE_RESULTS = ["hit", "miss", "stale"]
+
+_lock = threading.Lock()
+_start_time = time.time()
+# Maps endpoints to {"calls", "seconds", "bytes", "histogram"}.
+_endpoints = {}
+# Maps namespaces to {"hit", "miss", "stale"}.
+_cache = {}
+_cache_bytes = {"read": 0, "written": 0}
+_rate_limit_sleep_seconds = 0
+# Maps phase names to seconds, in the order they first ran.
+_phases = collections.OrderedDict()
+
+
+def reset():
+  """Start counting from zero."""
+  global _start_time
+  global _rate_limit_sleep_seconds
+
+  with _lock:
+    _start_time = time.time()
+    _endpoints.clear()
+    _cache.clear()
+    _cache_bytes["read"] = 0
+    _cache_bytes["written"] = 0
+    _rate_limit_sleep_seconds = 0
+    _phases.clear()
+
+
+def endpoint_for_url(url_or_path):
+  """Groups API URLs by endpoint, with IDs and SHAs replaced by placeholders.
+
+  For example, "/repos/o/r/actions/runs/123/jobs?page=2" becomes
+  "/repos/o/r/actions/runs/:id/jobs".
+  """
+  path = re.sub(r'^https://[^/]+', '', url_or_path).split("?")[0]
+  path = re.sub(r'/[0-9a-f]{40}(?=/|$)', '/:sha', path)
+  path = re.sub(r'/\d+(?=/|$)', '/:id', path)
+  return path
+
+
+def record_call(endpoint, seconds, num_bytes=0):
+  """Count an API call to endpoint, which took seconds."""
+  bucket = 0
+  while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+    bucket += 1
+
+  with _lock:
+    stats = _endpoints.setdefault(endpoint, {
+      "calls": 0,
+      "seconds": 0,
+      "bytes": 0,
+      "histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+    })
+    stats["calls"] += 1
+    stats["seconds"] += seconds
+    stats["bytes"] += num_bytes
+    stats["histogram"][bucket] += 1
+
+
+def record_cache(namespace, result):
+  """Count a cache lookup in a namespace, with a result from CACHE_RESULTS."""
+  with _lock:
+    counts = _cache.setdefault(
+        namespace, {name: 0 for name in CACHE_RESULTS})
+    counts[result] += 1
+
+
+def record_cache_bytes(read=0, written=0):
+  with _lock:
+    _cache_bytes["read"] += read
+    _cache_bytes["written"] += written
+
+
+def record_sleep(seconds):
+  """Count time spent waiting for the rate limit."""
+  global _rate_limit_sleep_seconds
+
+  with _lock:
+    _rate_limit_sleep_seconds += seconds
+
+
+@contextlib.contextmanager
+def phase(name):
+  """Time a phase of the run.  Repeated phases add up."""
+  start = time.time()
+  try:
+    yield
+  finally:
+    with _lock:
+      _phases[name] = _phases.get(name, 0) + time.time() - start
+
+
+def report():
+  """Returns everything counted so far, as a JSON-serializable object."""
+  with _lock:
+    endpoints = {}
+    for endpoint, stats in sorted(_endpoints.items()):
+      endpoints[endpoint] = dict(stats, histogram=list(stats["histogram"]))
+
+    return {
+      "wall_seconds": time.time() - _start_time,
+      "phases": dict(_phases),
+      "rate_limit_sleep_seconds": _rate_limit_sleep_seconds,
+      "latency_buckets": LATENCY_BUCKETS,
+      "endpoints": endpoints,
+      "cache": {
+        namespace: dict(counts) for namespace, counts in sorted(_cache.items())
+      },
+      "cache_bytes": dict(_cache_bytes),
+    }
+
+
+def write_report(path, extra=None):
+  """Writes the report as JSON to path, or to stderr if path is "-".
+
+  extra holds any other fields to include.
+  """
+  data = report()
+  data.update(extra or {})
+
+  if path == "-":
+    print(json.dumps(data, indent=2), file=sys.stderr)
+  else:
+    with open(path, "w") as f:
+      json.dump(data, f, indent=2)
@@ -0,0 +1,236 @@
+# Shaka Player Project Health Metrics
+# Copyright 2023 Google LLC
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import sys
+
+import requests as requests_lib
+from requests.adapters import HTTPAdapter
+
+from . import shell
+
+
+API_ROOT = "https://api.github.com"
+
+# Matches the API version the gh CLI requests by default.
+API_VERSION = "2022-11-28"
+
+# Connections kept alive per host.  Most calls go to api.github.com, and
+# artifact downloads are redirected to a handful of blob storage hosts.
+POOL_SIZE = 16
+
+# Seconds to wait for a connection or for the next chunk of a response.
+TIMEOUT_SECONDS = 60
+
+
+class RateLimitedError(RuntimeError):
+  """The server refused a request because of a rate limit."""
+
+  def __init__(self, url, status, headers, text):
+    super().__init__("Rate limited:", url, status, text)
+    # Header names are lower-cased.
+    self.headers = headers
+
+
+def _is_rate_limited(status, headers):
+  # Primary limits return 403 or 429 with no quota remaining.  Secondary
+  # limits return 403 or 429, usually with Retry-After.
+  if status not in (403, 429):
+    return False
+  return (status == 429 or "retry-after" in headers or
+          headers.get("x-ratelimit-remaining") == "0")
+
+
+class Response(object):
+  """The parts of an HTTP response the API layer cares about."""
+
+  def __init__(self, status, headers, content):
+    self.status = status
+    # Header names are lower-cased.
+    self.headers = headers
+    self.content = content
+
+
+def get_token():
+  """Find a GitHub token the same way the gh CLI does, or return None.
+
+  gh prefers GH_TOKEN, then GITHUB_TOKEN, then whatever "gh auth login"
+  stored in its config file or the system keyring.
+  """
+  for name in ["GH_TOKEN", "GITHUB_TOKEN"]:
+    token = os.environ.get(name)
+    if token:
+      return token
+
+  try:
+    token = shell.run_command(["gh", "auth", "token"], text=True).strip()
+  except (OSError, RuntimeError):
+    # gh is not installed, or is not logged in.
+    return None
+
+  return token or None
+
+
+class GhCliTransport(object):
+  """Calls the GitHub API through a `gh api` subprocess per request.
+
+  Slow, since every call pays for process startup, auth lookup, and a new TLS
+  handshake, but it needs nothing beyond a logged-in gh CLI.
+  """
+
+  name = "gh"
+
+  def get(self, url_or_path, text=True, headers=None):
+    # NOTE: Request headers are ignored.  They are only used for conditional
+    # requests, and gh can't tell us that the response was a 304.
+    args = ["gh", "api", url_or_path]
+    data = shell.run_command(args, text=text)
+    # gh doesn't give us the status or headers without --include, and then
+    # the body is no longer safe to treat as text.
+    return Response(200, {}, data)
+
+  def graphql(self, query, variables):
+    args = ["gh", "api", "graphql", "-f", "query=" + query]
+    for name, value in variables.items():
+      if type(value) is str:
+        args += ["-f", "{}={}".format(name, value)]
+      else:
+        # -F converts JSON literals like numbers, true, false, and null.
+        args += ["-F", "{}={}".format(name, json.dumps(value))]
+    data = shell.run_command(args, text=True)
+    return Response(200, {}, data)
+
+
+class HttpTransport(object):
+  """Calls the GitHub API in-process over pooled keep-alive connections."""
+
+  name = "http"
+
+  def __init__(self, token, pool_size=POOL_SIZE):
+    self.session = requests_lib.Session()
+
+    # Retry GET requests that fail on the network, such as a dropped
+    # keep-alive connection.
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    self.session.mount("https://", adapter)
+
+    # NOTE: requests drops the Authorization header when following a redirect
+    # to another host, so the token is never sent to artifact blob storage.
+    self.session.headers.update({
+      "Authorization": "token {}".format(token),
+      "Accept": "application/vnd.github+json",
+      "X-GitHub-Api-Version": API_VERSION,
+      "User-Agent": "shaka-player-ph",
+    })
+
+  def _url(self, url_or_path):
+    if url_or_path.startswith("https://") or url_or_path.startswith("http://"):
+      return url_or_path
+    # Like gh, accept paths with or without a leading slash.
+    return API_ROOT + "/" + url_or_path.lstrip("/")
+
+  def _check_status(self, url, response, headers):
+    if response.status_code < 400:
+      return
+
+    if _is_rate_limited(response.status_code, headers):
+      raise RateLimitedError(url, response.status_code, headers,
+                             response.text)
+
+    raise RuntimeError("Request failed:", url, response.status_code,
+                       response.text)
+
+  def get(self, url_or_path, text=True, headers=None):
+    """GET a URL or API path.
+
+    With conditional request headers (If-None-Match, If-Modified-Since), the
+    response may be a 304 with no content.
+    """
+    url = self._url(url_or_path)
+    try:
+      response = self.session.get(url, headers=headers,
+                                  timeout=TIMEOUT_SECONDS)
+    except requests_lib.RequestException as e:
+      raise RuntimeError("Request failed:", url, e)
+
+    headers = {k.lower(): v for k, v in response.headers.items()}
+    self._check_status(url, response, headers)
+
+    if response.status_code == 304:
+      return Response(304, headers, None)
+
+    data = response.content
+    if text:
+      data = data.decode("utf8")
+    return Response(response.status_code, headers, data)
+
+  def get_redirect(self, url_or_path):
+    """GET a URL or API path without following a redirect.
+
+    For a redirect, the target is in the "location" header.  The content is
+    always None.
+    """
+    url = self._url(url_or_path)
+    try:
+      response = self.session.get(url, allow_redirects=False, stream=True,
+                                  timeout=TIMEOUT_SECONDS)
+    except requests_lib.RequestException as e:
+      raise RuntimeError("Request failed:", url, e)
+
+    with response:
+      headers = {k.lower(): v for k, v in response.headers.items()}
+      self._check_status(url, response, headers)
+      return Response(response.status_code, headers, None)
+
+  def open_stream(self, url, headers=None):
+    """GET a URL outside the API, such as the target of get_redirect().
+
+    Returns a streaming requests Response, which the caller must close.  The
+    status is not checked, and the GitHub token is not sent.
+    """
+    headers = dict(headers or {}, Authorization=None)
+    try:
+      return self.session.get(url, headers=headers, stream=True,
+                              timeout=TIMEOUT_SECONDS)
+    except requests_lib.RequestException as e:
+      raise RuntimeError("Request failed:", url, e)
+
+  def graphql(self, query, variables):
+    url = API_ROOT + "/graphql"
+    try:
+      response = self.session.post(
+          url, json={"query": query, "variables": variables},
+          timeout=TIMEOUT_SECONDS)
+    except requests_lib.RequestException as e:
+      raise RuntimeError("Request failed:", url, e)
+
+    headers = {k.lower(): v for k, v in response.headers.items()}
+    self._check_status(url, response, headers)
+
+    return Response(response.status_code, headers,
+                    response.content.decode("utf8"))
+
+
+def create_transport(backend, pool_size=POOL_SIZE):
+  """Create a transport for backend "http", "gh", or "auto".
+
+  "auto" uses the in-process HTTP transport when a token can be found, and
+  falls back to the gh CLI otherwise.
+  """
+  if backend == "gh":
+    return GhCliTransport()
+
+  token = get_token()
+  if token is not None:
+    return HttpTransport(token, pool_size)
+
+  if backend == "http":
+    raise RuntimeError("No GitHub token found.  Set GH_TOKEN or run "
+                       "\"gh auth login\".")
+
+  print("No GitHub token found.  Falling back to the gh CLI.",
+        file=sys.stderr)
+  return GhCliTransport()
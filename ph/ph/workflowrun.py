@@ -5,12 +5,23 @@
 import dateutil.parser
 import io
 import sys
+import threading
+import urllib.parse
 import zipfile
 
 from . import base
 from . import gh
 
 
+# Every WorkflowRun loaded so far, by (run ID, attempt number), so that runs
+# shared by several measurements are only built once.
+_registry = {}
+# Raw run listings by API query.  Workflows measured with the same filters
+# share one listing.
+_listings = {}
+_registry_lock = threading.Lock()
+
+
 class WorkflowRun(object):
   def __init__(self, data):
     self.run_id = data["id"]
@@ -33,92 +44,161 @@ class WorkflowRun(object):
     else:
       self.passed = None  # canceled, etc
 
-    self.previous_run = None
-    self.flaky = False
-
-    previous_attempt_url = data["previous_attempt_url"]
-    if previous_attempt_url:
-      self.previous_run = WorkflowRun.load_by_url(previous_attempt_url)
-      self.flaky = self.passed and not self.previous_run.passed
-
-  def serializable(self):
-    return {
+    # The previous attempt is only loaded if it is needed.  See previous_run.
+    self.previous_attempt_url = data["previous_attempt_url"]
+    self._previous_run = None
+
+  @property
+  def previous_run(self):
+    """The previous attempt of this run, or None.  Loaded on first use."""
+    if self.previous_attempt_url and self._previous_run is None:
+      self._previous_run = WorkflowRun.load_by_url(self.previous_attempt_url)
+    return self._previous_run
+
+  @property
+  def flaky(self):
+    """True if this attempt passed after the previous attempt did not."""
+    if not self.passed or not self.previous_attempt_url:
+      # No need to load the previous attempt.
+      return False
+    return not self.previous_run.passed
+
+  def serializable(self, include_flaky=True):
+    data = {
       "html_url": self.html_url,
       "trigger": self.trigger_time.timestamp(),
       "start": self.start_time.timestamp(),
       "duration": self.duration.total_seconds(),
       "event": self.event,
       "passed": self.passed,
-      "flaky": self.flaky,
     }
+    if include_flaky:
+      data["flaky"] = self.flaky
+    return data
 
   def fetch_artifact(self, name, filename):
     results = gh.api_multiple(self.artifacts_url, "artifacts")
 
-    zip_data = None
     for data in results:
       if data["name"] == name:
         try:
-          zip_data = gh.api_raw(data["archive_download_url"])
-          break
+          return gh.api_zip_member(data["archive_download_url"], filename,
+                                   cache=gh.cache_artifacts)
         except RuntimeError as e:
           print(
             'Failed to fetch artifact for run from {}'.format(self.start_time),
             file=sys.stderr)
           print(e, file=sys.stderr)
 
-    if zip_data is None:
-      return None
-
-    with zipfile.ZipFile(io.BytesIO(zip_data), 'r') as f:
-      try:
-        return f.read(filename)
-      except KeyError as e:
-        return None
+    return None
 
-  def fetch_logs(self, pattern):
+  def _open_logs(self):
     try:
-      zip_data = gh.api_raw(self.logs_url)
+      return gh.api_raw_spooled(self.logs_url, cache=gh.cache_artifacts)
     except RuntimeError:
       # The run was cancelled or logs have gone out of retention
       return None
 
-    if zip_data is None:
+  def fetch_logs(self, pattern):
+    zip_file = self._open_logs()
+    if zip_file is None:
       return None
 
     output = {}
-    with zipfile.ZipFile(io.BytesIO(zip_data), 'r') as f:
+    with zip_file, zipfile.ZipFile(zip_file, 'r') as f:
       for filename in f.namelist():
         if pattern.match(filename):
           output[filename] = f.read(filename)
     return output
 
+  def scan_logs(self, pattern, line_pattern=None):
+    """Yields (filename, lines) for each log file matching pattern.
+
+    lines iterates over the text lines of that file, which are decompressed
+    as they are read, so memory use doesn't depend on the size of the logs.
+    If line_pattern is given, lines yields the match objects of
+    line_pattern.search() for matching lines instead.  Each lines iterator
+    must be used before moving on to the next file.
+
+    Yields nothing if the logs are unavailable.
+    """
+    zip_file = self._open_logs()
+    if zip_file is None:
+      return
+
+    with zip_file, zipfile.ZipFile(zip_file, 'r') as f:
+      for filename in f.namelist():
+        if not pattern.match(filename):
+          continue
+
+        with f.open(filename) as member:
+          lines = io.TextIOWrapper(member, encoding="utf8", errors="replace")
+          if line_pattern is not None:
+            lines = filter(None, map(line_pattern.search, lines))
+          yield filename, lines
+
   @staticmethod
   def is_immutable(parsed):
     return parsed.get("conclusion") is not None
 
   @staticmethod
   def get_all(repo, workflow, range_start):
-    if ":" in workflow:
-      workflow_filename, event_filter = workflow.split(":")
-    else:
-      workflow_filename = workflow
-      event_filter = None
+    """Returns completed runs of a workflow, created since range_start.
+
+    workflow is a filename, optionally followed by ":event" and then
+    ":branch" to filter by.  All filtering is done by the API.
+    """
+    workflow_filename, _, filters = workflow.partition(":")
+    event_filter, _, branch_filter = filters.partition(":")
 
     api_path = "/repos/%s/actions/workflows/%s/runs" % (repo, workflow_filename)
     api_path += "?created=>=%s" % range_start.strftime("%Y-%m-%dT%H:%M:%SZ")
-    results = gh.api_multiple(api_path, "workflow_runs")
+    # Runs still in progress have no results yet, and are not measured.
+    api_path += "&status=completed"
+    if event_filter:
+      api_path += "&event=%s" % event_filter
+    if branch_filter:
+      api_path += "&branch=%s" % urllib.parse.quote(branch_filter, safe="")
+
+    results = _listings.get(api_path)
+    if results is None:
+      results = gh.api_multiple(api_path, "workflow_runs")
+      _listings[api_path] = results
+
+    runs = [WorkflowRun.from_data(data) for data in results]
+    return sorted(runs, key=lambda r: r.start_time)
 
-    return base.load_and_filter(
-        results,
-        constructor=WorkflowRun,
-        should_load=lambda d: not event_filter or d["event"] == event_filter,
-        sort_by=lambda r: r.start_time)
+  @staticmethod
+  def load_previous_attempts(runs):
+    """Load the previous attempts needed for flakiness, concurrently.
+
+    Only the attempt before each passing retry is loaded, from the run's
+    /attempts/{n} endpoint.  Earlier attempts are not.
+    """
+    needed = [r for r in runs if r.passed and r.previous_attempt_url]
+    gh.map_concurrent(lambda r: r.previous_run, needed)
 
   @staticmethod
   def load_by_url(url):
     data = gh.api_single(url, WorkflowRun.is_immutable)
-    return WorkflowRun(data)
+    return WorkflowRun.from_data(data)
+
+  @staticmethod
+  def from_data(data):
+    """Returns the WorkflowRun for data, reusing one already built."""
+    key = (data["id"], data.get("run_attempt"))
+    with _registry_lock:
+      run = _registry.get(key)
+      if run is None:
+        run = _registry[key] = WorkflowRun(data)
+      return run
+
+  @staticmethod
+  def clear_registry():
+    """Forget all runs and listings loaded so far."""
+    with _registry_lock:
+      _registry.clear()
+      _listings.clear()
 
   @staticmethod
   def average_greenness(runs):
@@ -0,0 +1,137 @@
+import os
+import time
+from ph.cachebundle import BundledCache, CacheBundle, write_bundle
+from ph.diskcache import CacheEntry, DiskCache
+
+
+def _bundle_path(tmp_path):
+    return str(tmp_path / "cache.bundle")
+
+
+def test_round_trip(tmp_path):
+    future = time.time() + 3600
+    entries = [
+        ("json", CacheEntry({"a": [1, 2]}, future, {})),
+        ("text", CacheEntry("hello", future, {})),
+        ("bytes", CacheEntry(b"PK\x05\x06", future, {"etag": "\"x\""})),
+    ]
+    assert write_bundle(_bundle_path(tmp_path), entries) == 3
+
+    bundle = CacheBundle(_bundle_path(tmp_path))
+    assert len(bundle) == 3
+    assert bundle.get_entry("json") == entries[0][1]
+    assert bundle.get_entry("text") == entries[1][1]
+    assert bundle.get_entry("bytes") == entries[2][1]
+    assert bundle.get_entry("missing") is None
+
+
+def test_expired_entries_are_not_packed(tmp_path):
+    past = time.time() - 60
+    entries = [
+        ("expired", CacheEntry("x", past, {})),
+        ("revalidatable", CacheEntry("x", past, {"etag": "\"x\""})),
+    ]
+    assert write_bundle(_bundle_path(tmp_path), entries) == 1
+    assert "revalidatable" in CacheBundle(_bundle_path(tmp_path))
+
+
+def test_missing_bundle_is_empty(tmp_path):
+    assert len(CacheBundle(_bundle_path(tmp_path))) == 0
+
+
+def test_bundled_cache_reads_bundle_and_writes_folder(tmp_path):
+    future = time.time() + 3600
+    write_bundle(_bundle_path(tmp_path),
+                 [("old", CacheEntry("from bundle", future, {}))])
+    folder = str(tmp_path / "folder")
+    cache = BundledCache(DiskCache(folder), CacheBundle(_bundle_path(tmp_path)))
+
+    assert cache.get("old") == "from bundle"
+    cache.store("new", "from folder", ttl_minutes=120)
+    assert DiskCache(folder).get("new") == "from folder"
+    assert DiskCache(folder).get("old") is None
+    assert sorted(key for key, _ in cache.entries()) == ["new", "old"]
+
+    cache.delete("old")
+    assert cache.get("old") is None
+
+
+def test_refresh_copies_entry_out_of_bundle(tmp_path):
+    past = time.time() - 60
+    write_bundle(_bundle_path(tmp_path),
+                 [("key", CacheEntry("data", past, {"etag": "\"x\""}))])
+    folder = str(tmp_path / "folder")
+    cache = BundledCache(DiskCache(folder), CacheBundle(_bundle_path(tmp_path)))
+    assert cache.get("key") is None
+    cache.refresh("key", ttl_minutes=120)
+    assert cache.get("key") == "data"
+    assert DiskCache(folder).get_entry("key").validators == {"etag": "\"x\""}
+
+
+def test_repack_merges_bundle_and_folder(tmp_path):
+    future = time.time() + 3600
+    path = _bundle_path(tmp_path)
+    write_bundle(path, [("a", CacheEntry("old a", future, {})),
+                        ("b", CacheEntry("b", future, {}))])
+    folder = str(tmp_path / "folder")
+    cache = BundledCache(DiskCache(folder), CacheBundle(path))
+    cache.store("a", "new a", ttl_minutes=120)
+
+    assert write_bundle(path, cache.entries()) == 2
+    bundle = CacheBundle(path)
+    assert bundle.get_entry("a").data == "new a"
+    assert bundle.get_entry("b").data == "b"
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_stale_window_keeps_recently_expired_entries(tmp_path):
+    now = time.time()
+    entries = [
+        ("recent", CacheEntry("x", now - 60, {})),
+        ("old", CacheEntry("x", now - 7200, {})),
+    ]
+    assert write_bundle(_bundle_path(tmp_path), entries, stale_minutes=60) == 1
+    assert "recent" in CacheBundle(_bundle_path(tmp_path))
+
+
+def test_least_recently_used_entries_are_dropped(tmp_path):
+    future = time.time() + 3600
+    entries = [
+        ("/old", CacheEntry("x" * 100, future, {})),
+        ("/new", CacheEntry("x" * 100, future, {})),
+        ("coverage-summary:1", CacheEntry(0.5, future, {})),
+    ]
+    access_times = {"/old": 1, "/new": 2, "coverage-summary:1": 0}
+    path = _bundle_path(tmp_path)
+    assert write_bundle(path, entries, max_bytes=150,
+                        access_time=access_times.get) == 2
+
+    bundle = CacheBundle(path)
+    assert sorted(bundle.keys()) == ["/new", "coverage-summary:1"]
+    assert bundle.get_entry("/new").data == "x" * 100
+    assert bundle.access_time("/new") == 2
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_bundle_access_times_are_logged_for_packing(tmp_path):
+    future = time.time() + 3600
+    path = _bundle_path(tmp_path)
+    write_bundle(path, [("/used", CacheEntry("x" * 100, future, {})),
+                        ("/unused", CacheEntry("x" * 100, future, {}))],
+                 access_time=lambda key: 1)
+    folder = str(tmp_path / "folder")
+    log_path = os.path.join(folder, BundledCache.ACCESS_LOG_FILENAME)
+
+    cache = BundledCache(DiskCache(folder), CacheBundle(path), log_path)
+    assert cache.get("/used") == "x" * 100
+    cache.save_access_times()
+
+    # Packing happens in another process.
+    cache = BundledCache(DiskCache(folder), CacheBundle(path), log_path)
+    assert cache.access_time("/used") > 1
+    assert cache.access_time("/unused") == 1
+    assert write_bundle(path, cache.entries(), max_bytes=150,
+                        access_time=cache.access_time) == 1
+    cache.clear_access_times()
+    assert not os.path.exists(log_path)
+    assert list(CacheBundle(path).keys()) == ["/used"]
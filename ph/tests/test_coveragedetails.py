@@ -0,0 +1,156 @@
+import json
+import os
+import random
+from ph.coveragedetails import CoverageDetails, _strip_git_dir
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures",
+                       "coverage-details.json")
+
+
+def _reference_lines(coverage_range):
+    return set(range(coverage_range["start"]["line"],
+                     coverage_range["end"]["line"] + 1))
+
+
+def _reference_files(file_data):
+    # The original set-based implementation, which compares every statement
+    # with every earlier statement and every function.
+    files = {}
+    for path, path_data in json.loads(file_data).items():
+        function_locations = [
+            _reference_lines(value["loc"])
+            for value in path_data["fnMap"].values()]
+
+        statement_to_lines = {}
+        for key, value in path_data["statementMap"].items():
+            lines = _reference_lines(value)
+            for function_lines in function_locations:
+                if function_lines < lines:
+                    lines -= function_lines
+            for older_key, older_lines in statement_to_lines.items():
+                if lines < older_lines:
+                    statement_to_lines[older_key] -= lines
+            statement_to_lines[key] = lines
+
+        instrumented = set()
+        for lines in statement_to_lines.values():
+            instrumented |= lines
+        executed = set()
+        for key, count in path_data["s"].items():
+            if count:
+                executed |= statement_to_lines[key]
+
+        files[_strip_git_dir(path)] = {
+            "instrumented": instrumented,
+            "executed": executed,
+        }
+    return files
+
+
+def _range(start, end):
+    return {"start": {"line": start, "column": 0},
+            "end": {"line": end, "column": 1}}
+
+
+def test_matches_reference_on_fixture():
+    with open(FIXTURE) as f:
+        file_data = f.read()
+    details = CoverageDetails(file_data)
+    assert set(details.files) == {"lib/ph.js", "lib/ui/freeboard_ui.js",
+                                  "ui/widgets.js"}
+    assert details.files == _reference_files(file_data)
+
+
+def test_matches_reference_on_random_nesting():
+    rng = random.Random(1234)
+    for _ in range(200):
+        statements = {}
+        functions = {}
+        # Nested, overlapping, identical, and empty ranges, in an arbitrary
+        # order.
+        for i in range(rng.randint(1, 40)):
+            start = rng.randint(1, 60)
+            end = start + rng.choice([-1, 0, 0, 1, 2, 5, 20, 50])
+            statements[str(i)] = _range(start, end)
+        for i in range(rng.randint(0, 10)):
+            start = rng.randint(1, 60)
+            functions[str(i)] = {"loc": _range(start, start + rng.randint(0, 15))}
+        executed = {key: rng.choice([0, 1]) for key in statements}
+
+        file_data = json.dumps({"/src/lib/a.js": {
+            "statementMap": statements, "fnMap": functions, "s": executed,
+        }})
+        assert CoverageDetails(file_data).files == _reference_files(file_data)
+
+
+def test_class_methods_are_excluded_from_class_statement():
+    file_data = json.dumps({"/build/lib/a.js": {
+        # A class on lines 1-10 with a method on lines 3-6, whose body is a
+        # single statement on line 4.
+        "statementMap": {"0": _range(1, 10), "1": _range(4, 4)},
+        "fnMap": {"0": {"loc": _range(3, 6)}},
+        "s": {"0": 1, "1": 0},
+    }})
+    files = CoverageDetails(file_data).files
+    assert files["lib/a.js"]["instrumented"] == {1, 2, 4, 7, 8, 9, 10}
+    assert files["lib/a.js"]["executed"] == {1, 2, 7, 8, 9, 10}
+
+
+def test_wanted_paths_match_full_parse():
+    with open(FIXTURE, "rb") as f:
+        file_data = f.read()
+    full = CoverageDetails(file_data).files
+    for wanted in [{"lib/ph.js"}, {"ui/widgets.js", "lib/missing.js"}, set()]:
+        details = CoverageDetails(file_data, wanted_paths=wanted)
+        assert details.files == {
+            path: data for path, data in full.items() if path in wanted}
+
+
+def test_wanted_paths_skip_tricky_json():
+    tricky = {
+        # Brackets and escaped quotes in strings must not confuse skipping.
+        "/a/lib/skipped.js": {
+            "path": "/a/lib/sk\"ipped{[.js",
+            "fnMap": {"0": {"name": "}]\\", "loc": _range(1, 2)}},
+            "statementMap": {"0": _range(1, 2)},
+            "s": {"0": 1},
+        },
+        "/a/lib/wanted.js": {
+            "fnMap": {},
+            "statementMap": {"0": _range(3, 4)},
+            "s": {"0": 1},
+        },
+    }
+    for file_data in [json.dumps(tricky), json.dumps(tricky, indent=2)]:
+        details = CoverageDetails(file_data, wanted_paths=["lib/wanted.js"])
+        assert details.files == {
+            "lib/wanted.js": {"instrumented": {3, 4}, "executed": {3, 4}},
+        }
+
+    assert CoverageDetails("{ }", wanted_paths=["lib/a.js"]).files == {}
+
+
+def test_line_set_operations():
+    from ph.coveragedetails import LineSet
+    a = LineSet.from_intervals([(1, 3), (10, 10)])
+    b = LineSet.from_lines([2, 3, 4, 10, 200])
+    assert list(a) == [1, 2, 3, 10]
+    assert len(a) == 4
+    assert 3 in a and 4 not in a and -1 not in a
+    assert a & b == {2, 3, 10}
+    assert len(a | b) == 6
+    assert a == LineSet.from_lines([10, 3, 2, 1])
+    assert LineSet() == set()
+
+
+def test_index_round_trip():
+    from ph.coveragedetails import LineSet
+    for lines in [[], [0], [1, 7, 8, 9, 4000]]:
+        line_set = LineSet.from_lines(lines)
+        assert LineSet.decode(line_set.encode()) == line_set
+
+    with open(FIXTURE, "rb") as f:
+        details = CoverageDetails(f.read())
+    index = json.loads(json.dumps(details.to_index()))
+    assert CoverageDetails.from_index(index).files == details.files
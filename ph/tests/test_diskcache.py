@@ -1,3 +1,5 @@
+import json
+import os
 import time
 import pytest
 from ph.diskcache import DiskCache
@@ -94,7 +96,7 @@ def test_prune_removes_expired_entry(tmp_path):
     # Manually trigger prune (normally runs at startup)
     cache._prune_cache()
     import os
-    assert len(os.listdir(str(tmp_path))) == 0
+    assert os.listdir(str(tmp_path)) == [DiskCache.LOCK_FILENAME]
 
 
 def test_prune_keeps_long_ttl_entry(tmp_path):
@@ -112,3 +114,322 @@ def test_prune_skips_non_json_files(tmp_path):
     cache = DiskCache(str(tmp_path))
     cache._prune_cache()
     assert non_json.exists()
+
+
+def test_concurrent_store_and_get(tmp_path):
+    """Readers in other threads never see a partial write."""
+    import threading
+    cache = DiskCache(str(tmp_path))
+    value = {"items": list(range(5000))}
+    errors = []
+
+    def writer():
+        for _ in range(20):
+            cache.store("key1", value, ttl_minutes=120)
+
+    def reader():
+        for _ in range(50):
+            data = cache.get("key1")
+            if data is not None and data != value:
+                errors.append(data)
+
+    threads = [threading.Thread(target=writer) for _ in range(2)]
+    threads += [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert cache.get("key1") == value
+
+
+def test_get_entry_returns_expired_entry(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.store("key1", "value1", ttl_minutes=0,
+                validators={"etag": "\"abc\""})
+    time.sleep(0.01)
+    assert cache.get("key1") is None
+    entry = cache.get_entry("key1")
+    assert entry.data == "value1"
+    assert entry.expires_at < time.time()
+    assert entry.validators == {"etag": "\"abc\""}
+
+
+def test_refresh_extends_expired_entry(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.store("key1", "value1", ttl_minutes=0,
+                validators={"etag": "\"abc\""})
+    time.sleep(0.01)
+    cache.refresh("key1", ttl_minutes=120)
+    assert cache.get("key1") == "value1"
+    assert cache.get_entry("key1").validators == {"etag": "\"abc\""}
+
+
+def test_prune_keeps_expired_entry_with_validators(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.store("key1", "value1", ttl_minutes=0,
+                validators={"etag": "\"abc\""})
+    time.sleep(0.01)
+    cache._prune_cache()
+    assert cache.get_entry("key1") is not None
+
+
+def _body_path(tmp_path, key):
+    import hashlib, os
+    sha = hashlib.sha256(key.encode("utf8")).hexdigest()
+    return os.path.join(str(tmp_path), sha + ".body")
+
+
+def test_bytes_stored_raw_without_base64(tmp_path):
+    import os
+    cache = DiskCache(str(tmp_path))
+    data = bytes(range(256)) * 100
+    cache.store("key1", data, ttl_minutes=120)
+    assert os.path.getsize(_body_path(tmp_path, "key1")) == len(data)
+    assert cache.get("key1") == data
+
+
+def test_open_streams_bytes_from_disk(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.store("key1", b"\x00\x01\x02", ttl_minutes=120)
+    with cache.open("key1") as f:
+        assert f.read() == b"\x00\x01\x02"
+    cache.store("key2", "text", ttl_minutes=120)
+    assert cache.open("key2") is None
+    assert cache.open("missing") is None
+
+
+def test_gzip_compression_round_trip(tmp_path):
+    import os
+    cache = DiskCache(str(tmp_path), compression="gzip")
+    value = {"items": ["same"] * 1000}
+    cache.store("key1", value, ttl_minutes=120)
+    cache.store("key2", "text " * 1000, ttl_minutes=120)
+    assert cache.get("key1") == value
+    assert cache.get("key2") == "text " * 1000
+    assert os.path.getsize(_body_path(tmp_path, "key1")) < 1000
+    # A cache without compression can still read these.
+    assert DiskCache(str(tmp_path)).get("key1") == value
+
+
+def test_zstd_compression_round_trip(tmp_path):
+    pytest.importorskip("zstandard")
+    cache = DiskCache(str(tmp_path), compression="zstd")
+    cache.store("key1", {"foo": "bar"}, ttl_minutes=120)
+    assert cache.get("key1") == {"foo": "bar"}
+
+
+def test_unknown_compression_fails(tmp_path):
+    with pytest.raises(ValueError):
+        DiskCache(str(tmp_path), compression="lzma")
+
+
+def test_prune_removes_body_files(tmp_path):
+    import os
+    cache = DiskCache(str(tmp_path))
+    cache.store("key1", b"\x00\x01\x02", ttl_minutes=0)
+    time.sleep(0.01)
+    # A body whose entry is gone.
+    orphan = tmp_path / "orphan.body"
+    orphan.write_bytes(b"\x00")
+    cache._prune_cache()
+    assert os.listdir(str(tmp_path)) == [DiskCache.LOCK_FILENAME]
+
+
+def test_storing_inline_replaces_body(tmp_path):
+    import os
+    cache = DiskCache(str(tmp_path))
+    cache.store("key1", b"\x00\x01\x02", ttl_minutes=120)
+    cache.store("key1", "text", ttl_minutes=120)
+    assert cache.get("key1") == "text"
+    assert not os.path.exists(_body_path(tmp_path, "key1"))
+
+
+def test_namespace_for_key():
+    from ph.diskcache import namespace_for_key
+    assert namespace_for_key("/repos/o/r/pulls?page=1") == "api"
+    assert namespace_for_key("graphql:{}") == "api"
+    assert namespace_for_key(
+        "https://api.github.com/repos/o/r/actions/artifacts/1/zip") == \
+        "artifacts"
+    assert namespace_for_key(
+        "https://api.github.com/repos/o/r/actions/runs/1/logs") == "artifacts"
+    assert namespace_for_key("incremental-coverage:1") == "derived"
+
+
+def _set_access_time(tmp_path, key, when):
+    import os
+    path = _body_path(tmp_path, key)[:-len(".body")] + ".json"
+    os.utime(path, (when, when))
+
+
+def test_eviction_removes_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    for i, key in enumerate(["/old", "/middle", "/new"]):
+        cache.store(key, "x" * 1000, ttl_minutes=120)
+        _set_access_time(tmp_path, key, 1000 + i)
+
+    # Room for two entries.
+    cache = DiskCache(str(tmp_path), max_bytes=2500)
+    assert cache.get("/old") is None
+    assert cache.get("/middle") == "x" * 1000
+    assert cache.get("/new") == "x" * 1000
+
+
+def test_reads_update_access_time(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    for i, key in enumerate(["/a", "/b"]):
+        cache.store(key, "x" * 1000, ttl_minutes=120)
+        _set_access_time(tmp_path, key, 1000 + i)
+    cache.get("/a")
+
+    cache = DiskCache(str(tmp_path), max_bytes=1500)
+    assert cache.get("/a") == "x" * 1000
+    assert cache.get("/b") is None
+
+
+def test_eviction_never_removes_pinned_entries(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.store("incremental-coverage:1", "x" * 1000, ttl_minutes=120)
+    _set_access_time(tmp_path, "incremental-coverage:1", 1000)
+    cache.store("/api", "x" * 1000, ttl_minutes=120)
+
+    cache = DiskCache(str(tmp_path), max_bytes=500)
+    assert cache.get("incremental-coverage:1") == "x" * 1000
+    assert cache.get("/api") is None
+
+
+def test_namespace_quota_only_evicts_that_namespace(tmp_path):
+    url = "https://api.github.com/repos/o/r/actions/artifacts/{}/zip"
+    cache = DiskCache(str(tmp_path))
+    cache.store(url.format(1), b"\x00" * 1000, ttl_minutes=120)
+    _set_access_time(tmp_path, url.format(1), 1000)
+    cache.store(url.format(2), b"\x00" * 1000, ttl_minutes=120)
+    cache.store("/api", "x" * 1000, ttl_minutes=120)
+    _set_access_time(tmp_path, "/api", 500)
+
+    cache = DiskCache(str(tmp_path), quotas={"artifacts": 1500})
+    assert cache.get(url.format(1)) is None
+    assert cache.get(url.format(2)) == b"\x00" * 1000
+    assert cache.get("/api") == "x" * 1000
+
+
+def test_memory_cache_serves_repeat_reads_from_memory(tmp_path):
+    from unittest.mock import patch
+    from ph.diskcache import MemoryCache
+    cache = MemoryCache(DiskCache(str(tmp_path)))
+    cache.store("key1", {"a": 1}, ttl_minutes=120)
+    with patch("builtins.open", side_effect=AssertionError("disk read")):
+        assert cache.get("key1") == {"a": 1}
+        assert cache.get("key1") == {"a": 1}
+    assert cache.hits == 2
+
+
+def test_memory_cache_writes_through(tmp_path):
+    from ph.diskcache import MemoryCache
+    cache = MemoryCache(DiskCache(str(tmp_path)))
+    cache.store("key1", "value1", ttl_minutes=120)
+    assert DiskCache(str(tmp_path)).get("key1") == "value1"
+
+    other = MemoryCache(DiskCache(str(tmp_path)))
+    assert other.get("key1") == "value1"
+    assert (other.hits, other.misses) == (0, 1)
+    assert other.get("key1") == "value1"
+    assert (other.hits, other.misses) == (1, 1)
+
+
+def test_memory_cache_evicts_least_recently_used(tmp_path):
+    from ph.diskcache import MemoryCache
+    cache = MemoryCache(DiskCache(str(tmp_path)), max_entries=2,
+                        max_bytes=1000)
+    cache.store("a", "x", ttl_minutes=120)
+    cache.store("b", "x", ttl_minutes=120)
+    cache.get("a")
+    cache.store("c", "x", ttl_minutes=120)
+    assert list(cache._entries) == ["a", "c"]
+
+    # Too big to keep in memory at all, but still on disk.
+    cache.store("big", "x" * 2000, ttl_minutes=120)
+    assert "big" not in cache._entries
+    assert cache.get("big") == "x" * 2000
+    assert cache._bytes <= 1000
+
+
+def test_memory_cache_delete_and_refresh(tmp_path):
+    from ph.diskcache import MemoryCache
+    cache = MemoryCache(DiskCache(str(tmp_path)))
+    cache.store("key1", "value1", ttl_minutes=0)
+    assert cache.get("key1") is None
+    cache.refresh("key1", ttl_minutes=120)
+    assert cache.get("key1") == "value1"
+    cache.delete("key1")
+    assert cache.get("key1") is None
+
+
+def test_memory_cache_skips_binary_data(tmp_path):
+    from ph.diskcache import MemoryCache
+    cache = MemoryCache(DiskCache(str(tmp_path), compression="gzip"))
+    cache.store("zip", b"PK\x05\x06", ttl_minutes=120)
+    assert cache.get("zip") == b"PK\x05\x06"
+    with cache.open("zip") as f:
+        assert f.read() == b"PK\x05\x06"
+    assert "zip" not in cache._entries
+
+    # JSON is sized as stored, which is compressed here.
+    data = {"items": [0] * 10000}
+    cache.store("json", data, ttl_minutes=120)
+    assert 0 < cache._entries["json"][1] < len(json.dumps(data))
+
+
+def _hammer_cache(folder, worker, iterations):
+    # Runs in a separate process.  Every entry is self-consistent, so any
+    # partial or mismatched read shows up as a bad value.
+    cache = DiskCache(folder)
+    bad_reads = 0
+    for i in range(iterations):
+        key = "key{}".format(i % 5)
+        if i % 2:
+            cache.store(key, {"worker": worker, "data": [worker] * 2000},
+                        ttl_minutes=120)
+        else:
+            cache.store(key, bytes([worker]) * 20000, ttl_minutes=120)
+
+        for j in range(5):
+            data = cache.get("key{}".format(j))
+            if data is None:
+                continue
+            if type(data) is bytes:
+                ok = data == bytes([data[0]]) * 20000
+            else:
+                ok = data["data"] == [data["worker"]] * 2000
+            if not ok:
+                bad_reads += 1
+    return bad_reads
+
+
+def test_concurrent_processes(tmp_path):
+    import multiprocessing
+    context = multiprocessing.get_context("fork")
+    folder = str(tmp_path)
+    with context.Pool(4) as pool:
+        results = pool.starmap(_hammer_cache,
+                               [(folder, worker, 100) for worker in range(4)])
+    assert results == [0, 0, 0, 0]
+
+    # Nothing was deleted as corrupt, and no temporary files were left behind.
+    cache = DiskCache(folder)
+    for i in range(5):
+        assert cache.get("key{}".format(i)) is not None
+    assert not [n for n in os.listdir(folder) if n.endswith(".tmp")]
+
+
+def test_prune_skipped_while_another_process_holds_the_lock(tmp_path):
+    import fcntl
+    cache = DiskCache(str(tmp_path))
+    cache.store("key1", "value1", ttl_minutes=0)
+    with open(str(tmp_path / DiskCache.LOCK_FILENAME), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        DiskCache(str(tmp_path))
+        assert cache.get_entry("key1") is not None
+    DiskCache(str(tmp_path))
+    assert cache.get_entry("key1") is None
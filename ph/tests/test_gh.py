@@ -1,4 +1,5 @@
 import json
+import time
 import pytest
 from unittest.mock import patch, MagicMock
 from ph import gh
@@ -25,8 +26,8 @@ def test_api_multiple_sha_commit_uses_long_ttl(tmp_path):
     with patch("ph.shell.run_command", side_effect=[page1, page2]):
         gh.api_multiple(base_url)
     import time, hashlib, os
-    # The stored key will be base_url + "?page_size=100&page=1"
-    stored_url = base_url + "?page_size=100&page=1"
+    # The stored key will be base_url + "?per_page=100&page=1"
+    stored_url = base_url + "?per_page=100&page=1"
     sha = hashlib.sha256(stored_url.encode("utf8")).hexdigest()
     path = os.path.join(str(tmp_path), sha + ".json")
     with open(path) as f:
@@ -86,3 +87,301 @@ def test_http_head_uses_long_ttl(tmp_path):
     with open(path) as f:
         data = json.load(f)
     assert data["expires_at"] > time.time() + 86400 * 99
+
+
+def test_map_concurrent_preserves_order():
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=gh.disk_cache.cache_folder,
+        debug=False,
+        max_concurrency=4)
+    import time
+    def slow_square(x):
+        time.sleep(0.01 * (5 - x))
+        return x * x
+    assert gh.map_concurrent(slow_square, range(5)) == [0, 1, 4, 9, 16]
+
+
+def test_api_multiple_concurrent_matches_serial(tmp_path):
+    base_url = "/repos/owner/repo/pulls?state=closed"
+    pages = {
+        1: [{"id": 1}, {"id": 2}],
+        2: [{"id": 3}, {"id": 4}],
+        3: [{"id": 5}],
+    }
+    def fake_run_command(args, text=True):
+        page = int(args[-1].split("&page=")[1])
+        return json.dumps(pages.get(page, []))
+
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=str(tmp_path / "concurrent"),
+        debug=False,
+        max_concurrency=4)
+    with patch("ph.shell.run_command", side_effect=fake_run_command):
+        results = gh.api_multiple(base_url)
+    assert [r["id"] for r in results] == [1, 2, 3, 4, 5]
+
+
+def test_api_multiple_concurrent_honors_stop_predicate(tmp_path):
+    base_url = "/repos/owner/repo/releases"
+    def fake_run_command(args, text=True):
+        page = int(args[-1].split("&page=")[1])
+        return json.dumps([{"page": page}])
+
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=str(tmp_path / "concurrent"),
+        debug=False,
+        max_concurrency=3)
+    with patch("ph.shell.run_command", side_effect=fake_run_command):
+        results = gh.api_multiple(
+            base_url, stop_predicate=lambda results: len(results) >= 2)
+    assert [r["page"] for r in results] == [1, 2]
+
+
+def test_api_single_with_sqlite_cache(tmp_path):
+    from ph.sqlitecache import SqliteCache
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=str(tmp_path / "sqlite"),
+        debug=False,
+        cache_backend="sqlite")
+    assert isinstance(gh.disk_cache.backing, SqliteCache)
+    url = "/repos/owner/repo/pulls/1"
+    with patch("ph.shell.run_command",
+               return_value=json.dumps({"number": 1})) as cmd:
+        assert gh.api_single(url) == {"number": 1}
+        assert gh.api_single(url) == {"number": 1}
+    assert cmd.call_count == 1
+
+
+def test_api_raw_file_caches_when_asked(tmp_path):
+    url = "/repos/owner/repo/actions/artifacts/1/zip"
+    with patch("ph.shell.run_command", return_value=b"PK\x05\x06") as cmd:
+        with gh.api_raw_file(url, cache=True) as f:
+            assert f.read() == b"PK\x05\x06"
+        with gh.api_raw_file(url, cache=True) as f:
+            assert f.read() == b"PK\x05\x06"
+        gh.api_raw_file(url, cache=False)
+    assert cmd.call_count == 2
+    assert gh.disk_cache.get_entry(url).expires_at > time.time() + 86400 * 99
+
+
+def test_api_raw_is_not_cached_by_default(tmp_path):
+    url = "/repos/owner/repo/actions/runs/1/logs"
+    with patch("ph.shell.run_command", return_value=b"PK\x05\x06"):
+        gh.api_raw(url)
+    assert gh.disk_cache.get_entry(url) is None
+
+
+def _stale_mode(tmp_path):
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=str(tmp_path),
+        debug=False,
+        serve_stale=True)
+
+
+def test_stale_entry_is_served_then_refreshed(tmp_path):
+    _stale_mode(tmp_path)
+    url = "/repos/owner/repo/pulls?state=closed&page=1"
+    gh.disk_cache.store(url, [{"number": 1}], ttl_minutes=-1)
+
+    with patch("ph.shell.run_command",
+               return_value=json.dumps([{"number": 2}])) as cmd:
+        assert gh.api_single(url) == [{"number": 1}]
+        assert cmd.call_count == 0
+        assert gh.refresh_stale() == 1
+        assert cmd.call_count == 1
+    assert gh.api_single(url) == [{"number": 2}]
+    assert gh.refresh_stale() == 0
+
+
+def test_very_stale_entry_is_refetched(tmp_path):
+    _stale_mode(tmp_path)
+    url = "/repos/owner/repo/pulls?state=closed&page=1"
+    gh.disk_cache.store(url, [{"number": 1}],
+                        ttl_minutes=-gh.MAX_STALE_MINUTES - 1)
+    with patch("ph.shell.run_command",
+               return_value=json.dumps([{"number": 2}])):
+        assert gh.api_single(url) == [{"number": 2}]
+
+
+def test_stale_entries_not_served_by_default(tmp_path):
+    url = "/repos/owner/repo/pulls?state=closed&page=1"
+    gh.disk_cache.store(url, [{"number": 1}], ttl_minutes=-1)
+    with patch("ph.shell.run_command",
+               return_value=json.dumps([{"number": 2}])):
+        assert gh.api_single(url) == [{"number": 2}]
+
+
+def test_stale_graphql_is_served_then_refreshed(tmp_path):
+    _stale_mode(tmp_path)
+    fresh = json.dumps({"data": {"search": "fresh"}})
+    with patch("ph.shell.run_command", return_value=fresh):
+        gh.api_graphql("query", {"q": "x"})
+    key = next(key for key, _ in gh.disk_cache.entries())
+    gh.disk_cache.store(key, {"search": "stale"}, ttl_minutes=-1)
+
+    with patch("ph.shell.run_command", return_value=fresh) as cmd:
+        assert gh.api_graphql("query", {"q": "x"}) == {"search": "stale"}
+        gh.refresh_stale()
+    assert cmd.call_count == 1
+    assert gh.api_graphql("query", {"q": "x"}) == {"search": "fresh"}
+
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_stale_graphql_survives_reopening_the_cache(tmp_path, backend):
+    def reopen():
+        gh.configure(
+            burst_limit=100,
+            rate_limit_per_hour=4000,
+            cache_folder=str(tmp_path),
+            debug=False,
+            cache_backend=backend,
+            serve_stale=True)
+
+    reopen()
+    fresh = json.dumps({"data": {"search": "fresh"}})
+    with patch("ph.shell.run_command", return_value=fresh):
+        gh.api_graphql("query", {"q": "x"})
+    key = next(key for key, _ in gh.disk_cache.entries())
+    # GraphQL responses have no validators, so only stale mode keeps them.
+    gh.disk_cache.store(key, {"search": "stale"}, ttl_minutes=-60)
+
+    reopen()
+    with patch("ph.shell.run_command", return_value=fresh) as cmd:
+        assert gh.api_graphql("query", {"q": "x"}) == {"search": "stale"}
+    assert cmd.call_count == 0
+
+
+def test_failed_refresh_is_reported_not_raised(tmp_path):
+    _stale_mode(tmp_path)
+    url = "/repos/owner/repo/pulls?state=closed&page=1"
+    gh.disk_cache.store(url, [{"number": 1}], ttl_minutes=-1)
+    with patch("ph.shell.run_command", side_effect=RuntimeError("down")):
+        gh.api_single(url)
+        assert gh.refresh_stale() == 0
+
+
+def _pr(number, updated_at):
+    return {"id": number, "number": number, "updated_at": updated_at}
+
+
+def _pages_by_url(pages):
+    # Serves the listing pages, by page number, through the gh CLI.
+    def fake_run_command(args, text=True):
+        page = int(args[2].split("&page=")[1])
+        if page > len(pages):
+            return "[]"
+        return json.dumps(pages[page - 1])
+    return fake_run_command
+
+
+def test_api_incremental_fetches_whole_listing_once(tmp_path):
+    url = "/repos/owner/repo/pulls?state=closed&sort=updated&direction=desc"
+    pages = [
+        [_pr(3, "2024-01-03"), _pr(2, "2024-01-02")],
+        [_pr(1, "2024-01-01")],
+    ]
+    with patch("ph.shell.run_command",
+               side_effect=_pages_by_url(pages)) as cmd:
+        results = gh.api_incremental(url)
+        # Fresh, so no calls at all.
+        assert gh.api_incremental(url) == results
+    assert [r["number"] for r in results] == [3, 2, 1]
+    assert cmd.call_count == 3
+    assert "per_page=100" in cmd.call_args_list[0][0][0][2]
+
+
+def test_api_incremental_only_fetches_new_pages(tmp_path):
+    url = "/repos/owner/repo/pulls?state=closed&sort=updated&direction=desc"
+    old_pages = [
+        [_pr(3, "2024-01-03"), _pr(2, "2024-01-02")],
+        [_pr(1, "2024-01-01")],
+    ]
+    with patch("ph.shell.run_command", side_effect=_pages_by_url(old_pages)):
+        gh.api_incremental(url)
+
+    # Expire the check.  Everything known shifts down a page, and PR 1 is
+    # updated, so it moves to the front.
+    key = "incremental:checked:" + url
+    state = gh.disk_cache.get(key)
+    state["checked_at"] = 0
+    gh.disk_cache.store(key, state, ttl_minutes=gh.LONG_TTL_MINUTES)
+
+    new_pages = [
+        [_pr(1, "2024-01-05"), _pr(4, "2024-01-04")],
+        [_pr(3, "2024-01-03"), _pr(2, "2024-01-02")],
+    ]
+    with patch("ph.shell.run_command",
+               side_effect=_pages_by_url(new_pages)) as cmd:
+        results = gh.api_incremental(url)
+    # Page 2 starts with a known, unchanged PR, so paging stops there.
+    assert cmd.call_count == 2
+    assert [(r["number"], r["updated_at"]) for r in results] == [
+        (1, "2024-01-05"), (4, "2024-01-04"), (3, "2024-01-03"),
+        (2, "2024-01-02"),
+    ]
+
+
+def test_api_incremental_keeps_fields_and_skips_unchanged_items(tmp_path):
+    url = "/repos/owner/repo/pulls?state=closed&sort=updated&direction=desc"
+    pages = [[dict(_pr(2, "2024-01-02"), head={"sha": "b", "repo": {}}),
+              dict(_pr(1, "2024-01-01"), head={"sha": "a", "repo": {}})]]
+    with patch("ph.shell.run_command", side_effect=_pages_by_url(pages)):
+        results = gh.api_incremental(url, fields=["number", "head.sha"])
+    assert results[0] == {"id": 2, "updated_at": "2024-01-02", "number": 2,
+                          "head": {"sha": "b"}}
+
+    key = "incremental:checked:" + url
+    state = gh.disk_cache.get(key)
+    state["checked_at"] = 0
+    gh.disk_cache.store(key, state, ttl_minutes=gh.LONG_TTL_MINUTES)
+
+    # Nothing changed, so only the check is stored again.
+    with patch("ph.shell.run_command", side_effect=_pages_by_url(pages)), \
+         patch.object(gh.disk_cache, "store") as store:
+        assert gh.api_incremental(url, fields=["number", "head.sha"]) == (
+            results)
+    assert [call[0][0] for call in store.call_args_list] == [key]
+
+
+def test_api_incremental_revalidates_first_page(tmp_path, monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    gh.configure_transport("http")
+    url = "/repos/owner/repo/pulls?state=closed&sort=updated&direction=desc"
+
+    def response(status, content, headers):
+        r = MagicMock()
+        r.status_code = status
+        r.content = content
+        r.text = content.decode("utf8")
+        r.headers = headers
+        return r
+
+    first = response(200, json.dumps([_pr(1, "2024-01-01")]).encode(),
+                     {"ETag": "\"v1\""})
+    end = response(200, b"[]", {})
+    with patch.object(gh.api_transport.session, "get",
+                      side_effect=[first, end]):
+        gh.api_incremental(url)
+
+    key = "incremental:checked:" + url
+    state = gh.disk_cache.get(key)
+    state["checked_at"] = 0
+    gh.disk_cache.store(key, state, ttl_minutes=gh.LONG_TTL_MINUTES)
+
+    with patch.object(gh.api_transport.session, "get",
+                      return_value=response(304, b"", {})) as get:
+        results = gh.api_incremental(url)
+    assert get.call_count == 1
+    assert get.call_args[1]["headers"] == {"If-None-Match": "\"v1\""}
+    assert [r["number"] for r in results] == [1]
+    gh.api_transport = None
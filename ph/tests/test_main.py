@@ -0,0 +1,88 @@
+import datetime
+import pytest
+from unittest.mock import MagicMock, patch
+import main
+from ph import gh
+
+
+@pytest.fixture(autouse=True)
+def configure_gh(tmp_path):
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=str(tmp_path),
+        debug=False)
+    yield
+
+
+def test_parse_days_sorts_and_dedupes():
+    assert main._parse_days("90,7,30,7") == [7, 30, 90]
+    assert main._parse_days("90") == [90]
+
+
+def _days_ago(days):
+    return (datetime.datetime.now(datetime.timezone.utc) -
+            datetime.timedelta(days=days, hours=1))
+
+
+def _make_run(days_ago):
+    run = MagicMock()
+    run.trigger_time = _days_ago(days_ago)
+    run.start_time = run.trigger_time
+    return run
+
+
+def _make_collected():
+    data = main.CollectData.__new__(main.CollectData)
+    data.days = 90
+    data.releases = [MagicMock(start_time=_days_ago(d)) for d in [60, 5]]
+    data.green_runs = [_make_run(d) for d in [80, 20, 3]]
+    data.latency_runs = [_make_run(d) for d in [40, 1]]
+    data.coverage_runs = [_make_run(d) for d in [50, 2]]
+    data.incremental_coverage_runs = [_make_run(d) for d in [35, 6]]
+    data.merged_prs = []
+    for d in [70, 25, 4]:
+        pr = MagicMock(timestamp=_days_ago(d))
+        pr.copy_without_coverage.return_value = pr
+        data.merged_prs.append(pr)
+    return data
+
+
+def test_window_filters_by_start_of_period():
+    collected = _make_collected()
+    with patch("main.CoverageSummary.get_all", return_value=[]), \
+         patch("main.PullRequest.average_incremental_coverage",
+               return_value=None) as average:
+        data = collected.window(7)
+
+    assert data.days == 7
+    assert len(data.releases) == 1
+    assert len(data.green_runs) == 1
+    assert len(data.latency_runs) == 1
+    assert len(data.coverage_runs) == 1
+    assert len(data.incremental_coverage_runs) == 1
+    assert len(data.merged_prs) == 1
+    average.assert_called_once_with(
+        data.merged_prs, data.incremental_coverage_runs)
+
+    # The original data is untouched.
+    assert collected.days == 90
+    assert len(collected.green_runs) == 3
+
+
+def test_window_for_longest_period_is_unchanged():
+    collected = _make_collected()
+    assert collected.window(90) is collected
+
+
+def test_parse_bytes_accepts_suffixes():
+    assert main._parse_bytes("1024") == 1024
+    assert main._parse_bytes("2K") == 2048
+    assert main._parse_bytes("1.5G") == 3 << 29
+    assert main._parse_bytes("500MB") == 500 << 20
+
+
+def test_parse_quota():
+    assert main._parse_quota("artifacts=1G") == ("artifacts", 1 << 30)
+    with pytest.raises(Exception):
+        main._parse_quota("bogus=1G")
@@ -0,0 +1,38 @@
+import os
+import pytest
+from ph import parsepool
+from ph.coveragedetails import CoverageDetails
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__), "fixtures", "coverage-details.json")
+
+
+@pytest.fixture(autouse=True)
+def reset_pool():
+    yield
+    parsepool.configure(0)
+
+
+def test_runs_inline_without_workers():
+    parsepool.configure(0)
+    assert parsepool.run(pow, 2, 10) == 1024
+    assert parsepool._pool is None
+
+
+def test_workers_parse_coverage_details():
+    with open(FIXTURE, "rb") as f:
+        file_data = f.read()
+
+    parsepool.configure(2)
+    details = parsepool.run(CoverageDetails, file_data, {"lib/ph.js"})
+    assert parsepool._pool is not None
+    assert details.files == CoverageDetails(file_data, {"lib/ph.js"}).files
+
+    parsepool.shutdown()
+    assert parsepool._pool is None
+
+
+def test_worker_exceptions_are_raised():
+    parsepool.configure(1)
+    with pytest.raises(ValueError):
+        parsepool.run(int, "not a number")
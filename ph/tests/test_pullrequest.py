@@ -1,8 +1,9 @@
 import datetime
 import json
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from ph import gh
+from ph.coveragedetails import CoverageDetails
 from ph.pullrequest import PullRequest
 
 
@@ -103,3 +104,76 @@ def test_incremental_coverage_zero_instrumented_lines():
     assert pr.num_covered_lines == 0
     assert pr.num_instrumented_lines == 0
     assert pr.incremental_coverage is None
+
+
+def test_coverage_index_is_stored_and_reused():
+    gh.store_coverage_index = True
+    try:
+        pr = _make_pr(head_sha="abc123")
+        run = _make_run(run_id=42, head_sha="abc123",
+                        fetch_return=_make_coverage_details_json())
+        pr._load_incremental_coverage([run])
+        assert gh.disk_cache.get("coverage-index:42") is not None
+
+        # A new metric can be recomputed from the index alone.
+        gh.disk_cache.delete("incremental-coverage:42")
+        run.fetch_artifact.reset_mock()
+        recomputed = _make_pr(head_sha="abc123")
+        with patch.object(CoverageDetails, "from_index",
+                          wraps=CoverageDetails.from_index) as from_index:
+            recomputed._load_incremental_coverage([run])
+        from_index.assert_called_once()
+        run.fetch_artifact.assert_not_called()
+        assert recomputed.num_covered_lines == pr.num_covered_lines == 1
+        assert (recomputed.num_instrumented_lines ==
+                pr.num_instrumented_lines == 1)
+        assert recomputed.incremental_coverage == pr.incremental_coverage
+    finally:
+        gh.store_coverage_index = False
+
+
+def _search_page(nodes, end_cursor=None):
+    return json.dumps({"data": {"search": {
+        "issueCount": 3,
+        "pageInfo": {
+            "hasNextPage": end_cursor is not None,
+            "endCursor": end_cursor,
+        },
+        "nodes": nodes,
+    }}})
+
+
+def _search_node(number, merged_at):
+    return {
+        "number": number,
+        "mergedAt": merged_at,
+        "updatedAt": merged_at,
+        "mergeCommit": {"oid": "merge%d" % number},
+        "headRefOid": "head%d" % number,
+    }
+
+
+def test_get_all_merged_graphql_pages_and_filters():
+    from unittest.mock import patch
+    range_start = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    pages = [
+        _search_page([_search_node(3, "2026-01-03T00:00:00Z"),
+                      _search_node(2, "2026-01-02T00:00:00Z")], "cursor1"),
+        _search_page([_search_node(1, "2025-12-31T23:00:00Z")]),
+    ]
+    with patch("ph.shell.run_command", side_effect=pages) as cmd:
+        prs = PullRequest.get_all_merged("owner/repo", range_start,
+                                         use_graphql=True)
+
+    assert cmd.call_count == 2
+    search_arg = cmd.call_args_list[0][0][0]
+    assert "search=repo:owner/repo is:pr is:merged merged:>=2026-01-01" \
+        in search_arg
+    assert "cursor=cursor1" in cmd.call_args_list[1][0][0]
+
+    # PR 1 is in the results because search only has day granularity, but
+    # was merged before range_start.
+    assert [pr.number for pr in prs] == [2, 3]
+    assert prs[0].merge_sha == "merge2"
+    assert prs[0].head_sha == "head2"
+    assert prs[0].merged
@@ -0,0 +1,161 @@
+import io
+import random
+import re
+import zipfile
+import pytest
+from ph import gh
+from ph import rangefile
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeBlobServer(object):
+    def __init__(self, body, supports_ranges=True):
+        self.body = body
+        self.supports_ranges = supports_ranges
+        self.bytes_sent = 0
+        self.requests = []
+
+    def open_stream(self, url, headers):
+        self.requests.append(headers.get("Range"))
+        match = re.match(r'bytes=(\d*)-(\d*)', headers.get("Range", ""))
+        if not self.supports_ranges or not match:
+            return self._send(200, {}, self.body)
+
+        size = len(self.body)
+        if match.group(1):
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1)
+        else:
+            start = max(0, size - int(match.group(2)))
+            end = size
+        content_range = "bytes {}-{}/{}".format(start, end - 1, size)
+        return self._send(206, {"content-range": content_range},
+                          self.body[start:end])
+
+    def _send(self, status, headers, content):
+        self.bytes_sent += len(content)
+        return FakeResponse(status, headers, content)
+
+
+def _make_zip():
+    # Incompressible filler, so the wanted member is a small part of the zip.
+    rng = random.Random(1)
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("coverage-details.json",
+                   bytes(rng.getrandbits(8) for _ in range(300000)))
+        z.writestr("coverage.json", b'{"total": {}}' * 100)
+        for i in range(50):
+            z.writestr("lcov/file{}.html".format(i), b"<html></html>")
+    return f.getvalue()
+
+
+def test_reads_one_member_with_ranges():
+    body = _make_zip()
+    server = FakeBlobServer(body)
+
+    with rangefile.open_url(server.open_stream, "https://blob/1") as f:
+        assert isinstance(f, rangefile.RangeFile)
+        with zipfile.ZipFile(f) as z:
+            assert z.read("coverage.json") == b'{"total": {}}' * 100
+        assert f.num_requests == len(server.requests) <= 3
+
+    assert server.bytes_sent < len(body) / 2
+
+
+def test_seek_and_read_match_file():
+    body = bytes(range(256)) * 1000
+    server = FakeBlobServer(body)
+    f = rangefile.open_url(server.open_stream, "https://blob/1")
+    expected = io.BytesIO(body)
+
+    rng = random.Random(2)
+    for _ in range(200):
+        offset = rng.randrange(-1000, len(body) + 1000)
+        whence = rng.choice([io.SEEK_SET, io.SEEK_CUR, io.SEEK_END])
+        n = rng.choice([0, 1, 30, 5000, 100000, -1])
+        try:
+            expected.seek(offset, whence)
+        except ValueError:
+            with pytest.raises(ValueError):
+                f.seek(offset, whence)
+            continue
+        f.seek(offset, whence)
+        assert f.read(n) == expected.read(n)
+        assert f.tell() == expected.tell()
+
+
+def test_falls_back_to_spooled_download():
+    body = _make_zip()
+    server = FakeBlobServer(body, supports_ranges=False)
+
+    with rangefile.open_url(server.open_stream, "https://blob/1") as f:
+        assert not isinstance(f, rangefile.RangeFile)
+        with zipfile.ZipFile(f) as z:
+            assert z.read("coverage.json") == b'{"total": {}}' * 100
+    assert server.requests == ["bytes=-{}".format(rangefile.TAIL_BYTES)]
+
+
+def test_failed_download_raises():
+    def open_stream(url, headers):
+        return FakeResponse(404, {}, b"Not found")
+
+    with pytest.raises(RuntimeError):
+        rangefile.open_url(open_stream, "https://blob/1")
+
+
+class FakeTransport(object):
+    name = "http"
+
+    def __init__(self, server):
+        self.server = server
+
+    def get_redirect(self, url_or_path):
+        return gh.transport.Response(
+            302, {"location": "https://blob/1"}, None)
+
+    def open_stream(self, url, headers):
+        return self.server.open_stream(url, headers)
+
+
+def test_api_zip_member_uses_ranges(tmp_path):
+    gh.configure(100, 4000, str(tmp_path), False, ranged_downloads=True)
+    server = FakeBlobServer(_make_zip())
+    gh.api_transport = FakeTransport(server)
+    try:
+        url = "/repos/owner/repo/actions/artifacts/1/zip"
+        assert gh.api_zip_member(url, "coverage.json") == (
+            b'{"total": {}}' * 100)
+        assert gh.api_zip_member(url, "missing.json") is None
+        assert gh.disk_cache.get_entry(url) is None
+    finally:
+        gh.api_transport = None
+
+
+def test_api_raw_spooled_streams_whole_file(tmp_path):
+    server = FakeBlobServer(_make_zip())
+    gh.api_transport = FakeTransport(server)
+    try:
+        url = "/repos/owner/repo/actions/runs/1/logs"
+        with gh.api_raw_spooled(url) as f:
+            assert f.read() == server.body
+        assert server.requests == [None]
+        assert gh.disk_cache.get_entry(url) is None
+    finally:
+        gh.api_transport = None
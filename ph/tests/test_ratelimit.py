@@ -0,0 +1,118 @@
+import threading
+import time
+from unittest.mock import patch
+from ph.ratelimit import RateLimit
+
+
+def _limiter(burst_limit, max_calls_per_hour=3600, reserve=0):
+    return RateLimit(burst_limit, max_calls_per_hour, reserve=reserve,
+                     min_seconds_between_calls=0)
+
+
+def test_burst_does_not_sleep():
+    limiter = _limiter(burst_limit=10)
+    with patch("time.sleep") as sleep:
+        for _ in range(5):
+            limiter.wait()
+    sleep.assert_not_called()
+    assert limiter.num_calls == 5
+
+
+def test_over_burst_sleeps():
+    limiter = _limiter(burst_limit=0)
+    with patch("time.sleep") as sleep:
+        limiter.wait()
+        limiter.wait()
+    assert sleep.call_count >= 1
+
+
+def test_concurrent_callers_each_count_once():
+    limiter = _limiter(burst_limit=1000)
+    def worker():
+        for _ in range(100):
+            limiter.wait()
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert limiter.num_calls == 800
+
+
+def test_update_raises_burst_from_headers():
+    limiter = _limiter(burst_limit=0, reserve=100)
+    limiter.update({
+        "x-ratelimit-remaining": "4000",
+        "x-ratelimit-reset": str(time.time() + 3600),
+    })
+    assert limiter.burst_limit == 3900
+    with patch("time.sleep") as sleep:
+        for _ in range(50):
+            limiter.wait()
+    sleep.assert_not_called()
+
+
+def test_update_ignores_stale_headers_in_same_window():
+    limiter = _limiter(burst_limit=0)
+    reset = str(time.time() + 3600)
+    limiter.update({"x-ratelimit-remaining": "100",
+                    "x-ratelimit-reset": reset})
+    limiter.update({"x-ratelimit-remaining": "150",
+                    "x-ratelimit-reset": reset})
+    assert limiter.burst_limit == 100
+
+
+def test_update_waits_for_reset_when_out_of_quota():
+    limiter = _limiter(burst_limit=1000, reserve=100)
+    limiter.update({
+        "x-ratelimit-remaining": "50",
+        "x-ratelimit-reset": str(time.time() + 600),
+    })
+    with patch("time.sleep") as sleep:
+        limiter.wait()
+    assert sleep.call_args[0][0] > 590
+
+
+def test_update_honors_retry_after():
+    limiter = _limiter(burst_limit=1000)
+    limiter.update({"retry-after": "30"}, limited=True)
+    with patch("time.sleep") as sleep:
+        limiter.wait()
+    assert 29 < sleep.call_args[0][0] <= 30
+
+
+def test_update_backs_off_on_secondary_limit_without_retry_after():
+    limiter = _limiter(burst_limit=1000)
+    limiter.update({"x-ratelimit-remaining": "3000",
+                    "x-ratelimit-reset": str(time.time() + 600)},
+                   limited=True)
+    with patch("time.sleep") as sleep:
+        limiter.wait()
+    assert sleep.call_args[0][0] > 50
+
+
+def test_update_ignores_other_resources():
+    limiter = _limiter(burst_limit=5)
+    limiter.update({"x-ratelimit-resource": "graphql",
+                    "x-ratelimit-remaining": "0",
+                    "x-ratelimit-reset": str(time.time() + 600)})
+    assert limiter.burst_limit == 5
+
+
+def test_update_honors_retry_after_for_other_resources():
+    limiter = _limiter(burst_limit=1000)
+    limiter.update({"x-ratelimit-resource": "graphql",
+                    "retry-after": "30"}, limited=True)
+    assert limiter.burst_limit == 1000
+    with patch("time.sleep") as sleep:
+        limiter.wait()
+    assert 29 < sleep.call_args[0][0] <= 30
+
+
+def test_min_seconds_between_calls_spaces_calls():
+    limiter = RateLimit(1000, 3600, min_seconds_between_calls=1)
+    with patch("time.sleep") as sleep:
+        limiter.wait()
+        limiter.wait()
+    sleep.assert_called_once()
+    assert 0.9 < sleep.call_args[0][0] <= 1
@@ -0,0 +1,118 @@
+import os
+import time
+from ph.diskcache import DiskCache
+from ph.sqlitecache import SqliteCache
+
+
+def _cache(tmp_path):
+    return SqliteCache(os.path.join(str(tmp_path), SqliteCache.FILENAME))
+
+
+def test_store_and_get(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("key1", "value1", ttl_minutes=120)
+    assert cache.get("key1") == "value1"
+
+
+def test_get_returns_none_for_expired_entry(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("key1", "value1", ttl_minutes=0)
+    time.sleep(0.01)
+    assert cache.get("key1") is None
+
+
+def test_bytes_round_trip(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("key1", b"\x00\x01\x02", ttl_minutes=120)
+    assert cache.get("key1") == b"\x00\x01\x02"
+
+
+def test_object_round_trip(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("key1", {"foo": "bar"}, ttl_minutes=120)
+    assert cache.get("key1") == {"foo": "bar"}
+    cache.store("key2", 0.75, ttl_minutes=120)
+    assert cache.get("key2") == 0.75
+
+
+def test_entries_persist_across_instances(tmp_path):
+    _cache(tmp_path).store("key1", [1, 2, 3], ttl_minutes=120)
+    assert _cache(tmp_path).get("key1") == [1, 2, 3]
+
+
+def test_get_entry_and_refresh(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("key1", "value1", ttl_minutes=0,
+                validators={"etag": "\"abc\""})
+    time.sleep(0.01)
+    entry = cache.get_entry("key1")
+    assert entry.data == "value1"
+    assert entry.validators == {"etag": "\"abc\""}
+    cache.refresh("key1", ttl_minutes=120)
+    assert cache.get("key1") == "value1"
+
+
+def test_prune_removes_expired_entry(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("key1", "value1", ttl_minutes=0)
+    cache.store("key2", "value2", ttl_minutes=0,
+                validators={"etag": "\"abc\""})
+    cache.store("key3", "value3", ttl_minutes=144000)
+    time.sleep(0.01)
+    cache._prune_cache()
+    assert cache.get_entry("key1") is None
+    # Kept so that it can be revalidated.
+    assert cache.get_entry("key2") is not None
+    assert cache.get("key3") == "value3"
+
+
+def test_import_folder(tmp_path):
+    folder = str(tmp_path / "files")
+    files = DiskCache(folder)
+    files.store("key1", {"foo": "bar"}, ttl_minutes=120,
+                validators={"etag": "\"abc\""})
+    files.store("key2", b"\x00\x01", ttl_minutes=120)
+    files.store("key3", "expired", ttl_minutes=0)
+    time.sleep(0.01)
+
+    cache = _cache(tmp_path)
+    assert cache.import_folder(folder) == 2
+    assert cache.get("key1") == {"foo": "bar"}
+    assert cache.get_entry("key1").validators == {"etag": "\"abc\""}
+    assert cache.get("key2") == b"\x00\x01"
+    assert cache.get_entry("key3") is None
+    # The imported files are gone.
+    assert [n for n in os.listdir(folder) if n.endswith(".json")] == []
+
+
+def test_eviction_removes_least_recently_used(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("/old", "x" * 1000, ttl_minutes=120)
+    cache.store("/new", "x" * 1000, ttl_minutes=120)
+    cache.store("incremental-coverage:1", "x" * 1000, ttl_minutes=120)
+    with cache._db:
+        cache._db.execute("UPDATE cache SET accessed_at = 1 WHERE key = ?",
+                          ("/old",))
+        cache._db.execute("UPDATE cache SET accessed_at = 0 WHERE key = ?",
+                          ("incremental-coverage:1",))
+
+    cache = SqliteCache(cache.path, max_bytes=2500)
+    assert cache.get("/old") is None
+    assert cache.get("/new") == "x" * 1000
+    assert cache.get("incremental-coverage:1") == "x" * 1000
+
+
+def test_read_access_times_are_written_in_batches(tmp_path):
+    cache = _cache(tmp_path)
+    cache.store("/a", "x", ttl_minutes=120)
+    with cache._db:
+        cache._db.execute("UPDATE cache SET accessed_at = 1")
+
+    assert cache.get("/a") == "x"
+    stored = cache._db.execute("SELECT accessed_at FROM cache").fetchone()[0]
+    assert stored == 1
+    assert cache.access_time("/a") > 1
+
+    cache.flush_access_times()
+    stored = cache._db.execute("SELECT accessed_at FROM cache").fetchone()[0]
+    assert stored > 1
@@ -0,0 +1,89 @@
+import json
+import pytest
+from unittest.mock import patch
+from ph import gh
+from ph import stats
+
+
+@pytest.fixture(autouse=True)
+def configure_gh(tmp_path):
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=str(tmp_path),
+        debug=False)
+    stats.reset()
+    yield
+
+
+def test_endpoint_for_url():
+    assert stats.endpoint_for_url(
+        "/repos/o/r/actions/runs/123/jobs?page=2") == \
+        "/repos/o/r/actions/runs/:id/jobs"
+    assert stats.endpoint_for_url(
+        "https://api.github.com/repos/o/r/commits/" + "a" * 40) == \
+        "/repos/o/r/commits/:sha"
+
+
+def test_record_call_histogram():
+    stats.record_call("/x", 0.05)
+    stats.record_call("/x", 3, num_bytes=10)
+    stats.record_call("/x", 120)
+    endpoint = stats.report()["endpoints"]["/x"]
+    assert endpoint["calls"] == 3
+    assert endpoint["bytes"] == 10
+    assert endpoint["histogram"][0] == 1
+    assert endpoint["histogram"][stats.LATENCY_BUCKETS.index(5)] == 1
+    assert endpoint["histogram"][-1] == 1
+
+
+def test_api_calls_and_cache_lookups_are_counted():
+    url = "/repos/o/r/pulls/1"
+    with patch("ph.shell.run_command", return_value=json.dumps({"n": 1})):
+        gh.api_single(url)
+        gh.api_single(url)
+    gh.disk_cache.get("coverage-summary:1")
+
+    report = stats.report()
+    assert report["endpoints"]["/repos/o/r/pulls/:id"]["calls"] == 1
+    assert report["cache"]["api"] == {"hit": 1, "miss": 1, "stale": 0}
+    assert report["cache"]["derived"]["miss"] == 1
+    assert report["cache_bytes"]["written"] > 0
+
+
+def test_cached_incremental_listing_is_counted_once():
+    url = "/repos/o/r/pulls?state=closed&sort=updated&direction=desc"
+    page = json.dumps([{"id": 1, "updated_at": "2024-01-01"}])
+    with patch("ph.shell.run_command", side_effect=[page, "[]"]):
+        gh.api_incremental(url)
+    stats.reset()
+
+    gh.api_incremental(url)
+    assert stats.report()["cache"]["api"] == {"hit": 1, "miss": 0, "stale": 0}
+
+
+def test_phases_add_up():
+    with patch("time.time", side_effect=[0, 2, 10, 13]):
+        with stats.phase("a"):
+            pass
+        with stats.phase("a"):
+            pass
+    assert stats.report()["phases"] == {"a": 5}
+
+
+def test_rate_limit_sleep_is_counted():
+    from ph.ratelimit import RateLimit
+    limiter = RateLimit(0, 3600, min_seconds_between_calls=0)
+    with patch("time.sleep"):
+        limiter.wait()
+        limiter.wait()
+    assert stats.report()["rate_limit_sleep_seconds"] > 0
+
+
+def test_write_report(tmp_path):
+    path = str(tmp_path / "stats.json")
+    stats.write_report(path, {"api_calls": 7})
+    with open(path) as f:
+        data = json.load(f)
+    assert data["api_calls"] == 7
+    assert "phases" in data
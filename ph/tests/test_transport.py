@@ -0,0 +1,183 @@
+import json
+import pytest
+from unittest.mock import patch, MagicMock
+from ph import gh
+from ph import transport
+from ph.transport import GhCliTransport, HttpTransport
+
+
+@pytest.fixture(autouse=True)
+def configure_gh(tmp_path):
+    gh.configure(
+        burst_limit=100,
+        rate_limit_per_hour=4000,
+        cache_folder=str(tmp_path),
+        debug=False)
+    yield
+    gh.api_transport = None
+
+
+def _fake_response(status=200, content=b"{}", headers=None):
+    response = MagicMock()
+    response.status_code = status
+    response.content = content
+    response.text = content.decode("utf8")
+    response.headers = headers or {}
+    return response
+
+
+def test_get_token_prefers_gh_token(monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "gh-token")
+    monkeypatch.setenv("GITHUB_TOKEN", "github-token")
+    assert transport.get_token() == "gh-token"
+
+
+def test_get_token_falls_back_to_github_token(monkeypatch):
+    monkeypatch.delenv("GH_TOKEN", raising=False)
+    monkeypatch.setenv("GITHUB_TOKEN", "github-token")
+    assert transport.get_token() == "github-token"
+
+
+def test_get_token_falls_back_to_gh_auth(monkeypatch):
+    monkeypatch.delenv("GH_TOKEN", raising=False)
+    monkeypatch.delenv("GITHUB_TOKEN", raising=False)
+    with patch("ph.shell.run_command", return_value="stored-token\n") as cmd:
+        assert transport.get_token() == "stored-token"
+    cmd.assert_called_once_with(["gh", "auth", "token"], text=True)
+
+
+def test_get_token_none_without_gh(monkeypatch):
+    monkeypatch.delenv("GH_TOKEN", raising=False)
+    monkeypatch.delenv("GITHUB_TOKEN", raising=False)
+    with patch("ph.shell.run_command", side_effect=FileNotFoundError()):
+        assert transport.get_token() is None
+
+
+def test_create_transport_auto_without_token_uses_gh():
+    with patch("ph.transport.get_token", return_value=None):
+        assert isinstance(transport.create_transport("auto"), GhCliTransport)
+
+
+def test_create_transport_http_without_token_fails():
+    with patch("ph.transport.get_token", return_value=None):
+        with pytest.raises(RuntimeError):
+            transport.create_transport("http")
+
+
+def test_http_transport_sends_token_and_resolves_paths():
+    t = HttpTransport("secret")
+    assert t.session.headers["Authorization"] == "token secret"
+    with patch.object(t.session, "get",
+                      return_value=_fake_response(content=b"[1]")) as get:
+        response = t.get("/repos/owner/repo/pulls", text=True)
+    assert get.call_args[0][0] == "https://api.github.com/repos/owner/repo/pulls"
+    assert response.content == "[1]"
+
+
+def test_http_transport_passes_full_urls_through():
+    t = HttpTransport("secret")
+    url = "https://api.github.com/repos/owner/repo/actions/runs/1/logs"
+    with patch.object(t.session, "get",
+                      return_value=_fake_response(content=b"\x00\x01")) as get:
+        response = t.get(url, text=False)
+    assert get.call_args[0][0] == url
+    assert response.content == b"\x00\x01"
+
+
+def test_http_transport_lowercases_headers():
+    t = HttpTransport("secret")
+    fake = _fake_response(headers={"ETag": "\"abc\""})
+    with patch.object(t.session, "get", return_value=fake):
+        response = t.get("/rate_limit")
+    assert response.headers["etag"] == "\"abc\""
+
+
+def test_http_transport_raises_on_error_status():
+    t = HttpTransport("secret")
+    with patch.object(t.session, "get",
+                      return_value=_fake_response(status=404, content=b"nope")):
+        with pytest.raises(RuntimeError):
+            t.get("/repos/owner/repo/actions/runs/1/logs", text=False)
+
+
+def test_api_single_uses_configured_http_transport(monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    gh.configure_transport("http")
+    run_data = {"id": 1, "conclusion": "success"}
+    fake = _fake_response(content=json.dumps(run_data).encode())
+    with patch.object(gh.api_transport.session, "get",
+                      return_value=fake) as get:
+        assert gh.api_single("/repos/owner/repo/actions/runs/1") == run_data
+        # The second call is served from the disk cache.
+        assert gh.api_single("/repos/owner/repo/actions/runs/1") == run_data
+    assert get.call_count == 1
+
+
+def test_expired_entry_is_revalidated_with_etag(monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    gh.configure_transport("http")
+    url = "/repos/owner/repo/actions/workflows/x.yaml/runs?page=1"
+    gh.disk_cache.store(url, [{"id": 1}], ttl_minutes=0,
+                        validators={"etag": "W/\"abc\""})
+
+    fake = _fake_response(status=304, content=b"")
+    with patch.object(gh.api_transport.session, "get",
+                      return_value=fake) as get:
+        assert gh.api_single(url) == [{"id": 1}]
+    assert get.call_args[1]["headers"] == {"If-None-Match": "W/\"abc\""}
+    # The TTL was refreshed, so the next call is a plain cache hit.
+    assert gh.disk_cache.get(url) == [{"id": 1}]
+
+
+def test_response_validators_are_cached(monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    gh.configure_transport("http")
+    url = "/repos/owner/repo/pulls?state=closed&page=1"
+    fake = _fake_response(content=b"[]", headers={
+        "ETag": "W/\"abc\"",
+        "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT",
+    })
+    with patch.object(gh.api_transport.session, "get", return_value=fake):
+        gh.api_single(url)
+    assert gh.disk_cache.get_entry(url).validators == {
+        "etag": "W/\"abc\"",
+        "last-modified": "Wed, 01 Jan 2025 00:00:00 GMT",
+    }
+
+
+def test_responses_update_rate_limiter(monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    gh.configure_transport("http")
+    fake = _fake_response(content=b"{}", headers={
+        "X-RateLimit-Remaining": "4321",
+        "X-RateLimit-Reset": "9999999999",
+    })
+    with patch.object(gh.api_transport.session, "get", return_value=fake):
+        gh.api_single("/repos/owner/repo/pulls/1")
+    assert gh.rate_limiter.burst_limit == 4321
+
+
+def test_rate_limited_call_is_retried(monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    gh.configure_transport("http")
+    limited = _fake_response(status=429, content=b"slow down",
+                             headers={"Retry-After": "1"})
+    ok = _fake_response(content=b"{\"number\": 1}")
+    with patch.object(gh.api_transport.session, "get",
+                      side_effect=[limited, ok]) as get, \
+         patch("time.sleep") as sleep:
+        assert gh.api_single("/repos/owner/repo/pulls/1") == {"number": 1}
+    assert get.call_count == 2
+    assert sleep.call_args[0][0] > 0.5
+
+
+def test_http_transport_raises_rate_limited_error():
+    t = HttpTransport("secret")
+    fake = _fake_response(status=403, content=b"limit", headers={
+        "X-RateLimit-Remaining": "0",
+        "X-RateLimit-Reset": "9999999999",
+    })
+    with patch.object(t.session, "get", return_value=fake):
+        with pytest.raises(transport.RateLimitedError) as e:
+            t.get("/repos/owner/repo/pulls/1")
+    assert e.value.headers["x-ratelimit-remaining"] == "0"
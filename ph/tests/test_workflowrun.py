@@ -0,0 +1,162 @@
+import datetime
+import io
+import re
+import zipfile
+import pytest
+from unittest.mock import patch
+from ph.workflowrun import WorkflowRun
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    WorkflowRun.clear_registry()
+    yield
+    WorkflowRun.clear_registry()
+
+
+def _run_data(run_id, conclusion, attempt=1):
+    previous_attempt_url = None
+    if attempt > 1:
+        previous_attempt_url = (
+            "https://api.github.com/repos/o/r/actions/runs/{}/attempts/{}"
+            .format(run_id, attempt - 1))
+    return {
+        "id": run_id,
+        "head_sha": "abc",
+        "event": "schedule",
+        "created_at": "2026-01-01T00:00:00Z",
+        "run_started_at": "2026-01-01T00:00:00Z",
+        "updated_at": "2026-01-01T00:10:00Z",
+        "artifacts_url": "",
+        "logs_url": "",
+        "html_url": "",
+        "conclusion": conclusion,
+        "run_attempt": attempt,
+        "previous_attempt_url": previous_attempt_url,
+    }
+
+
+def test_previous_attempt_is_loaded_lazily():
+    with patch("ph.gh.api_single") as api_single:
+        run = WorkflowRun(_run_data(1, "success", attempt=3))
+        api_single.assert_not_called()
+        assert run.serializable(include_flaky=False)["passed"] is True
+
+        api_single.return_value = _run_data(1, "failure", attempt=2)
+        assert run.flaky is True
+        assert run.flaky is True
+        # Only the attempt before this one is needed.
+        assert api_single.call_count == 1
+        assert api_single.call_args[0][0].endswith("/runs/1/attempts/2")
+
+
+def test_flaky_without_loading_previous_attempt():
+    with patch("ph.gh.api_single") as api_single:
+        assert WorkflowRun(_run_data(1, "failure", attempt=2)).flaky is False
+        assert WorkflowRun(_run_data(2, "success")).flaky is False
+        assert WorkflowRun(_run_data(3, "cancelled", attempt=2)).flaky is False
+    api_single.assert_not_called()
+
+
+def test_load_previous_attempts_only_for_passing_retries():
+    runs = [
+        WorkflowRun(_run_data(1, "success", attempt=2)),
+        WorkflowRun(_run_data(2, "failure", attempt=2)),
+        WorkflowRun(_run_data(3, "success")),
+    ]
+    with patch("ph.gh.api_single",
+               return_value=_run_data(1, "success")) as api_single:
+        WorkflowRun.load_previous_attempts(runs)
+        assert api_single.call_count == 1
+        assert WorkflowRun.average_flakiness(runs) == 0
+        assert api_single.call_count == 1
+
+
+def test_get_all_filters_on_the_server():
+    listing = [_run_data(1, "success"), _run_data(3, "success")]
+    range_start = datetime.datetime(2026, 1, 1)
+    with patch("ph.gh.api_multiple", return_value=listing) as api_multiple:
+        WorkflowRun.get_all("o/r", "tests.yaml", range_start)
+        WorkflowRun.get_all("o/r", "tests.yaml:schedule", range_start)
+        WorkflowRun.get_all("o/r", "tests.yaml:push:release/v4.x",
+                            range_start)
+    paths = [call[0][0] for call in api_multiple.call_args_list]
+    assert paths == [
+        "/repos/o/r/actions/workflows/tests.yaml/runs"
+        "?created=>=2026-01-01T00:00:00Z&status=completed",
+        "/repos/o/r/actions/workflows/tests.yaml/runs"
+        "?created=>=2026-01-01T00:00:00Z&status=completed&event=schedule",
+        "/repos/o/r/actions/workflows/tests.yaml/runs"
+        "?created=>=2026-01-01T00:00:00Z&status=completed&event=push"
+        "&branch=release%2Fv4.x",
+    ]
+
+
+def test_listings_and_runs_are_shared():
+    listing = [_run_data(3, "success"), _run_data(1, "success")]
+    range_start = datetime.datetime(2026, 1, 1)
+    with patch("ph.gh.api_multiple", return_value=listing) as api_multiple:
+        green = WorkflowRun.get_all("o/r", "tests.yaml:schedule", range_start)
+        coverage = WorkflowRun.get_all("o/r", "tests.yaml:schedule",
+                                       range_start)
+        everything = WorkflowRun.get_all("o/r", "tests.yaml", range_start)
+    assert api_multiple.call_count == 2
+    assert [r.run_id for r in green] == [3, 1]
+    assert green[0] is coverage[0] is everything[0]
+
+
+def test_attempts_of_one_run_are_distinct():
+    with patch("ph.gh.api_single",
+               return_value=_run_data(1, "failure", attempt=1)):
+        run = WorkflowRun.from_data(_run_data(1, "success", attempt=2))
+        assert run.previous_run is not run
+        assert run.previous_run.passed is False
+        assert WorkflowRun.from_data(_run_data(1, "success", attempt=2)) is run
+
+
+def _make_run():
+    run = WorkflowRun.__new__(WorkflowRun)
+    run.logs_url = "/repos/owner/repo/actions/runs/1/logs"
+    return run
+
+
+def _make_logs_zip():
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("chrome/1_test.txt",
+                   "start\nFAILED: test a\nok\nFAILED: test b\n")
+        z.writestr("firefox/1_test.txt", "FAILED: test c\n")
+        z.writestr("build.txt", "FAILED: not a test\n")
+    f.seek(0)
+    return f
+
+
+def test_scan_logs_yields_lines():
+    with patch("ph.gh.api_raw_spooled", return_value=_make_logs_zip()):
+        logs = {filename: list(lines) for filename, lines in
+                _make_run().scan_logs(re.compile(r'chrome/'))}
+    assert logs == {
+        "chrome/1_test.txt":
+            ["start\n", "FAILED: test a\n", "ok\n", "FAILED: test b\n"],
+    }
+
+
+def test_scan_logs_extracts_matches():
+    line_pattern = re.compile(r'FAILED: test (\w+)')
+    with patch("ph.gh.api_raw_spooled", return_value=_make_logs_zip()):
+        failures = [
+            (filename, match.group(1))
+            for filename, matches in _make_run().scan_logs(
+                re.compile(r'\w+/'), line_pattern)
+            for match in matches]
+    assert failures == [
+        ("chrome/1_test.txt", "a"),
+        ("chrome/1_test.txt", "b"),
+        ("firefox/1_test.txt", "c"),
+    ]
+
+
+def test_scan_logs_without_logs():
+    with patch("ph.gh.api_raw_spooled", side_effect=RuntimeError("gone")):
+        assert list(_make_run().scan_logs(re.compile(r''))) == []
+        assert _make_run().fetch_logs(re.compile(r'')) is None
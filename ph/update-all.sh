@@ -9,6 +9,16 @@ set -e
 
 cd $(dirname "$0")
 
-time ./main.py -j -d 90 > ../ph-90.json
-time ./main.py -j -d 30 > ../ph-30.json
-time ./main.py -j -d 7 > ../ph-7.json
+# Extra arguments are passed to main.py.  If PH_CACHE_BUNDLE is set, the
+# cache is read from that bundle file.
+CACHE_ARGS=()
+if [[ -n "$PH_CACHE_BUNDLE" ]]; then
+  CACHE_ARGS=(--cache-bundle "$PH_CACHE_BUNDLE")
+
+  # Pack the cache, including anything new, back into the bundle file.  This
+  # runs on exit, so that nothing fetched is lost if collection fails.
+  trap 'time ./main.py pack-cache "${CACHE_ARGS[@]}" "$@"' EXIT
+fi
+
+# Collect once for the longest period, and write one file per period.
+time ./main.py -j -d 7,30,90 -o "../ph-{days}.json" "${CACHE_ARGS[@]}" "$@"